@@ -0,0 +1,67 @@
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+
+# Fake HTTP session answering ipinfo, Nominatim and Open-Meteo instantly, so a turn never leaves the process
+class FakeSession:
+    def get(self, url: str, **kwargs):
+        if "ipinfo.io" in url:
+            payload = {"city": "Karachi"}
+        elif "nominatim" in url:
+            payload = [{"lat": "24.86", "lon": "67.01"}]
+        else:
+            payload = {"current_weather": {"temperature": 31.0, "weathercode": 1}}
+        return SimpleNamespace(status_code=200, json=lambda: payload)
+
+
+def load_agent():
+    import greeting_agent
+    greeting_agent.http_session = FakeSession()
+    return greeting_agent
+
+
+# What the graph itself costs per turn: every backend answers instantly, so the time left is node dispatch,
+# state merging and the branch pool hand-off. Allocations are traced with tracemalloc in a second pass
+def benchmark_graph_overhead(agent, turns: int = 300) -> None:
+    from metrics import metrics
+
+    messages = ["Hello, tell me a joke and the weather", "What can you do?"]
+
+    def node_runs() -> int:
+        return sum(summary["count"] for name, summary in metrics.snapshot().items() if name.startswith("node."))
+
+    def run_turns(traced: bool) -> list:
+        peaks = []
+        for n in range(turns):
+            if traced:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            agent.run_greeting_agent(messages[n % len(messages)])
+            if traced:
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        return peaks
+
+    run_turns(False)  # Warm the graph and the branch pool
+    runs = node_runs()
+    start = time.perf_counter()
+    run_turns(False)
+    elapsed = time.perf_counter() - start
+    steps = node_runs() - runs
+
+    tracemalloc.start()
+    try:
+        retained = tracemalloc.get_traced_memory()[0]
+        peaks = run_turns(True)
+        retained = tracemalloc.get_traced_memory()[0] - retained
+    finally:
+        tracemalloc.stop()
+
+    print(f"Graph overhead: {elapsed / turns * 1e3:.3f}ms per turn, {elapsed / steps * 1e6:.0f}us per node step "
+          f"({steps / turns:.1f} steps per turn)")
+    print(f"Allocations: peak {sum(peaks) / len(peaks) / 1024:.1f} KiB per turn, "
+          f"{retained / turns:.0f} bytes retained per turn")
+
+
+if __name__ == "__main__":
+    benchmark_graph_overhead(load_agent())
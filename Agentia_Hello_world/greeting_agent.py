@@ -1,44 +1,65 @@
 from langgraph.graph import StateGraph
 from langgraph.constants import START, END
-from typing import TypedDict
-import re
+from typing import TypedDict, FrozenSet
+import os
+import logging
 import requests
 import random
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import metrics
+from intents import IntentMatcher
+
+# LOG_LEVEL=DEBUG turns on the per-step debug logs; at the default level they cost a level check
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), format="%(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("greeting_agent")
+
+# Shared keep-alive session: connections are reused across turns, and transient failures
+# (connection errors, 429 and 5xx) are retried with jittered exponential backoff
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_maxsize=10,
+    max_retries=Retry(total=2, backoff_factor=0.2, backoff_jitter=0.2,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+))
 
 # Function to get the user's location
+@metrics.instrument("upstream.get_user_location")
 def get_user_location() -> str:
     try:
         # Replace 'YOUR_IPINFO_API_KEY' with your actual ipinfo.io API key
-        response = requests.get("https://ipinfo.io", timeout=5)
+        response = http_session.get("https://ipinfo.io", timeout=5)
         data = response.json()
         return data.get("city", "Unknown Location")
     except Exception as e:
-        print(f"Debug: Error getting location - {e}")
+        logger.debug("Error getting location - %s", e)
         return "Unknown Location"
 
 # Function to get the weather for a given location
+@metrics.instrument("upstream.get_coordinates")
 def get_coordinates(location: str) -> dict:
     try:
         # Simplified to use only the city name
         url = f"https://nominatim.openstreetmap.org/search?city={location}&format=json"
         headers = {"User-Agent": "YourAppName/1.0 (contact@example.com)"}  # Replace with your contact info
-        response = requests.get(url, headers=headers, timeout=5)
+        response = http_session.get(url, headers=headers, timeout=5)
 
         if response.status_code == 200:
             data = response.json()
             if data:
                 latitude = float(data[0]["lat"])
                 longitude = float(data[0]["lon"])
-                print(f"Debug: Found coordinates - Latitude: {latitude}, Longitude: {longitude}")
+                logger.debug("Found coordinates - Latitude: %s, Longitude: %s", latitude, longitude)
                 return {"latitude": latitude, "longitude": longitude}
             else:
-                print(f"Debug: No coordinates found for {location}")
+                logger.debug("No coordinates found for %s", location)
                 return {}
         else:
-            print(f"Debug: Geocoding API returned status code {response.status_code}")
+            logger.debug("Geocoding API returned status code %s", response.status_code)
             return {}
     except Exception as e:
-        print(f"Debug: Error fetching coordinates - {e}")
+        logger.debug("Error fetching coordinates - %s", e)
         return {}
 
 WEATHER_CODE_DESCRIPTIONS = {
@@ -66,6 +87,7 @@ WEATHER_CODE_DESCRIPTIONS = {
 }
 
 
+@metrics.instrument("upstream.get_weather_for_today")
 def get_weather_for_today(location: str) -> str:
     try:
         # Get coordinates dynamically
@@ -78,7 +100,7 @@ def get_weather_for_today(location: str) -> str:
 
         # Open-Meteo API URL
         url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
-        response = requests.get(url, timeout=5)
+        response = http_session.get(url, timeout=5)
 
         if response.status_code == 200:
             data = response.json()
@@ -94,145 +116,196 @@ def get_weather_for_today(location: str) -> str:
             else:
                 return f"Weather details are incomplete for {location}. Please try again later."
         else:
-            print(f"Debug: Open-Meteo returned status code {response.status_code}")
+            logger.debug("Open-Meteo returned status code %s", response.status_code)
             return f"Could not fetch weather details for {location}."
     except Exception as e:
-        print(f"Debug: Error fetching weather - {e}")
+        logger.debug("Error fetching weather - %s", e)
         return "Could not fetch weather details at the moment. Please try again later."
 
 
-# Define the state schema
+# What a turn is given, and what it hands back; the rest of the state stays inside the graph
+class TurnInput(TypedDict):
+    message: str
+
+class TurnOutput(TypedDict):
+    final_response: str
+    skipped_nodes: list  # Agent nodes the classifier ruled out, for callers tracing how a turn was routed
+
+# Define the state schema. Every node returns only the keys it owns, so each step merges one or two
+# channels instead of rewriting the whole state
 class State(TypedDict):
     message: str
+    intents: FrozenSet[str]  # Detected once by the classifier; every other node reads this
+    skipped_nodes: list
     greeting_response: str
     weather_response: str
     joke_response: str
     final_response: str
 
+# What an agent branch reads: the message and the intents the router acted on
+class AgentInput(TurnInput):
+    intents: FrozenSet[str]
+
+# Keywords for detecting intents
+GREETING_KEYWORDS = ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "howdy"]
+JOKE_KEYWORDS = ["joke", "funny", "laugh"]
+WEATHER_KEYWORDS = ["weather", "temperature", "forecast"]
+
+# Matcher built once at import; it only fires on whole words, so "Is this thing on?" isn't a greeting
+intent_matcher = IntentMatcher({"greeting": GREETING_KEYWORDS, "joke": JOKE_KEYWORDS, "weather": WEATHER_KEYWORDS})
+
+# Agent nodes in the order they run, keyed by the intent that needs them
+AGENT_NODES = [
+    ("greeting", "GreetingAgent"),
+    ("joke", "JokeAgent"),
+    ("weather", "WeatherAgent"),
+]
+
+# Intent Classifier Node
+def intent_classifier_function(state: TurnInput) -> dict:
+    intents = intent_matcher.match(state.get("message", ""))
+
+    skipped_nodes = [node for intent, node in AGENT_NODES if intent not in intents]
+    logger.debug("Detected intents = %s, skipping %s", sorted(intents), skipped_nodes)
+    return {"intents": intents, "skipped_nodes": skipped_nodes}
+
+# Fan out to every agent the message needs; they run in parallel and join at the front-end
+def route_by_intent(state: State) -> list:
+    agents = [node for intent, node in AGENT_NODES if intent in state["intents"]]
+    return agents or ["FrontEndAgent"]
+
+# Bounded pool shared by the agent branches, and how long a single branch may take
+AGENT_POOL_SIZE = 8
+BRANCH_TIMEOUT_SECONDS = 10.0
+agent_pool = concurrent.futures.ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="agent")
+
+# Run an agent branch on the pool, answering with a fallback if it exceeds its timeout
+def with_branch_timeout(agent_function, output_key: str, fallback: str):
+    def run_branch(state: AgentInput) -> dict:
+        future = agent_pool.submit(agent_function, state)
+        try:
+            return future.result(timeout=BRANCH_TIMEOUT_SECONDS)
+        except concurrent.futures.TimeoutError:
+            logger.debug("%s timed out after %ss", agent_function.__name__, BRANCH_TIMEOUT_SECONDS)
+            return {output_key: fallback}
+
+    return run_branch
+
 # Greeting Agent Node
-def greeting_agent_function(state: State) -> State:
-    greetings = [
-        "hello", "hi", "hey", "good morning", "good afternoon", "good evening",
-        "how are you", "greetings", "salutations", "what's up", "howdy"
-    ]
+def greeting_agent_function(state: AgentInput) -> dict:
     message = state.get("message", "").strip().lower()
 
-    print(f"Debug: Received message = '{message}'")
-
-    greeting_pattern = re.compile(r'(?:' + '|'.join(map(re.escape, greetings)) + r')', re.IGNORECASE)
+    logger.debug("Received message = '%s'", message)
 
-    if greeting_pattern.search(message):
-        print("Debug: Greeting detected!")
-        state["greeting_response"] = "Hello! How can I assist you today?"
+    if "greeting" in state.get("intents", ()):
+        logger.debug("Greeting detected!")
+        greeting_response = "Hello! How can I assist you today?"
     else:
-        print("Debug: No greeting detected.")
-        state["greeting_response"] = "I only handle greetings right now."
-    return state
+        logger.debug("No greeting detected.")
+        greeting_response = "I only handle greetings right now."
+
+    # Only the key this agent owns, so parallel branches don't collide
+    return {"greeting_response": greeting_response}
 
 # Weather Agent Node
-def weather_agent_function(state: State) -> State:
-    weather_keywords = ["weather", "temperature", "forecast"]
+def weather_agent_function(state: AgentInput) -> dict:
     message = state.get("message", "").strip().lower()
 
-    print(f"Debug: Received message in WeatherAgent = '{message}'")
+    logger.debug("Received message in WeatherAgent = '%s'", message)
 
-    if any(keyword in message for keyword in weather_keywords):
+    if "weather" in state.get("intents", ()):
         location = get_user_location()
-        state["weather_response"] = get_weather_for_today(location)
-        print(f"Debug: Weather response generated: {state['weather_response']}")
+        weather_response = get_weather_for_today(location)
+        logger.debug("Weather response generated: %s", weather_response)
     else:
-        state["weather_response"] = "I can only provide weather information for today."
-        print("Debug: No weather-related keywords detected.")
-    return state
+        weather_response = "I can only provide weather information for today."
+        logger.debug("No weather-related keywords detected.")
+    return {"weather_response": weather_response}
 
 # Joke Agent Node
-def joke_agent_function(state: State) -> State:
-    joke_keywords = ["joke", "funny", "laugh"]
+def joke_agent_function(state: AgentInput) -> dict:
     message = state.get("message", "").strip().lower()
 
-    print(f"Debug: Received message in JokeAgent = '{message}'")
+    logger.debug("Received message in JokeAgent = '%s'", message)
 
-    if any(keyword in message for keyword in joke_keywords):
+    if "joke" in state.get("intents", ()):
         jokes = [
             "Why don't scientists trust atoms? Because they make up everything!",
             "Why did the scarecrow win an award? Because he was outstanding in his field!",
             "What do you call fake spaghetti? An impasta!"
         ]
-        state["joke_response"] = random.choice(jokes)
-        print(f"Debug: Joke response generated: {state['joke_response']}")
+        joke_response = random.choice(jokes)
+        logger.debug("Joke response generated: %s", joke_response)
     else:
-        state["joke_response"] = "I can tell jokes if you ask for one!"
-        print("Debug: No joke-related keywords detected.")
-    return state
+        joke_response = "I can tell jokes if you ask for one!"
+        logger.debug("No joke-related keywords detected.")
+    return {"joke_response": joke_response}
 
 # Front-End Orchestration Node
-def front_end_agent_function(state: State) -> State:
-    print(f"Debug: Received state in FrontEndAgent = {state}")
-
-    message = state.get("message", "").strip().lower()
-
-    # Keywords for detecting intents
-    greeting_keywords = ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "howdy"]
-    joke_keywords = ["joke", "funny", "laugh"]
-    weather_keywords = ["weather", "temperature", "forecast"]
-
-    # Detect multiple intents
-    intents = {
-        "greeting": any(keyword in message for keyword in greeting_keywords),
-        "joke": any(keyword in message for keyword in joke_keywords),
-        "weather": any(keyword in message for keyword in weather_keywords)
-    }
+def front_end_agent_function(state: State) -> dict:
+    # Intents were detected once by the classifier
+    intents = state.get("intents", frozenset())
+    logger.debug("FrontEndAgent combining the replies for %s", sorted(intents))
 
     # Build response based on detected intents
     response_parts = []
-    if intents["greeting"]:
+    if "greeting" in intents:
         response_parts.append(state["greeting_response"])
-    if intents["joke"]:
+    if "joke" in intents:
         response_parts.append(state["joke_response"])
-    if intents["weather"]:
+    if "weather" in intents:
         response_parts.append(state["weather_response"])
 
     # Combine responses or set a default response
     if response_parts:
-        state["final_response"] = " ".join(response_parts)
-        print("Debug: Final response updated with combined responses!")
+        final_response = " ".join(response_parts)
+        logger.debug("Final response updated with combined responses!")
     else:
-        state["final_response"] = "I can handle greetings, weather queries, and jokes!"
-        print("Debug: Final response set to default message.")
-    
-    return state
-
-
-# Create StateGraph with the defined state schema
-greeting_graph = StateGraph(state_schema=State)
-
-# Add nodes
-greeting_graph.add_node("GreetingAgent", greeting_agent_function)
-greeting_graph.add_node("WeatherAgent", weather_agent_function)
-greeting_graph.add_node("JokeAgent", joke_agent_function)
-greeting_graph.add_node("FrontEndAgent", front_end_agent_function)
-
-# Define the workflow
-greeting_graph.add_edge(START, "GreetingAgent")  # Process greeting first
-greeting_graph.add_edge("GreetingAgent", "JokeAgent")  # Route to JokeAgent
-greeting_graph.add_edge("JokeAgent", "WeatherAgent")  # Route to WeatherAgent
-greeting_graph.add_edge("WeatherAgent", "FrontEndAgent")  # Pass weather to front-end
+        final_response = "I can handle greetings, weather queries, and jokes!"
+        logger.debug("Final response set to default message.")
+
+    return {"final_response": final_response}
+
+
+# Create StateGraph with the defined state schema; callers pass a TurnInput and get a TurnOutput back
+greeting_graph = StateGraph(state_schema=State, input=TurnInput, output=TurnOutput)
+
+# Every node is timed under node.<name> (see metrics.py)
+def add_timed_node(name: str, node_function, input=None) -> None:
+    greeting_graph.add_node(name, metrics.instrument(f"node.{name}")(node_function), input=input)
+
+# Add nodes; the classifier only reads the message, the agents the message and its intents
+add_timed_node("IntentClassifier", intent_classifier_function, input=TurnInput)
+add_timed_node("GreetingAgent", with_branch_timeout(
+    greeting_agent_function, "greeting_response", "Hello! How can I assist you today?"
+), input=AgentInput)
+add_timed_node("WeatherAgent", with_branch_timeout(
+    weather_agent_function, "weather_response", "Could not fetch weather details at the moment. Please try again later."
+), input=AgentInput)
+add_timed_node("JokeAgent", with_branch_timeout(
+    joke_agent_function, "joke_response", "What do you call fake spaghetti? An impasta!"
+), input=AgentInput)
+add_timed_node("FrontEndAgent", front_end_agent_function)
+
+# Define the workflow: classify first, then fan out to the needed agents in parallel
+greeting_graph.add_edge(START, "IntentClassifier")
+greeting_graph.add_conditional_edges(
+    "IntentClassifier", route_by_intent,
+    ["GreetingAgent", "JokeAgent", "WeatherAgent", "FrontEndAgent"]
+)
+greeting_graph.add_edge("GreetingAgent", "FrontEndAgent")  # Join at the front-end
+greeting_graph.add_edge("JokeAgent", "FrontEndAgent")
+greeting_graph.add_edge("WeatherAgent", "FrontEndAgent")
 greeting_graph.add_edge("FrontEndAgent", END)  # End workflow at front-end
 
 # Compile the graph
 compiled_graph = greeting_graph.compile()
 
 # Function to run the graph
+@metrics.instrument("turn")
 def run_greeting_agent(input_message: str) -> str:
-    # Prepare initial state
-    initial_state = {
-        "message": input_message,
-        "greeting_response": "",
-        "weather_response": "",
-        "joke_response": "",
-        "final_response": ""
-    }
-    result = compiled_graph.invoke(initial_state)
+    # Only the input; every other key is written by the node that owns it
+    result = compiled_graph.invoke({"message": input_message})
     return result["final_response"]
 
 # Test the agents
@@ -0,0 +1,24 @@
+import string
+
+# Everything that ends a word becomes a space, so a phrase padded with spaces only matches whole words
+SEPARATORS = str.maketrans({char: " " for char in string.punctuation + string.whitespace + "‘’“”«»¿¡–—…"
+                            if char != "_"})
+
+
+def normalize(text: str) -> str:
+    return text.lower().translate(SEPARATORS)
+
+
+# Whole-word intent matcher: the message is lowercased and its punctuation turned into spaces in one
+# pass, then each trigger phrase is a plain substring test for " phrase ", so "hi" doesn't fire
+# inside "this". Both passes run in C, where a regex alternation of every phrase backtracks per character
+class IntentMatcher:
+    def __init__(self, phrases: dict):
+        self.phrases = phrases  # intent -> trigger phrases
+        self._padded = {intent: tuple(f" {' '.join(normalize(phrase).split())} " for phrase in intent_phrases)
+                        for intent, intent_phrases in phrases.items()}
+
+    # The intents whose phrases occur in the message
+    def match(self, message: str) -> frozenset:
+        text = f" {normalize(message)} "
+        return frozenset(intent for intent, padded in self._padded.items() if any(p in text for p in padded))
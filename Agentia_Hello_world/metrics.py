@@ -0,0 +1,148 @@
+import json
+import time
+import bisect
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+# Fixed-bucket latency histogram; percentiles are interpolated within a bucket, like Prometheus does
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "errors", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, n in enumerate(self.counts):
+            if n and cumulative + n >= rank:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / n, self.max)
+            cumulative += n
+        return self.max
+
+
+# Latency histograms and error counters per operation name ("node.GreetingAgent", "gemini.query", ...)
+class Metrics:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram()
+            histogram.observe(seconds, error)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, error)
+
+    # Decorator timing every call of a sync or async function under name
+    def instrument(self, name: str):
+        def decorate(function):
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def timed(*args, **kwargs):
+                    start = time.perf_counter()
+                    error = False
+                    try:
+                        return await function(*args, **kwargs)
+                    except BaseException:
+                        error = True
+                        raise
+                    finally:
+                        self.observe(name, time.perf_counter() - start, error)
+            else:
+                @functools.wraps(function)
+                def timed(*args, **kwargs):
+                    start = time.perf_counter()
+                    error = False
+                    try:
+                        return function(*args, **kwargs)
+                    except BaseException:
+                        error = True
+                        raise
+                    finally:
+                        self.observe(name, time.perf_counter() - start, error)
+            return timed
+
+        return decorate
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "count": histogram.count,
+                    "errors": histogram.errors,
+                    "sum": histogram.total,
+                    "max": histogram.max,
+                    "p50": histogram.percentile(0.50),
+                    "p95": histogram.percentile(0.95),
+                    "p99": histogram.percentile(0.99),
+                }
+                for name, histogram in sorted(self._histograms.items())
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    # Prometheus text exposition format
+    def to_prometheus(self, prefix: str = "agent") -> str:
+        lines = [
+            f"# HELP {prefix}_latency_seconds Latency of graph nodes and upstream calls.",
+            f"# TYPE {prefix}_latency_seconds histogram",
+        ]
+        errors = [
+            f"# HELP {prefix}_errors_total Calls that raised.",
+            f"# TYPE {prefix}_errors_total counter",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + ["+Inf"], histogram.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_latency_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_latency_seconds_sum{{name="{name}"}} {histogram.total}')
+                lines.append(f'{prefix}_latency_seconds_count{{name="{name}"}} {histogram.count}')
+                errors.append(f'{prefix}_errors_total{{name="{name}"}} {histogram.errors}')
+        return "\n".join(lines + errors) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+
+
+# Process-wide registry
+metrics = Metrics()
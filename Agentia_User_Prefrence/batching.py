@@ -0,0 +1,147 @@
+import re
+import json
+import asyncio
+
+# Gemini likes to wrap JSON in a ```json fence even when asked not to
+CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+# One structured prompt asking for a JSON object with a field per sub-request
+def build_batch_prompt(requests: dict) -> str:
+    fields = ", ".join(f'"{field}"' for field in requests)
+    tasks = "\n".join(f"- {field}: {prompt}" for field, prompt in requests.items())
+    return (
+        "Complete each of the following tasks independently.\n"
+        f"{tasks}\n"
+        f"Reply with only a JSON object with exactly the keys {fields}, "
+        "each holding the reply text for that task and nothing else."
+    )
+
+
+# The per-field replies, or None when the reply is not a JSON object with a non-empty string per field
+def parse_batch_reply(text: str, fields) -> dict:
+    if not text:
+        return None
+    text = CODE_FENCE.sub("", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        replies = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(replies, dict):
+        return None
+    replies = {field: replies.get(field) for field in fields}
+    if not all(isinstance(reply, str) and reply.strip() for reply in replies.values()):
+        return None
+    return {field: reply.strip() for field, reply in replies.items()}
+
+
+# Collects the Gemini prompts of one turn and answers them with a single structured call.
+# Parts that the turn planned but that never submit a prompt (cache hit, failed lookup,
+# timeout) must be withdrawn so the others aren't held up; max_wait bounds the wait regardless.
+class PromptBatch:
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self._waiting_for = set()
+        self._pending = {}  # part -> (prompt, prompt_class, future)
+        self._timer = None
+
+    # Declare which parts of the turn may submit a prompt
+    def plan(self, parts) -> None:
+        self._waiting_for = set(parts)
+
+    async def submit(self, part: str, prompt: str, prompt_class: str) -> str:
+        reply = await self.batcher.cache.cached(prompt, prompt_class)
+        if reply is not None:
+            self.withdraw(part)
+            return reply
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[part] = (prompt, prompt_class, future)
+        self._waiting_for.discard(part)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.batcher.max_wait, self._dispatch)
+        self._maybe_dispatch()
+        return await future
+
+    def withdraw(self, part: str) -> None:
+        self._waiting_for.discard(part)
+        self._maybe_dispatch()
+
+    def _maybe_dispatch(self) -> None:
+        if self._pending and not self._waiting_for:
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        # Anyone still expected after this point is answered on their own
+        self._waiting_for.clear()
+        if pending:
+            asyncio.ensure_future(self.batcher.generate_batch(pending))
+
+
+# Long-lived side of prompt batching: the LLM cache, the raw Gemini call and the counters
+class PromptBatcher:
+    def __init__(self, cache, generate, max_wait: float = 1.0):
+        self.cache = cache  # LLMResponseCache: checked before batching, filled from the parsed replies
+        self.generate = generate  # async (prompt) -> text or None, uncached
+        self.max_wait = max_wait
+
+        self.batched_calls = 0
+        self.batched_prompts = 0
+        self.parse_failures = 0
+        self.failed_calls = 0
+        self.single_calls = 0
+
+    def start_turn(self) -> PromptBatch:
+        return PromptBatch(self)
+
+    async def generate_batch(self, pending: dict) -> None:
+        try:
+            if len(pending) == 1:
+                # Nothing to share the round trip with
+                self.single_calls += 1
+                (prompt, prompt_class, future), = pending.values()
+                reply = await self.cache.query(prompt, prompt_class)
+                if not future.done():
+                    future.set_result(reply)
+                return
+
+            self.batched_calls += 1
+            self.batched_prompts += len(pending)
+            text = await self.generate(build_batch_prompt({part: prompt for part, (prompt, _, _) in pending.items()}))
+            replies = parse_batch_reply(text, pending)
+            if text is None:
+                # Gemini itself failed, so asking again per prompt would only multiply the load on it
+                self.failed_calls += 1
+                replies = dict.fromkeys(pending)
+            elif replies is None:
+                # A reply came back in the wrong shape: fall back to one call per prompt
+                self.parse_failures += 1
+                replies = dict(zip(pending, await asyncio.gather(*(
+                    self.cache.query(prompt, prompt_class) for prompt, prompt_class, _ in pending.values()
+                ))))
+            else:
+                await asyncio.gather(*(self.cache.remember(prompt, prompt_class, replies[part])
+                                       for part, (prompt, prompt_class, _) in pending.items()))
+            for part, (_, _, future) in pending.items():
+                if not future.done():
+                    future.set_result(replies[part])
+        except Exception as e:
+            for _, _, future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "batched_calls": self.batched_calls,
+            "batched_prompts": self.batched_prompts,
+            "parse_failures": self.parse_failures,
+            "failed_calls": self.failed_calls,
+            "single_calls": self.single_calls,
+        }
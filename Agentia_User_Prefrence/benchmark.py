@@ -0,0 +1,635 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+import subprocess
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+import httpx
+
+# Simulated latency of each backend, in seconds
+GEMINI_LATENCY = 0.4
+HTTP_LATENCY = 0.1
+# Number of chunks a streamed fake Gemini reply arrives in
+STREAM_CHUNKS = 8
+
+# Requests seen by the fake HTTP backends, keyed by host
+upstream_requests = Counter()
+
+# Faults injected into the fake HTTP backends: host -> (extra latency in seconds, share of 503 answers)
+injected_faults = {}
+
+
+# Fake Gemini model that sleeps like a real generate_content call
+class FakeGenerativeModel:
+    def __init__(self, latency: float = GEMINI_LATENCY):
+        self.latency = latency
+        self.calls = 0
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        self.calls += 1
+        text = f"Fake reply #{self.calls} to: {prompt[:40]}"
+        fields = re.search(r"JSON object with exactly the keys (.+?), each", prompt)
+        if fields:
+            # Batched prompt: answer every requested field
+            keys = re.findall(r'"(\w+)"', fields.group(1))
+            text = json.dumps({key: f"Fake reply #{self.calls} for {key}" for key in keys})
+        if stream:
+            return self._stream_chunks(text)
+        await asyncio.sleep(self.latency)
+        part = SimpleNamespace(text=text)
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    # Spread the reply over STREAM_CHUNKS chunks that arrive evenly across the latency
+    async def _stream_chunks(self, text: str):
+        size = -(-len(text) // STREAM_CHUNKS)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(self.latency / STREAM_CHUNKS)
+            yield SimpleNamespace(text=text[start:start + size])
+
+
+# Fake HTTP handler answering ipinfo, Nominatim and Open-Meteo after a delay
+async def fake_http_handler(request: httpx.Request) -> httpx.Response:
+    upstream_requests[request.url.host] += 1
+    extra_latency, error_rate = injected_faults.get(request.url.host, (0.0, 0.0))
+    await asyncio.sleep(HTTP_LATENCY + extra_latency)
+    if random.random() < error_rate:
+        return httpx.Response(503, json={"error": "injected fault"})
+    if request.url.host == "ipinfo.io":
+        payload = {"city": "Karachi"}
+    elif "nominatim" in request.url.host:
+        city = request.url.params.get("city", "").lower()
+        if city == "karachi":
+            payload = [{"lat": "24.86", "lon": "67.01"}]
+        else:
+            # Any other city gets stable coordinates of its own
+            seed = sum(map(ord, city))
+            payload = [{"lat": str(seed % 60), "lon": str(seed % 170)}]
+    else:
+        current = {"current_weather": {"temperature": 31.0, "weathercode": 1}}
+        locations = request.url.params.get("latitude", "").count(",") + 1
+        payload = current if locations == 1 else [current] * locations
+    return httpx.Response(200, json=payload)
+
+
+# Import the agent with slow fakes for every backend; the database pool opens lazily and is never touched
+def load_agent():
+    os.environ.setdefault("GEOCODE_CACHE_PATH", ":memory:")
+    import greeting_agent
+    greeting_agent.model = FakeGenerativeModel()
+    greeting_agent.http_transport = httpx.MockTransport(fake_http_handler)
+    return greeting_agent
+
+
+# Compare one fan-out turn against the sum of its branch latencies
+def benchmark_parallel_fan_out(agent, rounds: int = 5) -> None:
+    message = "Hello! Tell me a joke and the weather forecast"
+    # A plain weather question is worded locally unless WEATHER_RESPONDER=gemini
+    weather_gemini = GEMINI_LATENCY if agent.uses_gemini("weather", message) else 0.0
+    branches = {
+        "GreetingAgent": GEMINI_LATENCY,
+        "JokeAgent": GEMINI_LATENCY,
+        "WeatherAgent": 3 * HTTP_LATENCY + weather_gemini,
+    }
+    sequential = sum(branches.values())
+    slowest = max(branches.values())
+
+    # Bypass the LLM cache so every round waits on Gemini, not just the first
+    timings, disabled = [], agent.llm_cache.disabled_classes
+    agent.llm_cache.disabled_classes = {"greeting", "joke", "weather"}
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            agent.run_greeting_agent(message)
+            timings.append(time.perf_counter() - start)
+    finally:
+        agent.llm_cache.disabled_classes = disabled
+
+    print(f"Branch latencies: {branches}")
+    print(f"Sequential estimate: {sequential:.3f}s, slowest branch: {slowest:.3f}s")
+    print(f"Measured turn latency: best {min(timings):.3f}s, mean {sum(timings) / len(timings):.3f}s")
+
+
+# Run many conversations on one event loop to show they overlap instead of queueing
+def benchmark_concurrent_conversations(agent, conversations: int = 200) -> None:
+    async def run_all():
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            agent.run_greeting_agent_async("Tell me a joke", session_id=f"bench-{n}") for n in range(conversations)
+        ))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run_all())
+    print(f"{conversations} concurrent conversations on one worker: {elapsed:.3f}s "
+          f"({conversations / elapsed:.1f} turns/s, one turn alone takes ~{GEMINI_LATENCY:.3f}s)")
+
+
+# Fire concurrent weather lookups for one city and count what reaches the upstream APIs
+def benchmark_weather_cache(agent, lookups: int = 50) -> None:
+    async def run_all():
+        start = time.perf_counter()
+        await asyncio.gather(*(agent.get_weather_for_today("Karachi") for _ in range(lookups)))
+        return time.perf_counter() - start
+
+    # Start cold: earlier benchmarks have already looked Karachi up
+    from cache import SQLiteStore
+    agent.weather_cache.clear()
+    agent.coordinates_memory.clear()
+    agent.coordinates_store = SQLiteStore(":memory:", table="coordinates")
+
+    upstream_requests.clear()
+    cold = asyncio.run(run_all())
+    cold_requests = dict(upstream_requests)
+    upstream_requests.clear()
+    warm = asyncio.run(run_all())
+    print(f"{lookups} concurrent lookups, cold cache: {cold:.3f}s, upstream requests {cold_requests}")
+    print(f"{lookups} concurrent lookups, warm cache: {warm:.3f}s, upstream requests {dict(upstream_requests)}")
+    print(f"Cache stats: {agent.cache_stats()}")
+
+
+# Compare resolving a client's city from the local IP table against the remote ipinfo lookup
+def benchmark_location_resolution(agent, lookups: int = 1000) -> None:
+    from location import IPRangeTable, LocationResolver
+
+    csv_path = os.path.join(tempfile.mkdtemp(), "ip_ranges.csv")
+    with open(csv_path, "w") as f:
+        f.write("start_ip,end_ip,city\n")
+        for block in range(256):
+            f.write(f"11.{block}.0.0,11.{block}.255.255,City{block}\n")
+    table_resolver = LocationResolver(agent.fetch_ip_location, ip_table=IPRangeTable.from_csv(csv_path))
+    remote_resolver = LocationResolver(agent.fetch_ip_location)
+
+    async def resolve_all(resolver, client_ips):
+        start = time.perf_counter()
+        for client_ip in client_ips:
+            await resolver.resolve(client_ip)
+        return time.perf_counter() - start
+
+    client_ips = [f"11.{n % 256}.{n % 7}.{n % 250}" for n in range(lookups)]
+    table = asyncio.run(resolve_all(table_resolver, client_ips))
+    remote = asyncio.run(resolve_all(remote_resolver, client_ips[:20]))
+    print(f"IP table: {table / lookups * 1e6:.1f}us per lookup; "
+          f"uncached ipinfo: {remote / 20 * 1e3:.1f}ms per lookup")
+
+
+# Ask for jokes repeatedly and report how many needed a live Gemini call
+def benchmark_llm_cache(agent, requests: int = 50) -> None:
+    async def run_all():
+        replies = []
+        start = time.perf_counter()
+        for n in range(requests):
+            replies.append(await agent.query_gemini(
+                "The user asked for a joke. Provide a lighthearted and funny joke.", "joke"
+            ))
+            await asyncio.sleep(0)  # Let the background variant fill make progress
+        return time.perf_counter() - start, replies
+
+    calls_before = agent.model.calls
+    elapsed, replies = asyncio.run(run_all())
+    print(f"{requests} joke prompts: {elapsed:.3f}s, {agent.model.calls - calls_before} Gemini calls, "
+          f"{len(set(replies))} distinct replies")
+    print(f"LLM cache stats: {agent.llm_cache.stats()}")
+
+
+# Compare time to the first streamed chunk against waiting for the whole reply
+def benchmark_streaming_ttfb(agent, turns: int = 5) -> None:
+    async def time_turn(n):
+        # Unique small talk misses the LLM cache and goes to the front-end's fallback call
+        start = time.perf_counter()
+        await agent.run_greeting_agent_async(f"What do you think about topic {n}?", session_id=f"stream-{n}")
+        full = time.perf_counter() - start
+
+        start = time.perf_counter()
+        first = None
+        async for _ in agent.stream_greeting_agent(f"What do you make of subject {n}?", session_id=f"stream-{n}"):
+            if first is None:
+                first = time.perf_counter() - start
+        return full, first, time.perf_counter() - start
+
+    async def run_all():
+        return [await time_turn(n) for n in range(turns)]
+
+    results = asyncio.run(run_all())
+    mean = lambda values: sum(values) / len(values)
+    print(f"Full reply: mean {mean([r[0] for r in results]):.3f}s; streamed: first chunk after "
+          f"{mean([r[1] for r in results]):.3f}s, last after {mean([r[2] for r in results]):.3f}s")
+
+
+# Count Gemini round trips for a three-agent turn with and without prompt batching
+def benchmark_prompt_batching(agent, turns: int = 5) -> None:
+    async def run_turns(label):
+        calls_before = agent.model.calls
+        start = time.perf_counter()
+        for n in range(turns):
+            await agent.run_greeting_agent_async(f"Hello, I'm guest {label}{n}! Tell me a joke and the weather")
+        return (time.perf_counter() - start) / turns, (agent.model.calls - calls_before) / turns
+
+    # Bypass the LLM cache so every turn needs all three replies
+    batching, disabled = agent.GEMINI_BATCHING, agent.llm_cache.disabled_classes
+    agent.llm_cache.disabled_classes = {"greeting", "joke", "weather"}
+    try:
+        agent.GEMINI_BATCHING = False
+        unbatched = asyncio.run(run_turns("a"))
+        agent.GEMINI_BATCHING = True
+        batched = asyncio.run(run_turns("b"))
+    finally:
+        agent.GEMINI_BATCHING, agent.llm_cache.disabled_classes = batching, disabled
+    print(f"One call per agent: {unbatched[1]:.1f} Gemini calls/turn, {unbatched[0]:.3f}s/turn")
+    print(f"Batched: {batched[1]:.1f} Gemini calls/turn, {batched[0]:.3f}s/turn")
+    print(f"Batcher stats: {agent.prompt_batcher.stats()}")
+
+
+# Let a few cities become hot, prefetch them in one request, then time lookups against a city nobody asked about
+def benchmark_weather_prefetch(agent, hot: int = 5, requests_per_city: int = 10) -> None:
+    cities = [f"Hot City {n}" for n in range(hot)]
+    for city in cities:
+        for _ in range(requests_per_city):
+            agent.weather_prefetcher.record(city)
+    agent.weather_cache.clear()
+
+    async def timed_lookup(city):
+        start = time.perf_counter()
+        await agent.get_weather_for_today(city)
+        return time.perf_counter() - start
+
+    upstream_requests.clear()
+    refreshed = asyncio.run(agent.weather_prefetcher.refresh())
+    print(f"Prefetched {refreshed} hot cities with {upstream_requests['api.open-meteo.com']} Open-Meteo request(s)")
+
+    upstream_requests.clear()
+    hot_latency = max(asyncio.run(timed_lookup(city)) for city in cities)
+    print(f"Hot city lookup: {hot_latency * 1e3:.2f}ms, upstream requests {dict(upstream_requests)}")
+    upstream_requests.clear()
+    cold_latency = asyncio.run(timed_lookup("Cold City"))
+    print(f"Cold city lookup: {cold_latency * 1e3:.2f}ms, upstream requests {dict(upstream_requests)}")
+
+
+# Inject errors and latency into Open-Meteo and show retries, the circuit breaker and the turn deadline at work
+def benchmark_upstream_faults(agent, lookups: int = 20) -> None:
+    from upstream import Deadline, current_deadline
+
+    host = "api.open-meteo.com"
+    upstream = agent.open_meteo_upstream
+
+    async def fetch_all():
+        # Distinct coordinates so every lookup reaches the upstream
+        return [await agent.fetch_current_weather(10 + n, 20 + n) for n in range(lookups)]
+
+    async def timed(coroutine):
+        start = time.perf_counter()
+        result = await coroutine
+        return result, time.perf_counter() - start
+
+    try:
+        injected_faults[host] = (0.0, 0.3)
+        retries_before = upstream.retries
+        results = asyncio.run(fetch_all())
+        print(f"30% errors: {sum(r is not None for r in results)}/{lookups} lookups answered, "
+              f"{upstream.retries - retries_before} retries")
+
+        upstream.breaker.record_success()
+        injected_faults[host] = (0.0, 1.0)
+        asyncio.run(agent.get_current_weather(24.86, 67.01))  # Usually cached already; remembered either way
+        agent.weather_cache.clear()
+        _, failing = asyncio.run(timed(agent.fetch_current_weather(1, 1)))
+        for n in range(upstream.breaker.failure_threshold):
+            asyncio.run(agent.fetch_current_weather(2, n))
+        stale, open_circuit = asyncio.run(timed(agent.get_current_weather(24.86, 67.01)))
+        print(f"Open-Meteo down: {failing * 1e3:.0f}ms per failing call with retries, "
+              f"{open_circuit * 1e3:.1f}ms once the breaker is {upstream.breaker.state}, "
+              f"answered with last known weather: {stale}")
+
+        upstream.breaker.record_success()
+        injected_faults[host] = (30.0, 0.0)
+
+        async def hanging_turn():
+            current_deadline.set(Deadline(1.0))
+            return await timed(agent.fetch_current_weather(3, 3))
+
+        result, hanging = asyncio.run(hanging_turn())
+        print(f"Open-Meteo hanging, 1s turn deadline: gave up after {hanging:.2f}s (result {result})")
+    finally:
+        injected_faults.pop(host, None)
+        upstream.breaker.record_success()
+    print(f"Upstream stats: {agent.upstream_stats()}")
+
+
+# Serve chat over HTTP on a local port and fire concurrent requests at it, one turn per graph call
+# against micro-batches through abatch, then overflow a short queue to see requests shed
+def benchmark_http_server(agent, requests: int = 400, clients: int = 100) -> None:
+    from server import create_server
+
+    messages = ["Hello!", "Tell me a joke", "What's the weather like today?", "Can you recommend a good book?"]
+
+    async def run(requests, clients, **limits):
+        server = create_server(agent, **limits)
+        host, port = await server.start("127.0.0.1", 0)
+        latencies, statuses = [], Counter()
+        pending = iter(range(requests))
+
+        # One keep-alive connection per client; httpx's own pool would cost more CPU than the server
+        async def client():
+            reader, writer = await asyncio.open_connection(host, port)
+            for n in pending:
+                body = json.dumps({"message": messages[n % len(messages)], "session_id": f"http-{n}"}).encode()
+                start = time.perf_counter()
+                writer.write(b"POST /chat HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while (line := await reader.readline()) != b"\r\n":
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] += 1
+            writer.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        stats = server.batcher.stats()
+        await server.close()
+        latencies.sort()
+        return elapsed, latencies, statuses, stats
+
+    for label, limits in (("one turn per call", {"max_batch_size": 1, "max_wait": 0, "max_concurrency": clients}),
+                          ("micro-batched", {"max_batch_size": 32, "max_wait": 0.005, "max_concurrency": 4})):
+        elapsed, latencies, statuses, stats = asyncio.run(run(requests, clients, **limits))
+        print(f"HTTP {label:17}: {requests / elapsed:7.1f} req/s, p50 {latencies[len(latencies) // 2] * 1e3:6.1f}ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:6.1f}ms, {stats['batches']} graph calls "
+              f"(mean batch {stats['mean_batch_size']:.1f}), statuses {dict(statuses)}")
+
+    _, _, statuses, stats = asyncio.run(run(requests, clients, max_batch_size=8, max_concurrency=1, max_queue=20))
+    print(f"HTTP overload, queue of 20: statuses {dict(statuses)}, shed {stats['shed']}")
+
+
+# Turns with a SQLite checkpointer: write latency per checkpoint, reuse of a fresh weather reply,
+# and resuming a turn that crashed in the front-end without re-running its agents
+def benchmark_checkpointing(agent, turns: int = 50) -> None:
+    from checkpoint import SQLiteCheckpointSaver
+    from metrics import metrics
+
+    message = "Hello! What's the weather like?"
+
+    def run_turns(session_prefix):
+        start = time.perf_counter()
+        for n in range(turns):
+            agent.run_greeting_agent(message, session_id=f"{session_prefix}-{n}")
+        return (time.perf_counter() - start) / turns
+
+    previous_graph = agent.compiled_graph
+    try:
+        agent.compiled_graph = agent.create_app()
+        agent.run_greeting_agent(message, session_id="warm-up")  # Fill the caches so both runs see the same hits
+        without = run_turns("no-checkpoint")
+        saver = SQLiteCheckpointSaver(os.path.join(tempfile.mkdtemp(), "checkpoints.sqlite3"))
+        agent.compiled_graph = agent.create_app(saver)
+        with_checkpoints = run_turns("checkpoint")
+        print(f"Turn latency: {without * 1e3:.1f}ms without checkpoints, {with_checkpoints * 1e3:.1f}ms with SQLite")
+        snapshot = metrics.snapshot()
+        for name in ("checkpoint.get", "checkpoint.put", "checkpoint.put_writes"):
+            print(f"  {name:22} p50 {snapshot[name]['p50'] * 1e3:5.2f}ms, p99 {snapshot[name]['p99'] * 1e3:5.2f}ms "
+                  f"({snapshot[name]['count']} calls)")
+
+        calls = agent.model.calls
+        agent.run_greeting_agent(message, session_id="checkpoint-0")
+        print(f"Same weather question again within the TTL: {agent.model.calls - calls} Gemini calls")
+
+        front_end = agent.front_end_agent_function
+
+        async def crash(state, config):
+            raise RuntimeError("worker died")
+
+        agent.front_end_agent_function = crash
+        try:
+            agent.run_greeting_agent("Tell me a joke", session_id="checkpoint-crash")
+        except RuntimeError:
+            pass
+        finally:
+            agent.front_end_agent_function = front_end
+        calls = agent.model.calls
+        reply = asyncio.run_coroutine_threadsafe(
+            agent.resume_interrupted_turn("checkpoint-crash"), agent.get_background_loop()
+        ).result()
+        print(f"Crashed turn resumed with {agent.model.calls - calls} Gemini calls: {reply!r}")
+    finally:
+        agent.compiled_graph = previous_graph
+
+
+# Login throughput at the production scrypt cost for a few pool sizes, and how late a 1ms timer on the
+# event loop fires while the logins run
+def benchmark_credentials(logins: int = 64) -> None:
+    from credentials import VerifierPool, hash_password
+
+    start = time.perf_counter()
+    stored = hash_password("correct horse battery staple")
+    print(f"One scrypt hash: {(time.perf_counter() - start) * 1e3:.1f}ms")
+
+    async def run(pool):
+        lag = 0.0
+        done = asyncio.Event()
+
+        async def ticker():
+            nonlocal lag
+            while not done.is_set():
+                scheduled = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lag = max(lag, time.perf_counter() - scheduled - 0.001)
+
+        ticking = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        results = await asyncio.gather(*(pool.averify("correct horse battery staple", stored) for _ in range(logins)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await ticking
+        return elapsed, lag, all(results)
+
+    for workers in (1, 2, 4):
+        pool = VerifierPool(workers=workers, max_pending=logins)
+        elapsed, lag, ok = asyncio.run(run(pool))
+        pool.close()
+        print(f"{workers} verifier thread(s): {logins / elapsed:6.1f} logins/s, "
+              f"worst event-loop lag {lag * 1e3:.1f}ms, all verified: {ok}")
+
+
+# What the graph itself costs per turn: every backend answers instantly, so the time left is node dispatch,
+# state merging and config plumbing. Allocations are traced with tracemalloc in a second, separate pass
+def benchmark_graph_overhead(agent, turns: int = 300) -> None:
+    from metrics import metrics
+
+    messages = ["Hello, tell me a joke", "What can you do?"]
+    model, agent.model = agent.model, FakeGenerativeModel(latency=0)
+
+    def node_runs() -> int:
+        return sum(summary["count"] for name, summary in metrics.snapshot().items() if name.startswith("node."))
+
+    async def run_turns(traced: bool):
+        peaks = []
+        for n in range(turns):
+            if traced:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            await agent.run_greeting_agent_async(messages[n % len(messages)], session_id=f"overhead-{n % 10}")
+            if traced:
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        return peaks
+
+    try:
+        asyncio.run(run_turns(False))  # Warm the graph, caches and sessions
+        runs = node_runs()
+        start = time.perf_counter()
+        asyncio.run(run_turns(False))
+        elapsed = time.perf_counter() - start
+        steps = node_runs() - runs
+
+        tracemalloc.start()
+        try:
+            retained = tracemalloc.get_traced_memory()[0]
+            peaks = asyncio.run(run_turns(True))
+            retained = tracemalloc.get_traced_memory()[0] - retained
+        finally:
+            tracemalloc.stop()
+    finally:
+        agent.model = model
+
+    print(f"Graph overhead: {elapsed / turns * 1e3:.3f}ms per turn, {elapsed / steps * 1e6:.0f}us per node step "
+          f"({steps / turns:.1f} steps per turn)")
+    print(f"Allocations: peak {sum(peaks) / len(peaks) / 1024:.1f} KiB per turn, "
+          f"{retained / turns:.0f} bytes retained per turn")
+
+
+# A plain weather question worded by Gemini against the local templates, and the cost of one render
+def benchmark_weather_templates(agent, turns: int = 10, renders: int = 10000) -> None:
+    from templates import WeatherTemplates, TONES
+
+    async def run_turns(responder):
+        agent.AGENT_RESPONDERS["weather"] = responder
+        calls_before = agent.model.calls
+        start = time.perf_counter()
+        for n in range(turns):
+            reply = await agent.run_greeting_agent_async("What's the weather like today?", session_id=f"tpl-{n}")
+        return (time.perf_counter() - start) / turns, (agent.model.calls - calls_before) / turns, reply
+
+    # Bypass the LLM cache so every Gemini-worded turn pays for its call; the weather itself is cached
+    responder, disabled = agent.AGENT_RESPONDERS["weather"], agent.llm_cache.disabled_classes
+    agent.llm_cache.disabled_classes = {"weather"}
+    try:
+        asyncio.run(agent.get_weather_for_today("Karachi"))
+        for mode in ("gemini", "template"):
+            latency, calls, reply = asyncio.run(run_turns(mode))
+            print(f"Weather worded by {mode:8}: {latency * 1e3:7.1f}ms/turn, {calls:.1f} Gemini calls/turn: {reply!r}")
+    finally:
+        agent.AGENT_RESPONDERS["weather"], agent.llm_cache.disabled_classes = responder, disabled
+
+    templates = WeatherTemplates()
+    start = time.perf_counter()
+    for n in range(renders):
+        templates.render("Karachi", 20 + n % 15, (0, 3, 61, 95)[n % 4], seed=str(n))
+    print(f"One template render: {(time.perf_counter() - start) / renders * 1e6:.1f}us")
+    for locale in ("en", "es"):
+        for tone in TONES:
+            print(f"  {locale} {tone:8}: {templates.render('Karachi', 31.0, 61, tone=tone, locale=locale)}")
+
+
+# Intent detection on a typical message and a long one: the whole-word matcher against a substring scan per
+# intent and against one regex alternation of every phrase
+def benchmark_intents(agent, words: int = 2000, rounds: int = 200) -> None:
+    from intents import IntentMatcher
+
+    phrases = agent.INTENT_PHRASES
+    matcher = IntentMatcher(phrases)
+    intent_of = {phrase.lower(): intent for intent, intent_phrases in phrases.items() for phrase in intent_phrases}
+    alternation = re.compile(r"\b(?:" + "|".join(map(re.escape, sorted(intent_of, key=len, reverse=True))) + r")\b")
+    filler = "this is just some long rambling text about nothing in particular".split()
+    messages = {
+        "short message": "Hey! Tell me a joke and the weather forecast",
+        f"{words}-word message": " ".join(filler[n % len(filler)] for n in range(words)) + " Tell me a Joke",
+    }
+
+    def substring_scan(text):
+        text = text.lower()
+        return frozenset(intent for intent, keywords in phrases.items() if any(k in text for k in keywords))
+
+    def regex_alternation(text):
+        return frozenset(intent_of[phrase] for phrase in alternation.findall(text.lower()))
+
+    for label, message in messages.items():
+        for name, detect in (("substring scan", substring_scan), ("regex alternation", regex_alternation),
+                             ("whole-word matcher", matcher.match)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                found = detect(message)
+            elapsed = time.perf_counter() - start
+            print(f"{label:18} {name:18}: {elapsed / rounds * 1e6:8.1f}us, intents {sorted(found)}")
+
+
+# Startup cost: profile `import greeting_agent` in a fresh interpreter with -X importtime,
+# then time the graph build that the first turn pays for
+def benchmark_import_time(agent, top: int = 10) -> None:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import greeting_agent"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+        env={**os.environ, "GEOCODE_CACHE_PATH": ":memory:"}
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(f"Import failed: {result.stderr.strip().splitlines()[-1]}")
+        return
+
+    # Lines look like "import time:   self [us] | cumulative | <indent>module"; the indent is the nesting depth
+    entries = []
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            name = fields[2].rstrip()
+            entries.append((len(name) - len(name.lstrip()), name.strip(), int(fields[1])))
+    depth, _, total = next(entry for entry in entries if entry[1] == "greeting_agent")
+    direct = sorted((entry for entry in entries if entry[0] == depth + 2), key=lambda entry: -entry[2])
+
+    print(f"import greeting_agent: {total / 1e3:.1f}ms cumulative, {elapsed:.3f}s for the whole interpreter")
+    for _, name, cumulative in direct[:top]:
+        print(f"  {name:32} {cumulative / 1e3:8.1f}ms")
+    deferred = [name for name in ("langgraph", "google.generativeai") if name in {entry[1] for entry in entries}]
+    print(f"Deferred packages loaded on import: {deferred or 'none'}")
+
+    start = time.perf_counter()
+    agent.create_app()
+    print(f"Graph build on the first turn: {time.perf_counter() - start:.3f}s")
+
+
+# Latency percentiles collected by the instrumentation while the benchmarks ran
+def report_metrics() -> None:
+    from metrics import metrics
+
+    print(f"{'name':36} {'count':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name, summary in metrics.snapshot().items():
+        print(f"{name:36} {summary['count']:6} {summary['errors']:6} "
+              + " ".join(f"{summary[q] * 1e3:7.1f}ms" for q in ("p50", "p95", "p99")))
+
+
+if __name__ == "__main__":
+    agent = load_agent()
+    benchmark_import_time(agent)
+    benchmark_parallel_fan_out(agent)
+    benchmark_concurrent_conversations(agent)
+    benchmark_weather_cache(agent)
+    benchmark_weather_prefetch(agent)
+    benchmark_location_resolution(agent)
+    benchmark_llm_cache(agent)
+    benchmark_streaming_ttfb(agent)
+    benchmark_prompt_batching(agent)
+    benchmark_upstream_faults(agent)
+    benchmark_http_server(agent)
+    benchmark_checkpointing(agent)
+    benchmark_credentials()
+    benchmark_graph_overhead(agent)
+    benchmark_weather_templates(agent)
+    benchmark_intents(agent)
+    report_metrics()
@@ -0,0 +1,134 @@
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+
+# Sentinel so cached falsy values ({} / "" / 0) still count as hits
+MISSING = object()
+
+
+# In-memory LRU cache with per-entry TTL and a size bound
+class TTLCache:
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl  # None means entries never expire
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, MISSING)
+            if entry is MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Persistent key -> JSON value store backed by SQLite, for data that never goes stale
+class SQLiteStore:
+    def __init__(self, path: str, table: str = "entries"):
+        self.path = path
+        self.table = table
+        self._conn = None  # Opened on first use so importing never touches the disk
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            row = self._connection().execute(
+                f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", (key, json.dumps(value))
+            )
+            conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# Coalesces concurrent calls for the same key onto a single in-flight upstream call
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}  # (event loop, key) -> task
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, coroutine_function):
+        flight_key = (id(asyncio.get_running_loop()), key)
+        task = self._inflight.get(flight_key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(coroutine_function())
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(flight_key, None))
+        else:
+            self.shared += 1
+        # Shield so one caller timing out doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"upstream_calls": self.calls, "deduplicated": self.shared, "in_flight": len(self._inflight)}
@@ -0,0 +1,264 @@
+import abc
+import time
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP, get_checkpoint_id
+from metrics import metrics
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS graph_checkpoints (
+        thread_id TEXT NOT NULL,
+        checkpoint_ns TEXT NOT NULL DEFAULT '',
+        checkpoint_id TEXT NOT NULL,
+        parent_checkpoint_id TEXT,
+        type TEXT NOT NULL,
+        checkpoint {blob} NOT NULL,
+        metadata_type TEXT NOT NULL,
+        metadata {blob} NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS graph_checkpoint_writes (
+        thread_id TEXT NOT NULL,
+        checkpoint_ns TEXT NOT NULL DEFAULT '',
+        checkpoint_id TEXT NOT NULL,
+        task_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        channel TEXT NOT NULL,
+        type TEXT NOT NULL,
+        value {blob} NOT NULL,
+        task_path TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS graph_checkpoints_created ON graph_checkpoints (created_at)",
+]
+
+CHECKPOINT_COLUMNS = "checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+
+
+# LangGraph checkpointer over a SQL table pair: one row per checkpoint, serialized whole with the graph's
+# msgpack serde, plus one row per pending write so a crashed step only re-runs the tasks that didn't finish.
+# Subclasses supply the connection through _cursor(); the async methods run the blocking calls in a worker thread.
+# Checkpoints older than max_age seconds are pruned every prune_every puts.
+class SQLCheckpointSaver(BaseCheckpointSaver, abc.ABC):
+    placeholder = "%s"
+    blob_type = "BYTEA"
+
+    def __init__(self, max_age: float = 86400.0, prune_every: int = 1000):
+        super().__init__()
+        self.max_age = max_age
+        self.prune_every = prune_every
+        self.puts = 0
+        self.writes = 0
+        self.pruned = 0
+
+    # Context manager yielding a cursor, committed when the block exits cleanly
+    @abc.abstractmethod
+    def _cursor(self):
+        pass
+
+    def _sql(self, statement: str) -> str:
+        return statement.replace("%s", self.placeholder)
+
+    def setup(self) -> None:
+        with self._cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement.format(blob=self.blob_type))
+
+    def _tuple(self, cursor, thread_id: str, checkpoint_ns: str, row) -> CheckpointTuple:
+        checkpoint_id, parent_id, type_, checkpoint, metadata_type, metadata = row
+        cursor.execute(self._sql(
+            "SELECT task_id, channel, type, value FROM graph_checkpoint_writes "
+            "WHERE thread_id = %s AND checkpoint_ns = %s AND checkpoint_id = %s ORDER BY task_id, idx"
+        ), (thread_id, checkpoint_ns, checkpoint_id))
+        writes = [(task_id, channel, self.serde.loads_typed((t, bytes(value))))
+                  for task_id, channel, t, value in cursor.fetchall()]
+
+        def config(checkpoint_id):
+            return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": checkpoint_id}}
+
+        return CheckpointTuple(
+            config=config(checkpoint_id),
+            checkpoint=self.serde.loads_typed((type_, bytes(checkpoint))),
+            metadata=self.serde.loads_typed((metadata_type, bytes(metadata))),
+            parent_config=config(parent_id) if parent_id else None,
+            pending_writes=writes,
+        )
+
+    @metrics.instrument("checkpoint.get")
+    def get_tuple(self, config) -> CheckpointTuple:
+        configurable = config["configurable"]
+        thread_id, checkpoint_ns = configurable["thread_id"], configurable.get("checkpoint_ns", "")
+        with self._cursor() as cursor:
+            if checkpoint_id := get_checkpoint_id(config):
+                cursor.execute(self._sql(
+                    f"SELECT {CHECKPOINT_COLUMNS} FROM graph_checkpoints "
+                    "WHERE thread_id = %s AND checkpoint_ns = %s AND checkpoint_id = %s"
+                ), (thread_id, checkpoint_ns, checkpoint_id))
+            else:
+                cursor.execute(self._sql(
+                    f"SELECT {CHECKPOINT_COLUMNS} FROM graph_checkpoints "
+                    "WHERE thread_id = %s AND checkpoint_ns = %s ORDER BY checkpoint_id DESC LIMIT 1"
+                ), (thread_id, checkpoint_ns))
+            row = cursor.fetchone()
+            return self._tuple(cursor, thread_id, checkpoint_ns, row) if row else None
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        conditions, params = [], []
+        if config:
+            conditions.append("thread_id = %s")
+            params.append(config["configurable"]["thread_id"])
+            if "checkpoint_ns" in config["configurable"]:
+                conditions.append("checkpoint_ns = %s")
+                params.append(config["configurable"]["checkpoint_ns"])
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = %s")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < %s")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                f"SELECT thread_id, checkpoint_ns, {CHECKPOINT_COLUMNS} FROM graph_checkpoints {where} "
+                "ORDER BY checkpoint_id DESC"
+            ), params)
+            rows = cursor.fetchall()
+            results = []
+            for thread_id, checkpoint_ns, *row in rows:
+                checkpoint_tuple = self._tuple(cursor, thread_id, checkpoint_ns, row)
+                # Metadata filters are rare and the metadata is serialized, so they are applied here
+                if filter and any(checkpoint_tuple.metadata.get(k) != v for k, v in filter.items()):
+                    continue
+                results.append(checkpoint_tuple)
+                if limit is not None and len(results) >= limit:
+                    break
+        yield from results
+
+    @metrics.instrument("checkpoint.put")
+    def put(self, config, checkpoint, metadata, new_versions) -> dict:
+        configurable = config["configurable"]
+        thread_id, checkpoint_ns = configurable["thread_id"], configurable.get("checkpoint_ns", "")
+        type_, serialized = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(dict(metadata))
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "INSERT INTO graph_checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+                "type, checkpoint, metadata_type, metadata, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id) DO UPDATE SET "
+                "type = excluded.type, checkpoint = excluded.checkpoint, "
+                "metadata_type = excluded.metadata_type, metadata = excluded.metadata"
+            ), (thread_id, checkpoint_ns, checkpoint["id"], configurable.get("checkpoint_id"),
+                type_, serialized, metadata_type, serialized_metadata, time.time()))
+        self.puts += 1
+        if self.prune_every and self.puts % self.prune_every == 0:
+            self.prune()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                 "checkpoint_id": checkpoint["id"]}}
+
+    @metrics.instrument("checkpoint.put_writes")
+    def put_writes(self, config, writes, task_id: str, task_path: str = "") -> None:
+        configurable = config["configurable"]
+        key = (configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"])
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized = self.serde.dumps_typed(value)
+            rows.append((*key, task_id, WRITES_IDX_MAP.get(channel, idx), channel, type_, serialized, task_path))
+        with self._cursor() as cursor:
+            for row in rows:
+                # Special writes (errors, interrupts) replace earlier ones; regular writes are kept as first saved
+                conflict = ("DO UPDATE SET channel = excluded.channel, type = excluded.type, value = excluded.value"
+                            if row[4] < 0 else "DO NOTHING")
+                cursor.execute(self._sql(
+                    "INSERT INTO graph_checkpoint_writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, "
+                    "channel, type, value, task_path) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                    f"ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id, task_id, idx) {conflict}"
+                ), row)
+        self.writes += 1
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._cursor() as cursor:
+            cursor.execute(self._sql("DELETE FROM graph_checkpoint_writes WHERE thread_id = %s"), (thread_id,))
+            cursor.execute(self._sql("DELETE FROM graph_checkpoints WHERE thread_id = %s"), (thread_id,))
+
+    # Drop checkpoints older than max_age, and their writes; returns how many checkpoints went
+    def prune(self) -> int:
+        cutoff = time.time() - self.max_age
+        with self._cursor() as cursor:
+            cursor.execute(self._sql(
+                "DELETE FROM graph_checkpoint_writes WHERE (thread_id, checkpoint_ns, checkpoint_id) IN "
+                "(SELECT thread_id, checkpoint_ns, checkpoint_id FROM graph_checkpoints WHERE created_at < %s)"
+            ), (cutoff,))
+            cursor.execute(self._sql("DELETE FROM graph_checkpoints WHERE created_at < %s"), (cutoff,))
+            pruned = cursor.rowcount
+        self.pruned += pruned
+        return pruned
+
+    async def aget_tuple(self, config) -> CheckpointTuple:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for checkpoint_tuple in await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        ):
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions) -> dict:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id: str, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def stats(self) -> dict:
+        return {"puts": self.puts, "writes": self.writes, "pruned": self.pruned}
+
+
+# Local checkpoints in one SQLite file, one connection per thread
+class SQLiteCheckpointSaver(SQLCheckpointSaver):
+    placeholder = "?"
+    blob_type = "BLOB"
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        self.setup()
+
+    @contextmanager
+    def _cursor(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL keeps this crash-safe; only a power loss can drop the tail
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+# Production checkpoints in Postgres, through the shared connection pool; tables come from migrate()
+class PostgresCheckpointSaver(SQLCheckpointSaver):
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+
+    @contextmanager
+    def _cursor(self):
+        with self.pool.cursor() as cursor:
+            yield cursor
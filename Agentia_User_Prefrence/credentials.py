@@ -0,0 +1,134 @@
+import os
+import hmac
+import base64
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# scrypt cost: 2^14 x 8 x 1 takes about 16 MiB and tens of milliseconds per hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# Namespace for user IDs, so the same name always maps to the same ID on every worker and after restarts
+USER_ID_KEY = b"agentia-user-id"
+
+
+def stable_user_id(name: str) -> str:
+    return hashlib.blake2b(name.strip().lower().encode("utf-8"), digest_size=16, key=USER_ID_KEY).hexdigest()
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+# Module-level so a process pool can pickle it
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=KEY_BYTES)
+
+
+# "scrypt$<n>$<r>$<p>$<salt>$<key>", so the cost can be raised later without breaking stored hashes
+def hash_password(password: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> str:
+    salt = os.urandom(SALT_BYTES)
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}"
+
+
+# Constant-time check; anything not in the scrypt format is a legacy plain-text password
+def verify_password(password: str, stored: str) -> bool:
+    if not stored.startswith("scrypt$"):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        _, n, r, p, salt, key = stored.split("$")
+        derived = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(derived, base64.b64decode(key))
+
+
+# Whether a stored password should be re-hashed at the current cost (legacy plain text or older parameters)
+def needs_rehash(stored: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> bool:
+    return not stored.startswith(f"scrypt${n}${r}${p}$")
+
+
+# Raised when more hashes are already waiting than the pool accepts
+class VerifierBusy(Exception):
+    pass
+
+
+# Dedicated pool for the deliberately slow hashing, so it never runs on the event loop or starves the
+# threads that do database I/O. workers caps how many hashes run at once; max_pending caps how many may
+# be queued or running before callers are turned away. hashlib.scrypt releases the GIL, so threads scale
+# with cores; use_processes isolates the work entirely at the cost of a pickling round trip.
+class VerifierPool:
+    def __init__(self, workers: int = 2, max_pending: int = 64, wait_timeout: float = 5.0,
+                 use_processes: bool = False, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P):
+        self.workers = workers
+        self.wait_timeout = wait_timeout
+        self.use_processes = use_processes
+        self.n, self.r, self.p = n, r, p
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self.hashes = 0
+        self.verifications = 0
+        self.rejected = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+                    self._executor = executor_class(max_workers=self.workers)
+        return self._executor
+
+    def _submit(self, function, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            self.rejected += 1
+            raise VerifierBusy("Too many password checks in progress, try again shortly")
+        try:
+            future = self._get_executor().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password: str) -> str:
+        self.hashes += 1
+        return self._submit(hash_password, password, self.n, self.r, self.p).result()
+
+    def verify(self, password: str, stored: str) -> bool:
+        self.verifications += 1
+        return self._submit(verify_password, password, stored).result()
+
+    def needs_rehash(self, stored: str) -> bool:
+        return needs_rehash(stored, self.n, self.r, self.p)
+
+    # Async counterparts; waiting for a free slot happens off the event loop
+    async def ahash(self, password: str) -> str:
+        self.hashes += 1
+        future = await asyncio.to_thread(self._submit, hash_password, password, self.n, self.r, self.p)
+        return await asyncio.wrap_future(future)
+
+    async def averify(self, password: str, stored: str) -> bool:
+        self.verifications += 1
+        future = await asyncio.to_thread(self._submit, verify_password, password, stored)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "hashes": self.hashes,
+            "verifications": self.verifications,
+            "rejected": self.rejected,
+        }
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
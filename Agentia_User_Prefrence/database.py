@@ -0,0 +1,196 @@
+import time
+import select
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+# Upper bounds (seconds) of the pool wait-time histogram buckets
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+logger = logging.getLogger(__name__)
+
+
+# Thread-safe Postgres pool: borrow a connection per operation, health-check it, reconnect when it died
+class ConnectionPool:
+    def __init__(self, minconn: int = 1, maxconn: int = 10, wait_timeout: float = 5.0,
+                 healthcheck_after: float = 30.0, on_create=None, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.wait_timeout = wait_timeout
+        self.healthcheck_after = healthcheck_after  # Ping connections idle for longer than this
+        self.on_create = on_create  # Called once with a fresh connection before the pool opens
+        self.connect_kwargs = connect_kwargs
+        self._pool = None  # Opened on first use so importing never connects
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool raises instead of waiting when exhausted, so borrowers queue here
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}  # id(connection) -> monotonic time it was returned
+
+        self.borrows = 0
+        self.in_use = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    if self.on_create is not None:
+                        conn = psycopg2.connect(**self.connect_kwargs)
+                        try:
+                            self.on_create(conn)
+                        finally:
+                            conn.close()
+                    self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, **self.connect_kwargs)
+        return self._pool
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise PoolError(f"Timed out after {self.wait_timeout}s waiting for a database connection")
+        self._record_wait(time.monotonic() - start)
+
+        try:
+            conn = self._ensure_healthy(self._get_pool().getconn())
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.borrows += 1
+            self.in_use += 1
+        return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        discard = discard or conn.closed
+        if discard:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._get_pool().putconn(conn, close=discard)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    # Replace connections that are closed or fail a ping after sitting idle
+    def _ensure_healthy(self, conn):
+        idle = time.monotonic() - self._last_used.get(id(conn), time.monotonic())
+        healthy = not conn.closed
+        if healthy and idle > self.healthcheck_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                healthy = False
+        if healthy:
+            return conn
+
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        with self._lock:
+            self.reconnects += 1
+        return self._pool.getconn()
+
+    def _record_wait(self, waited: float) -> None:
+        bucket = next((i for i, bound in enumerate(WAIT_BUCKETS) if waited <= bound), len(WAIT_BUCKETS))
+        with self._lock:
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            self.wait_histogram[bucket] += 1
+
+    # Borrow a connection for one operation: commit on success, roll back on error
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The connection itself is broken; drop it so the next borrower gets a fresh one
+            discard = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": self.in_use,
+                "borrows": self.borrows,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_histogram": dict(zip([str(b) for b in WAIT_BUCKETS] + ["+Inf"], self.wait_histogram)),
+            }
+
+    def closeall(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+# Dedicated autocommit connection that LISTENs on a channel and hands each payload to a callback
+class NotificationListener:
+    def __init__(self, channel: str, callback, poll_interval: float = 5.0, **connect_kwargs):
+        self.channel = channel
+        self.callback = callback  # Called with the payload string of every notification
+        self.poll_interval = poll_interval
+        self.connect_kwargs = connect_kwargs
+        self._thread = None
+        self._stopping = False
+        self.received = 0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=f"listen-{self.channel}", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopping:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                while not self._stopping:
+                    if select.select([conn], [], [], self.poll_interval)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.received += 1
+                            self.callback(conn.notifies.pop(0).payload)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # Reconnect after a short pause; notifications sent meanwhile are lost,
+                # which only delays invalidation until the cache TTL expires
+                logger.warning("Listener on %s lost its connection - %s", self.channel, e)
+                time.sleep(self.poll_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stop(self) -> None:
+        self._stopping = True
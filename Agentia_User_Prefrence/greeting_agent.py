@@ -1,30 +1,59 @@
 import os
 import re
-import requests
+import sys
+import time
+import uuid
+import atexit
+import logging
 import random
+import asyncio
+import queue
+import threading
+import httpx
 import psycopg2
-from psycopg2.extras import DictCursor
-from langgraph.graph import StateGraph
-from langgraph.constants import START, END
-from typing import TypedDict
+from psycopg2.extras import DictCursor, execute_values
+from langchain_core.runnables import RunnableConfig
+from typing import TypedDict, FrozenSet, Literal, Annotated
 from dotenv import load_dotenv
-import google.generativeai as genai
+from cache import TTLCache, SQLiteStore, SingleFlight
+from location import IPRangeTable, LocationResolver, UNKNOWN_LOCATION
+from database import ConnectionPool, NotificationListener
+from write_behind import WriteBehindQueue
+from sessions import InMemorySessionStore, PostgresSessionStore
+from llm_cache import LLMResponseCache
+from streaming import ResponseStream
+from batching import PromptBatcher, PromptBatch
+from upstream import Upstream, Deadline, current_deadline, time_left
+from metrics import metrics
+from intents import IntentMatcher, normalize
+from prefetch import WeatherPrefetcher
+from credentials import VerifierPool, VerifierBusy, stable_user_id
+from templates import WeatherTemplates, FreeFormDetector
 
 # Load environment variables
 load_dotenv()
-api_key = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel("gemini-1.5-flash")
-
-# PostgreSQL Initialization
-def initialize_database():
-    conn = psycopg2.connect(
-        host=os.getenv("PG_HOST"),
-        database=os.getenv("PG_DATABASE"),
-        user=os.getenv("PG_USER"),
-        password=os.getenv("PG_PASSWORD"),
-        cursor_factory=DictCursor
-    )
+
+# LOG_LEVEL=DEBUG turns on the per-step debug logs; at the default level they cost a level check
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), format="%(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("greeting_agent")
+
+# Gemini model, built on first use so importing never loads google.generativeai;
+# assign one directly (e.g. a fake) to skip that altogether
+model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                model = genai.GenerativeModel("gemini-1.5-flash")
+    return model
+
+# PostgreSQL schema; applied by `python greeting_agent.py migrate`, never on import or pool start
+def initialize_database(conn):
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS user_preferences (
@@ -35,59 +64,328 @@ def initialize_database():
             conversation_history TEXT
         )
     """)
+    # One row per turn, so recording a turn is a single INSERT however long the history is
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            user_id TEXT NOT NULL REFERENCES user_preferences (user_id) ON DELETE CASCADE,
+            seq BIGSERIAL,
+            ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+            message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            PRIMARY KEY (user_id, seq)
+        )
+    """)
+    # Rolling summary of the turns older than the prompt's history window (see get_history_window)
+    cursor.execute("ALTER TABLE user_preferences ADD COLUMN IF NOT EXISTS history_summary TEXT")
+    cursor.execute(
+        "ALTER TABLE user_preferences ADD COLUMN IF NOT EXISTS summary_through_seq BIGINT NOT NULL DEFAULT 0"
+    )
+    # Shared session store, used when SESSION_BACKEND=postgres
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            token TEXT PRIMARY KEY,
+            user_id TEXT,
+            last_seen TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
     conn.commit()
+    migrate_conversation_history(conn)
+    migrate_user_ids(conn)
+    cursor.close()
+
+# Legacy history blobs are "User: <message>\nBot: <response>\n" repeated; responses may span lines
+LEGACY_TURN_PATTERN = re.compile(r"^User: (.*?)\nBot: (.*?)\n(?=User: |\Z)", re.DOTALL | re.MULTILINE)
+
+# Split any remaining conversation_history blobs into conversation_turns rows, one user per transaction
+def migrate_conversation_history(conn) -> int:
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT user_id FROM user_preferences WHERE conversation_history IS NOT NULL AND conversation_history <> ''"
+    )
+    user_ids = [row[0] for row in cursor.fetchall()]
+    for user_id in user_ids:
+        cursor.execute(
+            "SELECT conversation_history FROM user_preferences WHERE user_id = %s FOR UPDATE", (user_id,)
+        )
+        history = cursor.fetchone()[0] or ""
+        turns = [(user_id, message, response) for message, response in LEGACY_TURN_PATTERN.findall(history)]
+        if turns:
+            execute_values(
+                cursor, "INSERT INTO conversation_turns (user_id, message, response) VALUES %s", turns
+            )
+        cursor.execute(
+            "UPDATE user_preferences SET conversation_history = NULL WHERE user_id = %s", (user_id,)
+        )
+        conn.commit()
     cursor.close()
-    conn.close()
+    if user_ids:
+        logger.info("Migrated conversation history for %d users", len(user_ids))
+    return len(user_ids)
+
+# Re-key users created with the old per-process hash() IDs to stable_user_id(name), one user per transaction.
+# A user whose stable ID already exists (the same name signed up on another worker) is merged into it:
+# their turns and sessions move over and the rolling summary starts again, so no turn is left out of it
+def migrate_user_ids(conn) -> int:
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, name FROM user_preferences")
+    legacy = [(user_id, stable_user_id(name)) for user_id, name in cursor.fetchall()
+              if user_id != stable_user_id(name)]
+    for old_id, new_id in legacy:
+        cursor.execute("SELECT 1 FROM user_preferences WHERE user_id = %s FOR UPDATE", (new_id,))
+        if cursor.fetchone() is None:
+            cursor.execute("""
+                INSERT INTO user_preferences
+                    (user_id, name, password, location, conversation_history, history_summary, summary_through_seq)
+                SELECT %s, name, password, location, conversation_history, history_summary, summary_through_seq
+                FROM user_preferences WHERE user_id = %s
+            """, (new_id, old_id))
+        else:
+            cursor.execute(
+                "UPDATE user_preferences SET history_summary = NULL, summary_through_seq = 0 WHERE user_id = %s",
+                (new_id,)
+            )
+        cursor.execute("UPDATE conversation_turns SET user_id = %s WHERE user_id = %s", (new_id, old_id))
+        cursor.execute("UPDATE chat_sessions SET user_id = %s WHERE user_id = %s", (new_id, old_id))
+        cursor.execute("DELETE FROM user_preferences WHERE user_id = %s", (old_id,))
+        conn.commit()
+    cursor.close()
+    if legacy:
+        logger.info("Re-keyed %d users to stable IDs", len(legacy))
+    return len(legacy)
+
+# Shared connection pool; it connects on first use
+db_pool = ConnectionPool(
+    minconn=int(os.getenv("PG_POOL_MIN", "1")),
+    maxconn=int(os.getenv("PG_POOL_MAX", "10")),
+    wait_timeout=float(os.getenv("PG_POOL_WAIT_TIMEOUT", "5")),
+    host=os.getenv("PG_HOST"),
+    database=os.getenv("PG_DATABASE"),
+    user=os.getenv("PG_USER"),
+    password=os.getenv("PG_PASSWORD"),
+    cursor_factory=DictCursor
+)
 
-# Ensure the database and table are initialized
-initialize_database()
+# Create or upgrade the schema; run once per deployment, before the workers start
+def migrate() -> None:
+    with db_pool.connection() as conn:
+        initialize_database(conn)
+    from checkpoint import PostgresCheckpointSaver
+    PostgresCheckpointSaver(db_pool).setup()
 
-# Function to query Gemini LLM
-def query_gemini(prompt: str) -> str:
+# Shared non-blocking HTTP client; one per event loop so connections are reused across turns
+HTTP_TIMEOUT_SECONDS = 5
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=30.0
+)
+http_transport = None  # Override with an httpx transport (e.g. httpx.MockTransport) for offline runs
+_http_client = None
+_http_client_loop = None
+_http_client_closer = None
+
+# Wait on the client's own loop until cancelled, then close it: asyncio.run cancels leftover tasks when its
+# loop shuts down, and a new loop taking over cancels it explicitly, so no client outlives its loop
+async def close_when_cancelled(client: httpx.AsyncClient) -> None:
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await client.aclose()
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client, _http_client_loop, _http_client_closer
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client_loop is not loop:
+        if _http_client_closer is not None and not _http_client_loop.is_closed():
+            _http_client_loop.call_soon_threadsafe(_http_client_closer.cancel)
+        _http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT_SECONDS, limits=HTTP_LIMITS, transport=http_transport)
+        _http_client_loop = loop
+        _http_client_closer = loop.create_task(close_when_cancelled(_http_client))
+    return _http_client
+
+# Retry and circuit-breaker policy per external dependency; calls never outlive the turn's deadline
+ipinfo_upstream = Upstream("ipinfo", attempts=2, timeout=HTTP_TIMEOUT_SECONDS)
+nominatim_upstream = Upstream("nominatim", timeout=HTTP_TIMEOUT_SECONDS)
+open_meteo_upstream = Upstream("open-meteo", timeout=HTTP_TIMEOUT_SECONDS)
+gemini_upstream = Upstream(
+    "gemini", attempts=2, timeout=float(os.getenv("GEMINI_TIMEOUT", "20")), backoff=0.5, retry_on=(Exception,)
+)
+
+# Whole-turn budget, shared by every node and upstream call of the turn
+TURN_DEADLINE_SECONDS = float(os.getenv("TURN_DEADLINE", "15"))
+
+def upstream_stats() -> dict:
+    return {upstream.name: upstream.stats()
+            for upstream in (ipinfo_upstream, nominatim_upstream, open_meteo_upstream, gemini_upstream)}
+
+# Function to call Gemini; None when it fails or returns no candidates
+async def generate_with_gemini(prompt: str) -> str:
     try:
-        response = model.generate_content(prompt)
+        response = await gemini_upstream.call(lambda: get_model().generate_content_async(prompt))
         if hasattr(response, "candidates") and len(response.candidates) > 0:
             return response.candidates[0].content.parts[0].text.strip()
-        else:
-            return "I'm sorry, I couldn't generate a response at this time."
+        return None
     except Exception as e:
-        print(f"Error querying Gemini: {e}")
-        return "An error occurred while processing your request."
+        logger.error("Error querying Gemini: %s", e)
+        return None
+
+# Function to stream a Gemini reply, passing each chunk to on_chunk; returns (text, complete).
+# The stream gets Gemini's timeout or whatever is left of the turn, whichever is shorter
+async def stream_with_gemini(prompt: str, on_chunk) -> tuple:
+    chunks = []
+    timeout = time_left(gemini_upstream.timeout)
+    if timeout <= 0:
+        logger.debug("No time left in this turn to stream from Gemini")
+        return None, False
+    # Tokens already shown can't be taken back, so a stream is never retried; it only feeds the breaker
+    if not gemini_upstream.breaker.allow():
+        logger.debug("Gemini circuit is open, not streaming")
+        return None, False
+
+    async def consume():
+        response = await get_model().generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            text = chunk.text if chunks else chunk.text.lstrip()
+            if text:
+                chunks.append(text)
+                on_chunk(text)
 
-# Function to get the user's location
-def get_user_location() -> str:
+    try:
+        await asyncio.wait_for(consume(), timeout)
+        gemini_upstream.breaker.record_success()
+        return "".join(chunks).strip() or None, bool(chunks)
+    except asyncio.CancelledError:
+        gemini_upstream.breaker.abandon_probe()
+        raise
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError) and timeout < gemini_upstream.timeout:
+            # Cut off by the turn's deadline, which says nothing about Gemini
+            gemini_upstream.breaker.abandon_probe()
+        else:
+            gemini_upstream.breaker.record_failure()
+        logger.error("Error streaming from Gemini: %s", e or type(e).__name__)
+        # Whatever already reached the user is the reply, but it is never cached
+        return "".join(chunks).strip() or None, False
+
+# Gemini replies cached per prompt class; jokes and greetings keep a pool of variants so repeats still vary
+llm_cache = LLMResponseCache(
+    generate_with_gemini,
+    generate_stream=stream_with_gemini,
+    memory_size=int(os.getenv("LLM_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+    disk_path=os.getenv("LLM_CACHE_PATH"),  # e.g. llm_cache.sqlite3 to survive restarts
+    variants={
+        "joke": int(os.getenv("LLM_JOKE_VARIANTS", "5")),
+        "greeting": int(os.getenv("LLM_GREETING_VARIANTS", "3")),
+    },
+    ttls={"weather": 600},  # Phrasing of live weather data goes stale with the data
+    disabled_classes=[name for name in os.getenv("LLM_CACHE_DISABLED_CLASSES", "").split(",") if name]
+)
+
+# What a part says when Gemini couldn't answer for it
+GEMINI_UNAVAILABLE = "I'm sorry, I couldn't generate a response at this time."
+
+# Function to query Gemini LLM; prompt_class picks the caching policy (greeting, joke, weather, fallback)
+# and on_chunk, when given, receives the reply as it is generated
+@metrics.instrument("gemini.query")
+async def query_gemini(prompt: str, prompt_class: str = "default", on_chunk=None) -> str:
+    response = await llm_cache.query(prompt, prompt_class, on_chunk)
+    if response is None:
+        return GEMINI_UNAVAILABLE
+    return response
+
+# Batched generation: the agents of one turn share a single structured Gemini call
+# (streamed turns keep one call per agent so each part can stream on its own)
+GEMINI_BATCHING = os.getenv("GEMINI_BATCHING", "true").lower() in ("1", "true", "yes")
+prompt_batcher = PromptBatcher(
+    llm_cache,
+    generate_with_gemini,
+    max_wait=float(os.getenv("GEMINI_BATCH_MAX_WAIT", "1.0"))  # Longest a prompt waits for the rest of its turn
+)
+
+# Function to look up a client's city with ipinfo.io (the server's own city when no IP is known)
+async def fetch_ip_location(client_ip: str = None) -> str:
     try:
         # Replace 'YOUR_IPINFO_API_KEY' with your actual ipinfo.io API key
-        response = requests.get("https://ipinfo.io", timeout=5)
+        url = f"https://ipinfo.io/{client_ip}/json" if client_ip else "https://ipinfo.io"
+        response = await ipinfo_upstream.get(get_http_client(), url)
         data = response.json()
-        return data.get("city", "Unknown Location")
+        return data.get("city")
     except Exception as e:
-        print(f"Debug: Error getting location - {e}")
-        return "Unknown Location"
+        logger.debug("Error getting location - %s", e)
+        return None
+
+# Location resolution: explicit location, then the local IP-range table (IP_TABLE_CSV), then ipinfo.io
+ip_table_csv = os.getenv("IP_TABLE_CSV")
+location_resolver = LocationResolver(
+    fetch_ip_location,
+    ip_table=IPRangeTable.from_csv(ip_table_csv) if ip_table_csv else None,
+    ttl=float(os.getenv("IP_LOCATION_CACHE_TTL", "3600"))
+)
+
+# Function to get the user's location
+@metrics.instrument("upstream.get_user_location")
+async def get_user_location(client_ip: str = None, explicit_location: str = None) -> str:
+    return await location_resolver.resolve(client_ip, explicit_location)
+
+# City -> coordinates never change: a memory tier in front of a persistent SQLite store
+coordinates_memory = TTLCache(max_size=int(os.getenv("GEOCODE_CACHE_SIZE", "4096")))
+coordinates_store = SQLiteStore(os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3"), table="coordinates")
+
+# Coordinates -> current weather is fresh enough for about ten minutes
+weather_cache = TTLCache(
+    max_size=int(os.getenv("WEATHER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("WEATHER_CACHE_TTL", "600"))
+)
+# Last known weather per location, served stale while Open-Meteo is failing
+weather_last_known = TTLCache(
+    max_size=int(os.getenv("WEATHER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("WEATHER_STALE_TTL", "21600"))
+)
+
+# Concurrent lookups for the same city or coordinates share one upstream call
+upstream_flight = SingleFlight()
 
-# Function to get the weather for a given location
-def get_coordinates(location: str) -> dict:
+# Function to get the coordinates of a city, served from cache when possible
+@metrics.instrument("upstream.get_coordinates")
+async def get_coordinates(location: str) -> dict:
+    key = location.strip().lower()
+    coordinates = coordinates_memory.get(key)
+    if coordinates is None:
+        # SQLite reads and writes block, so they run off the event loop
+        coordinates = await asyncio.to_thread(coordinates_store.get, key)
+        if coordinates is None:
+            coordinates = await upstream_flight.do(("geocode", key), lambda: fetch_coordinates(location))
+            # Only real answers are kept forever; failures are retried next time
+            if coordinates:
+                await asyncio.to_thread(coordinates_store.set, key, coordinates)
+        if coordinates:
+            coordinates_memory.set(key, coordinates)
+    return coordinates
+
+# Function to geocode a city with Nominatim
+async def fetch_coordinates(location: str) -> dict:
     try:
         # Simplified to use only the city name
         url = f"https://nominatim.openstreetmap.org/search?city={location}&format=json"
         headers = {"User-Agent": "YourAppName/1.0 (contact@example.com)"}  # Replace with your contact info
-        response = requests.get(url, headers=headers, timeout=5)
+        response = await nominatim_upstream.get(get_http_client(), url, headers=headers)
 
         if response.status_code == 200:
             data = response.json()
             if data:
                 latitude = float(data[0]["lat"])
                 longitude = float(data[0]["lon"])
-                print(f"Debug: Found coordinates - Latitude: {latitude}, Longitude: {longitude}")
+                logger.debug("Found coordinates - Latitude: %s, Longitude: %s", latitude, longitude)
                 return {"latitude": latitude, "longitude": longitude}
             else:
-                print(f"Debug: No coordinates found for {location}")
+                logger.debug("No coordinates found for %s", location)
                 return {}
         else:
-            print(f"Debug: Geocoding API returned status code {response.status_code}")
+            logger.debug("Geocoding API returned status code %s", response.status_code)
             return {}
     except Exception as e:
-        print(f"Debug: Error fetching coordinates - {e}")
+        logger.debug("Error fetching coordinates - %s", e)
         return {}
 
 WEATHER_CODE_DESCRIPTIONS = {
@@ -115,90 +413,394 @@ WEATHER_CODE_DESCRIPTIONS = {
 }
 
 
-def get_weather_for_today(location: str) -> str:
+# Function to get the current weather at some coordinates, served from cache when fresh
+@metrics.instrument("upstream.get_current_weather")
+async def get_current_weather(latitude: float, longitude: float) -> dict:
+    key = weather_key(latitude, longitude)
+    current_weather = weather_cache.get(key)
+    if current_weather is None:
+        current_weather = await upstream_flight.do(("weather", key), lambda: fetch_current_weather(latitude, longitude))
+        if current_weather:
+            remember_current_weather(latitude, longitude, current_weather)
+        else:
+            current_weather = weather_last_known.get(key)
+            if current_weather:
+                current_weather = {**current_weather, "stale": True}
+    return current_weather
+
+# ~1 km grid, so nearby lookups for the same city share an entry
+def weather_key(latitude: float, longitude: float) -> tuple:
+    return (round(latitude, 2), round(longitude, 2))
+
+def remember_current_weather(latitude: float, longitude: float, current_weather: dict) -> None:
+    key = weather_key(latitude, longitude)
+    weather_cache.set(key, current_weather)
+    weather_last_known.set(key, current_weather)
+
+# Function to fetch the current weather from Open-Meteo; None when the API fails
+async def fetch_current_weather(latitude: float, longitude: float) -> dict:
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
     try:
-        coordinates = get_coordinates(location)
-        if not coordinates:
-            return f"Sorry, weather information is not available for {location}."
+        response = await open_meteo_upstream.get(get_http_client(), url)
+    except Exception as e:
+        logger.debug("Error fetching weather - %s", e)
+        return None
 
-        latitude = coordinates["latitude"]
-        longitude = coordinates["longitude"]
+    if response.status_code == 200:
+        data = response.json()
+        return data.get("current_weather", {})
+    logger.debug("Open-Meteo returned status code %s", response.status_code)
+    return None
 
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
-        response = requests.get(url, timeout=5)
+# Function to fetch the current weather at several coordinates with one Open-Meteo request;
+# the result lines up with locations, None where the API failed
+async def fetch_current_weather_many(locations: list) -> list:
+    latitudes = ",".join(str(latitude) for latitude, _ in locations)
+    longitudes = ",".join(str(longitude) for _, longitude in locations)
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitudes}&longitude={longitudes}&current_weather=true"
+    try:
+        response = await open_meteo_upstream.get(get_http_client(), url)
+    except Exception as e:
+        logger.debug("Error fetching weather for %d locations - %s", len(locations), e)
+        return [None] * len(locations)
 
-        if response.status_code == 200:
-            data = response.json()
-            current_weather = data.get("current_weather", {})
-            temperature = current_weather.get("temperature")
-            weather_code = current_weather.get("weathercode", -1)
+    if response.status_code == 200:
+        data = response.json()
+        if isinstance(data, dict):
+            data = [data]  # A single location comes back as an object rather than a list
+        return [entry.get("current_weather") for entry in data]
+    logger.debug("Open-Meteo returned status code %s", response.status_code)
+    return [None] * len(locations)
 
-            description = WEATHER_CODE_DESCRIPTIONS.get(weather_code, "Unknown weather condition")
+# Hot cities are refreshed in the background, more often than WEATHER_CACHE_TTL, so their lookups never leave memory
+weather_prefetcher = WeatherPrefetcher(
+    get_coordinates,
+    fetch_current_weather_many,
+    remember_current_weather,
+    top_k=int(os.getenv("WEATHER_PREFETCH_TOP_K", "20")),  # 0 turns prefetching off
+    interval=float(os.getenv("WEATHER_PREFETCH_INTERVAL", "300")),
+    half_life=float(os.getenv("WEATHER_PREFETCH_HALF_LIFE", "3600"))
+)
 
-            if temperature is not None:
-                return f"The weather in {location} is {description} with a temperature of {temperature}°C."
-            else:
-                return f"Weather details are incomplete for {location}. Please try again later."
+
+# Current weather facts for a location: {"location", "temperature", "weather_code", "stale", "text"}, where
+# text is the plain sentence and stale marks last known weather served while Open-Meteo fails;
+# when the facts are missing, temperature is None and text says why
+@metrics.instrument("upstream.get_weather_for_today")
+async def get_weather_report(location: str) -> dict:
+    report = {"location": location, "temperature": None, "weather_code": -1, "stale": False}
+    if location == UNKNOWN_LOCATION:
+        # Nothing to geocode, and a failed geocode isn't cached, so don't ask Nominatim every turn
+        return {**report, "text": "Sorry, I couldn't work out your location, so I can't look up the weather. "
+                                  "Tell me which city you're in."}
+    weather_prefetcher.record(location)
+    weather_prefetcher.ensure_running()
+    try:
+        coordinates = await get_coordinates(location)
+        if not coordinates:
+            return {**report, "text": f"Sorry, weather information is not available for {location}."}
+
+        current_weather = await get_current_weather(coordinates["latitude"], coordinates["longitude"])
+        if current_weather is None:
+            return {**report, "text": f"Could not fetch weather details for {location}."}
+
+        temperature = current_weather.get("temperature")
+        weather_code = current_weather.get("weathercode", -1)
+
+        description = WEATHER_CODE_DESCRIPTIONS.get(weather_code, "Unknown weather condition")
+
+        if temperature is not None:
+            text = f"The weather in {location} is {description} with a temperature of {temperature}°C."
         else:
-            return f"Could not fetch weather details for {location}."
+            text = f"Weather details are incomplete for {location}. Please try again later."
+        return {**report, "temperature": temperature, "weather_code": weather_code,
+                "stale": bool(current_weather.get("stale")), "text": text}
     except Exception as e:
-        return "Could not fetch weather details at the moment. Please try again later."
+        return {**report, "text": "Could not fetch weather details at the moment. Please try again later."}
+
+async def get_weather_for_today(location: str) -> str:
+    return (await get_weather_report(location))["text"]
+
+# Hit/miss/eviction counters for the geocoding and weather caches
+def cache_stats() -> dict:
+    return {
+        "coordinates_memory": coordinates_memory.stats(),
+        "coordinates_store": coordinates_store.stats(),
+        "weather": weather_cache.stats(),
+        "weather_last_known": weather_last_known.stats(),
+        "single_flight": upstream_flight.stats(),
+        "location": location_resolver.stats(),
+        "prefetch": weather_prefetcher.stats(),
+    }
+
+
+# Everything the classifier can detect in a message
+Intent = Literal["greeting", "joke", "weather", "signup", "login", "whoami", "history"]
 
+# Agent outputs merge per part, so parallel branches can each add their own
+def merge_agent_outputs(current: dict, update: dict) -> dict:
+    return {**(current or {}), **(update or {})}
 
-# Define the state schema
-class State(TypedDict):
+# What a turn is given: the only keys the caller passes in
+class TurnInput(TypedDict):
     message: str
+    session_id: str
+    client_ip: str
+    location: str
+
+# What a turn hands back; the rest of the state stays inside the graph
+class TurnOutput(TypedDict):
+    final_response: str
+    skipped_nodes: list  # Agent nodes the classifier ruled out, for callers tracing how a turn was routed
+
+# Define the state schema. Every node returns only the keys it owns, so each step merges one or two
+# channels instead of rewriting the whole state; agent_outputs is the one key with several writers
+class State(TurnInput):
+    intents: FrozenSet[Intent]  # Detected once by the classifier; every other node reads this
+    skipped_nodes: list
     greeting_response: str
     weather_response: str
     joke_response: str
     final_response: str
+    # part -> {"response", "key", "at"}; kept across turns by the checkpointer so fresh outputs are reused
+    agent_outputs: Annotated[dict, merge_agent_outputs]
+
+# The slice of the state an agent branch reads; a node only gets the channels of its input schema
+class AgentInput(TurnInput):
+    intents: FrozenSet[Intent]
+    agent_outputs: Annotated[dict, merge_agent_outputs]
+
+# Keywords for detecting intents
+GREETING_KEYWORDS = ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "how are you", "howdy"]
+JOKE_KEYWORDS = ["joke", "jokes", "funny", "laugh"]
+WEATHER_KEYWORDS = ["weather", "temperature", "forecast"]
+
+# Account commands are answered by the front-end alone
+ACCOUNT_COMMANDS = {
+    "signup": "my name is",
+    "login": "log me in",
+    "whoami": "what is my name",
+    "history": "show my history",
+}
+
+# Every trigger phrase compiled into one matcher at import
+INTENT_PHRASES = {
+    **{intent: [phrase] for intent, phrase in ACCOUNT_COMMANDS.items()},
+    "greeting": GREETING_KEYWORDS,
+    "joke": JOKE_KEYWORDS,
+    "weather": WEATHER_KEYWORDS,
+}
+intent_matcher = IntentMatcher(INTENT_PHRASES)
+ACCOUNT_INTENTS = frozenset(ACCOUNT_COMMANDS)
+
+# How each agent words its reply, set per agent with <PART>_RESPONDER: "gemini" always asks Gemini,
+# "template" never does (weather renders its facts locally, greeting and joke pick a canned line),
+# and "auto" asks Gemini only when the message needs more than a plain answer
+RESPONDER_MODES = ("gemini", "template", "auto")
+AGENT_RESPONDERS = {
+    part: os.getenv(f"{part.upper()}_RESPONDER", default).lower()
+    for part, default in (("greeting", "gemini"), ("joke", "gemini"), ("weather", "auto"))
+}
+for part, mode in AGENT_RESPONDERS.items():
+    if mode not in RESPONDER_MODES:
+        raise ValueError(f"{part.upper()}_RESPONDER must be one of {RESPONDER_MODES}, not {mode!r}")
+needs_free_form = FreeFormDetector(phrase for phrases in INTENT_PHRASES.values() for phrase in phrases)
+
+# Weather sentences rendered locally; WEATHER_LOCALE picks the phrasebook and WEATHER_TONE the register
+weather_templates = WeatherTemplates(
+    locale=os.getenv("WEATHER_LOCALE", "en"),
+    tone=os.getenv("WEATHER_TONE", "friendly")
+)
+
+# Whether this part of the reply is worded by Gemini for this message
+def uses_gemini(part: str, message: str) -> bool:
+    mode = AGENT_RESPONDERS.get(part, "gemini")
+    return mode == "gemini" or (mode == "auto" and needs_free_form(message))
+
+# Agent nodes in the order they run, keyed by the intent that needs them
+AGENT_NODES = [
+    ("greeting", "GreetingAgent"),
+    ("joke", "JokeAgent"),
+    ("weather", "WeatherAgent"),
+]
+
+# Per-turn objects the nodes share, passed as one config entry instead of one key each
+class TurnContext:
+    __slots__ = ("deadline", "response_stream", "prompt_batch")
+
+    def __init__(self, deadline: Deadline = None, response_stream: ResponseStream = None,
+                 prompt_batch: PromptBatch = None):
+        self.deadline = deadline
+        self.response_stream = response_stream
+        self.prompt_batch = prompt_batch
+
+# Shared by graph invocations that carry no TurnContext
+NO_TURN_CONTEXT = TurnContext()
+
+def get_turn_context(config: RunnableConfig) -> TurnContext:
+    return ((config or {}).get("configurable") or {}).get("turn") or NO_TURN_CONTEXT
+
+# The turn's Deadline, or None when the graph is invoked without one
+def get_deadline(config: RunnableConfig) -> Deadline:
+    return get_turn_context(config).deadline
+
+# The turn's ResponseStream when the graph runs in streaming mode, else None
+def get_response_stream(config: RunnableConfig) -> ResponseStream:
+    return get_turn_context(config).response_stream
+
+# on_chunk callback that streams text into one part of the reply, or None when not streaming
+def stream_writer(config: RunnableConfig, part: str):
+    stream = get_response_stream(config)
+    return (lambda text: stream.write(part, text)) if stream is not None else None
+
+# The turn's PromptBatch when its Gemini calls are batched, else None
+def get_prompt_batch(config: RunnableConfig) -> PromptBatch:
+    return get_turn_context(config).prompt_batch
+
+# Query Gemini for one part of the reply: batched with the turn's other prompts, streamed, or on its own
+async def query_gemini_for_part(config: RunnableConfig, part: str, prompt: str, prompt_class: str) -> str:
+    batch = get_prompt_batch(config)
+    if batch is None:
+        return await query_gemini(prompt, prompt_class, stream_writer(config, part))
+    response = await batch.submit(part, prompt, prompt_class)
+    if response is None:
+        return GEMINI_UNAVAILABLE
+    return response
+
+# Intent Classifier Node
+def intent_classifier_function(state: State, config: RunnableConfig) -> dict:
+    found = intent_matcher.match(state.get("message", ""))
+    # An account command is the whole turn; the agents only run for everything else
+    intents = (found & ACCOUNT_INTENTS) or found
+
+    # The reply is the agents' parts in order, or the front-end's own answer
+    parts = [intent for intent, _ in AGENT_NODES if intent in intents] or ["final"]
+    stream = get_response_stream(config)
+    if stream is not None:
+        stream.plan(parts)
+    batch = get_prompt_batch(config)
+    if batch is not None:
+        # Parts worded locally never submit a prompt, so the batch doesn't wait for them
+        batch.plan([part for part in parts if uses_gemini(part, state.get("message", ""))])
+    return {
+        "intents": intents,
+        "skipped_nodes": [node for intent, node in AGENT_NODES if intent not in intents],
+    }
+
+# Fan out to every agent the message needs; they run in parallel and join at the front-end
+def route_by_intent(state: State) -> list:
+    agents = [node for intent, node in AGENT_NODES if intent in state["intents"]]
+    return agents or ["FrontEndAgent"]
+
+# Outputs a later turn of the same session may reuse (with a checkpointer), and what must match to reuse them.
+# An agent offers its output for reuse by returning it under agent_outputs, which it only does for a real
+# answer: never a fallback, an error or stale weather
+# A weather reply also depends on how it was worded and what else the message asked, so a follow-up such
+# as "should I bring an umbrella?" gets its own answer
+def weather_reuse_key(state: State) -> str:
+    message = state.get("message", "")
+    return "|".join((state.get("location") or "", state.get("client_ip") or "",
+                     "gemini" if uses_gemini("weather", message) else "template", " ".join(normalize(message).split())))
+
+REUSABLE_OUTPUTS = {
+    "weather": weather_reuse_key,
+    "greeting": lambda state: state.get("message", "").strip().lower(),
+}
+AGENT_OUTPUT_TTL = float(os.getenv("AGENT_OUTPUT_TTL", "600"))
+
+# How long a single agent branch may take
+BRANCH_TIMEOUT_SECONDS = float(os.getenv("AGENT_BRANCH_TIMEOUT", "10"))
+
+# Run an agent branch, answering with a fallback if it exceeds its timeout,
+# and end its part of the batched or streamed reply
+def with_branch_timeout(agent_function, part: str, fallback: str):
+    output_key = f"{part}_response"
+    reuse_key = REUSABLE_OUTPUTS.get(part)
+
+    async def run_branch(state: State, config: RunnableConfig) -> dict:
+        # A branch gets its own timeout or whatever is left of the turn, whichever is shorter
+        deadline = get_deadline(config)
+        timeout = BRANCH_TIMEOUT_SECONDS if deadline is None else min(BRANCH_TIMEOUT_SECONDS, deadline.remaining())
+        current_deadline.set(deadline)
+        previous = (state.get("agent_outputs") or {}).get(part)
+        if (reuse_key is not None and previous and previous.get("ok") and previous["key"] == reuse_key(state)
+                and time.time() - previous["at"] < AGENT_OUTPUT_TTL):
+            logger.debug("Reusing the %s output of an earlier turn", part)
+            update = {output_key: previous["response"]}
+        else:
+            try:
+                update = await asyncio.wait_for(agent_function(state, config), timeout=timeout)
+                offered = update.pop("agent_outputs", {}).get(part)
+                if reuse_key is not None and offered is not None:
+                    update["agent_outputs"] = {
+                        part: {"response": offered, "ok": True, "key": reuse_key(state), "at": time.time()}
+                    }
+            except asyncio.TimeoutError:
+                logger.debug("%s timed out after %.2fs", agent_function.__name__, timeout)
+                # Tokens already streamed can't be taken back, so they are the reply that gets recorded
+                stream = get_response_stream(config)
+                update = {output_key: (stream is not None and stream.written(part)) or fallback}
+        batch = get_prompt_batch(config)
+        if batch is not None:
+            batch.withdraw(part)  # Don't hold up the turn's other prompts for this branch
+        stream = get_response_stream(config)
+        if stream is not None:
+            stream.finish_part(part, update[output_key])
+        return update
+
+    return run_branch
 
 # Greeting Agent Node with Gemini
-def greeting_agent_function(state: State) -> State:
+async def greeting_agent_function(state: State, config: RunnableConfig) -> dict:
     message = state.get("message", "").strip()
-    prompt = f"The user said: '{message}'. Generate a friendly greeting response."
-    gemini_response = query_gemini(prompt)
+    gemini_response = None
+    if uses_gemini("greeting", message):
+        prompt = f"The user said: '{message}'. Generate a friendly greeting response."
+        gemini_response = await query_gemini_for_part(config, "greeting", prompt, "greeting")
 
-    if gemini_response:
-        state["greeting_response"] = gemini_response
-    else:
-        greetings = [
-            "Hello! How can I assist you today?",
-            "Hi there! What can I do for you?",
-            "Hey! Need any help?"
-        ]
-        state["greeting_response"] = random.choice(greetings)
+    if gemini_response and gemini_response != GEMINI_UNAVAILABLE:
+        # Only Gemini's own greeting is worth keeping for a repeat of the message
+        return {"greeting_response": gemini_response, "agent_outputs": {"greeting": gemini_response}}
 
-    return state
+    greetings = [
+        "Hello! How can I assist you today?",
+        "Hi there! What can I do for you?",
+        "Hey! Need any help?"
+    ]
+    # Only the key this agent owns, so parallel branches don't collide
+    return {"greeting_response": random.choice(greetings)}
 
 # Weather Agent Node
-def weather_agent_function(state: State) -> State:
-    message = state.get("message", "").strip().lower()
-    if "weather" in message or "temperature" in message or "forecast" in message:
-        location = get_user_location()
-        fallback_weather_response = get_weather_for_today(location)
-
-        prompt = (
-            f"The user asked about the weather in {location}. The current weather is: {fallback_weather_response}.\n"
-            f"Generate a friendly and concise response incorporating this information."
-        )
+async def weather_agent_function(state: State, config: RunnableConfig) -> dict:
+    if "weather" in state.get("intents", ()):
+        location = await get_user_location(state.get("client_ip"), state.get("location"))
+        report = await get_weather_report(location)
 
-        gemini_response = query_gemini(prompt)
-
-        # Use Gemini response or fallback data
-        state["weather_response"] = (
-            gemini_response if gemini_response else fallback_weather_response
-        )
+        if uses_gemini("weather", state.get("message", "")):
+            prompt = (
+                f"The user asked about the weather in {location}. The current weather is: {report['text']}.\n"
+                f"Generate a friendly and concise response incorporating this information."
+            )
+            gemini_response = await query_gemini_for_part(config, "weather", prompt, "weather")
+            # Use Gemini response or fallback data
+            worded = gemini_response if gemini_response and gemini_response != GEMINI_UNAVAILABLE else None
+            weather_response = worded or report["text"]
+        elif report["temperature"] is not None:
+            worded = weather_response = weather_templates.render(
+                location, report["temperature"], report["weather_code"], seed=state.get("session_id") or ""
+            )
+        else:
+            worded, weather_response = None, report["text"]
+        # Later turns may reuse a reply only when it words live weather facts
+        if worded and report["temperature"] is not None and not report["stale"]:
+            return {"weather_response": weather_response, "agent_outputs": {"weather": weather_response}}
     else:
-        state["weather_response"] = "I can provide weather information if you ask specifically."
-    return state
+        weather_response = "I can provide weather information if you ask specifically."
+    return {"weather_response": weather_response}
 
 # Joke Agent Node with Gemini
-def joke_agent_function(state: State) -> State:
-    joke_keywords = ["joke", "funny", "laugh"]
-    message = state.get("message", "").strip().lower()
-
-    if any(keyword in message for keyword in joke_keywords):
+async def joke_agent_function(state: State, config: RunnableConfig) -> dict:
+    if "joke" in state.get("intents", ()):
         fallback_jokes = [
             "Why don't scientists trust atoms? Because they make up everything!",
             "Why did the scarecrow win an award? Because he was outstanding in his field!",
@@ -206,197 +808,684 @@ def joke_agent_function(state: State) -> State:
         ]
         fallback_joke = random.choice(fallback_jokes)
 
-        prompt = "The user asked for a joke. Provide a lighthearted and funny joke."
-        gemini_response = query_gemini(prompt)
+        gemini_response = None
+        if uses_gemini("joke", state.get("message", "")):
+            prompt = "The user asked for a joke. Provide a lighthearted and funny joke."
+            gemini_response = await query_gemini_for_part(config, "joke", prompt, "joke")
 
-        state["joke_response"] = gemini_response if gemini_response else fallback_joke
+        joke_response = gemini_response if gemini_response else fallback_joke
     else:
-        state["joke_response"] = "I can tell jokes if you ask for one!"
+        joke_response = "I can tell jokes if you ask for one!"
 
-    return state
+    return {"joke_response": joke_response}
+
+# How many recent turns "show my history" returns
+HISTORY_TAIL_TURNS = int(os.getenv("HISTORY_TAIL_TURNS", "50"))
+
+# History given to Gemini: a rolling summary plus the newest turns, within a token budget
+HISTORY_CONTEXT_TOKENS = int(os.getenv("HISTORY_CONTEXT_TOKENS", "1000"))
+HISTORY_WINDOW_TURNS = int(os.getenv("HISTORY_WINDOW_TURNS", "10"))
+# Turns outside the window are folded into the summary once they add up to this many tokens
+HISTORY_SUMMARY_THRESHOLD = int(os.getenv("HISTORY_SUMMARY_THRESHOLD", "500"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "200"))
+# Most turns folded into the summary at once, so a long-unsummarized history is caught up in steps
+HISTORY_SUMMARY_MAX_TURNS = 100
+
+# Rough token count (about four characters per token); close enough for budgeting, with no tokenizer to load
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def format_turn(message: str, response: str) -> str:
+    return f"User: {message}\nBot: {response}\n"
 
-# Persistent User Preference Agent
 # Persistent User Preference Agent
 class UserPreferenceAgent:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv("PG_HOST"),
-            database=os.getenv("PG_DATABASE"),
-            user=os.getenv("PG_USER"),
-            password=os.getenv("PG_PASSWORD"),
-            cursor_factory=DictCursor
-        )
-        self.cursor = self.conn.cursor()
+    # Each operation borrows its own connection and cursor from the pool;
+    # with a turn_writer, conversation turns are written behind the reply in batches.
+    # Passwords are hashed and checked on the verifier's own pool, never on the caller's thread
+    def __init__(self, pool: ConnectionPool, turn_writer: WriteBehindQueue = None,
+                 cache_size: int = 10000, cache_ttl: float = 300, notify_channel: str = None,
+                 verifier: VerifierPool = None):
+        self.pool = pool
+        self.turn_writer = turn_writer
+        self.verifier = verifier or VerifierPool()
+        # Read-through caches keyed by user_id; every hit is a database read avoided
+        self.profile_cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.history_cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.window_cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        # With a notify channel, workers tell each other which users changed via LISTEN/NOTIFY
+        self.notify_channel = notify_channel
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.listener = None
+
+    def _ensure_listener(self) -> None:
+        if self.notify_channel and self.listener is None:
+            self.listener = NotificationListener(
+                self.notify_channel, self._on_notification, **self.pool.connect_kwargs
+            )
+            self.listener.start()
+
+    def _on_notification(self, payload: str) -> None:
+        sender, _, user_id = payload.partition(":")
+        if sender != self.worker_id:
+            self.invalidate_user(user_id)
+
+    # Queue invalidations for other workers; they are delivered when the transaction commits
+    def _notify(self, cursor, user_ids) -> None:
+        if self.notify_channel:
+            for user_id in user_ids:
+                cursor.execute("SELECT pg_notify(%s, %s)", (self.notify_channel, f"{self.worker_id}:{user_id}"))
+
+    def invalidate_user(self, user_id: str) -> None:
+        self.profile_cache.invalidate(user_id)
+        self.history_cache.invalidate(user_id)
+        self.window_cache.invalidate(user_id)
 
     def signup(self, user_id: str, name: str, password: str) -> str:
+        return self.create_user(user_id, name, self.verifier.hash(password))
+
+    # Async callers hash with verifier.ahash first and call this in a thread
+    @metrics.instrument("db.signup")
+    def create_user(self, user_id: str, name: str, password_hash: str) -> str:
         try:
-            self.cursor.execute(
-                "INSERT INTO user_preferences (user_id, name, password, conversation_history) VALUES (%s, %s, %s, %s)",
-                (user_id, name, password, "")
-            )
-            self.conn.commit()
+            with self.pool.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO user_preferences (user_id, name, password) VALUES (%s, %s, %s)",
+                    (user_id, name, password_hash)
+                )
+                self._notify(cursor, [user_id])
+            self.invalidate_user(user_id)
             return f"Signup successful! Welcome, {name.capitalize()}."
         except psycopg2.errors.UniqueViolation:
-            self.conn.rollback()
             return "This user already exists. Please log in."
 
+    @metrics.instrument("db.login")
     def login(self, user_id: str, password: str) -> str:
-        self.cursor.execute(
-            "SELECT name, password FROM user_preferences WHERE user_id = %s", (user_id,)
-        )
-        result = self.cursor.fetchone()
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "SELECT name, password FROM user_preferences WHERE user_id = %s", (user_id,)
+            )
+            result = cursor.fetchone()
         if not result:
             return "User not found. Please sign up first."
         name, stored_password = result
-        if stored_password == password:
-            return f"Login successful! Welcome back, {name.capitalize()}."
-        return "Incorrect password. Please try again."
+        try:
+            verified = self.verifier.verify(password, stored_password)
+        except VerifierBusy:
+            return "We're busy right now. Please try logging in again in a moment."
+        if not verified:
+            return "Incorrect password. Please try again."
+        # Plain-text passwords from before hashing, or hashes at an older cost, are upgraded on login
+        if self.verifier.needs_rehash(stored_password):
+            with self.pool.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE user_preferences SET password = %s WHERE user_id = %s AND password = %s",
+                    (self.verifier.hash(password), user_id, stored_password)
+                )
+        return f"Login successful! Welcome back, {name.capitalize()}."
 
+    @metrics.instrument("db.get_user_name")
     def get_user_name(self, user_id: str) -> str:
-        self.cursor.execute(
-            "SELECT name FROM user_preferences WHERE user_id = %s", (user_id,)
-        )
-        result = self.cursor.fetchone()
-        return result["name"] if result else None
+        profile = self.profile_cache.get(user_id)
+        if profile is None:
+            self._ensure_listener()
+            with self.pool.cursor() as cursor:
+                cursor.execute(
+                    "SELECT name FROM user_preferences WHERE user_id = %s", (user_id,)
+                )
+                result = cursor.fetchone()
+            if not result:
+                return None
+            profile = {"name": result["name"]}
+            self.profile_cache.set(user_id, profile)
+        return profile["name"]
 
+    @metrics.instrument("db.update_conversation_history")
     def update_conversation_history(self, user_id: str, message: str, response: str) -> None:
         if user_id:
-            self.cursor.execute(
-                "SELECT conversation_history FROM user_preferences WHERE user_id = %s", (user_id,)
+            self.history_cache.invalidate(user_id)
+            self.window_cache.invalidate(user_id)
+            turn = [user_id, time.time(), message, response]
+            if self.turn_writer is not None:
+                self.turn_writer.enqueue(turn)
+            else:
+                self.append_turns([turn])
+
+    # Insert [user_id, ts, message, response] turns with one statement and one commit
+    @metrics.instrument("db.append_turns")
+    def append_turns(self, turns: list) -> None:
+        with self.pool.cursor() as cursor:
+            # Unknown users have no history to append to, so the join drops their turns
+            execute_values(cursor, """
+                INSERT INTO conversation_turns (user_id, ts, message, response)
+                SELECT v.user_id, to_timestamp(v.ts), v.message, v.response
+                FROM (VALUES %s) AS v (ord, user_id, ts, message, response)
+                JOIN user_preferences u ON u.user_id = v.user_id
+                ORDER BY v.ord
+            """, [(ord, *turn) for ord, turn in enumerate(turns)])
+            self._notify(cursor, {turn[0] for turn in turns})
+
+    # One page of turns, newest first; pass the smallest seq seen as before_seq to page further back
+    @metrics.instrument("db.get_conversation_turns")
+    def get_conversation_turns(self, user_id: str, limit: int = 50, before_seq: int = None) -> list:
+        # Write out buffered turns first so a user always sees their latest messages
+        if self.turn_writer is not None:
+            self.turn_writer.flush()
+        with self.pool.cursor() as cursor:
+            if before_seq is None:
+                cursor.execute(
+                    "SELECT seq, ts, message, response FROM conversation_turns "
+                    "WHERE user_id = %s ORDER BY seq DESC LIMIT %s",
+                    (user_id, limit)
+                )
+            else:
+                cursor.execute(
+                    "SELECT seq, ts, message, response FROM conversation_turns "
+                    "WHERE user_id = %s AND seq < %s ORDER BY seq DESC LIMIT %s",
+                    (user_id, before_seq, limit)
+                )
+            return cursor.fetchall()
+
+    # The last N turns, oldest first, in the familiar "User: ... / Bot: ..." format
+    @metrics.instrument("db.get_conversation_history")
+    def get_conversation_history(self, user_id: str, last_n: int = HISTORY_TAIL_TURNS) -> str:
+        cached = self.history_cache.get(user_id)
+        if cached is not None and cached[0] == last_n:
+            return cached[1]
+        self._ensure_listener()
+        turns = self.get_conversation_turns(user_id, limit=last_n)
+        if not turns:
+            return "No history available."
+        history = "".join(format_turn(turn["message"], turn["response"]) for turn in reversed(turns))
+        self.history_cache.set(user_id, (last_n, history))
+        return history
+
+    # What of a user's history fits in a prompt of token_budget tokens: the stored summary, then the newest
+    # of the last_n turns not yet summarized. Older turns that are neither come back as "pending", oldest
+    # first, for the caller to fold into the summary once they pass HISTORY_SUMMARY_THRESHOLD tokens.
+    # None for an unknown user.
+    @metrics.instrument("db.get_history_window")
+    def get_history_window(self, user_id: str, token_budget: int = HISTORY_CONTEXT_TOKENS,
+                           last_n: int = HISTORY_WINDOW_TURNS) -> dict:
+        cached = self.window_cache.get(user_id)
+        if cached is not None and cached[0] == (token_budget, last_n):
+            return cached[1]
+        self._ensure_listener()
+        if self.turn_writer is not None:
+            self.turn_writer.flush()
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "SELECT history_summary, summary_through_seq FROM user_preferences WHERE user_id = %s", (user_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            summary, through_seq = row["history_summary"] or "", row["summary_through_seq"]
+            cursor.execute(
+                "SELECT seq, message, response FROM conversation_turns "
+                "WHERE user_id = %s AND seq > %s ORDER BY seq DESC LIMIT %s",
+                (user_id, through_seq, last_n)
             )
-            result = self.cursor.fetchone()
-            if result:
-                updated_history = (result[0] or "") + f"User: {message}\nBot: {response}\n"
-                self.cursor.execute(
-                    "UPDATE user_preferences SET conversation_history = %s WHERE user_id = %s",
-                    (updated_history, user_id)
+            newest = cursor.fetchall()
+
+            budget = token_budget - estimate_tokens(summary)
+            turns = []
+            for turn in newest:
+                tokens = estimate_tokens(format_turn(turn["message"], turn["response"]))
+                if tokens > budget:
+                    break
+                budget -= tokens
+                turns.append(turn)
+
+            # Everything older than the window still waits for the summary; the oldest of it is folded in first,
+            # HISTORY_SUMMARY_MAX_TURNS at a time, so a long backlog catches up over several refreshes
+            pending = []
+            if newest:
+                window_start = turns[-1]["seq"] if turns else newest[0]["seq"] + 1
+                cursor.execute(
+                    "SELECT seq, message, response FROM conversation_turns "
+                    "WHERE user_id = %s AND seq > %s AND seq < %s ORDER BY seq ASC LIMIT %s",
+                    (user_id, through_seq, window_start, HISTORY_SUMMARY_MAX_TURNS)
                 )
-                self.conn.commit()
+                pending = [(turn["seq"], turn["message"], turn["response"]) for turn in cursor.fetchall()]
 
-    def get_conversation_history(self, user_id: str) -> str:
-        self.cursor.execute(
-            "SELECT conversation_history FROM user_preferences WHERE user_id = %s", (user_id,)
-        )
-        result = self.cursor.fetchone()
-        return result[0] if result else "No history available."
+        turns = [(turn["message"], turn["response"]) for turn in turns]
+        window = {
+            "summary": summary,
+            "summary_through_seq": through_seq,
+            "turns": turns[::-1],
+            "pending": pending,
+            "pending_tokens": sum(estimate_tokens(format_turn(message, response)) for _, message, response in pending),
+        }
+        self.window_cache.set(user_id, ((token_budget, last_n), window))
+        return window
+
+    # Store a summary covering every turn up to through_seq. Only applies if nobody else moved the summary
+    # past previous_through_seq in the meantime; returns whether it did.
+    @metrics.instrument("db.save_history_summary")
+    def save_history_summary(self, user_id: str, summary: str, through_seq: int, previous_through_seq: int) -> bool:
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "UPDATE user_preferences SET history_summary = %s, summary_through_seq = %s "
+                "WHERE user_id = %s AND summary_through_seq = %s",
+                (summary, through_seq, user_id, previous_through_seq)
+            )
+            saved = cursor.rowcount == 1
+            if saved:
+                self._notify(cursor, [user_id])
+        self.window_cache.invalidate(user_id)
+        return saved
+
+    def cache_stats(self) -> dict:
+        return {
+            "profile": self.profile_cache.stats(),
+            "history": self.history_cache.stats(),
+            "window": self.window_cache.stats(),
+            "db_reads_avoided": self.profile_cache.hits + self.history_cache.hits + self.window_cache.hits,
+            "notifications_received": self.listener.received if self.listener else 0,
+        }
 
     def close(self):
-        self.cursor.close()
-        self.conn.close()
+        if self.listener is not None:
+            self.listener.stop()
+        if self.turn_writer is not None:
+            self.turn_writer.close()
+        self.verifier.close()
+        self.pool.closeall()
 
 # Instantiate UserPreferenceAgent
-user_pref_agent = UserPreferenceAgent()
+# Password hashing runs here: at most CREDENTIAL_WORKERS hashes at once, CREDENTIAL_MAX_PENDING queued
+credential_pool = VerifierPool(
+    workers=int(os.getenv("CREDENTIAL_WORKERS", "2")),
+    max_pending=int(os.getenv("CREDENTIAL_MAX_PENDING", "64")),
+    use_processes=os.getenv("CREDENTIAL_POOL", "thread") == "process"
+)
+
+user_pref_agent = UserPreferenceAgent(
+    db_pool,
+    cache_size=int(os.getenv("PROFILE_CACHE_SIZE", "10000")),
+    cache_ttl=float(os.getenv("PROFILE_CACHE_TTL", "300")),
+    notify_channel=os.getenv("PROFILE_CACHE_NOTIFY_CHANNEL"),
+    verifier=credential_pool
+)
+user_pref_agent.turn_writer = WriteBehindQueue(
+    user_pref_agent.append_turns,
+    spool_path=os.getenv("TURN_SPOOL_PATH", "conversation_turns.spool"),
+    batch_size=int(os.getenv("TURN_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("TURN_FLUSH_INTERVAL", "0.5")),
+    max_pending=int(os.getenv("TURN_MAX_PENDING", "10000"))
+)
+# Flush buffered turns and close the pool on shutdown
+atexit.register(user_pref_agent.close)
+
+# Session management: which user each session token is logged in as
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+if os.getenv("SESSION_BACKEND", "memory") == "postgres":
+    session_store = PostgresSessionStore(db_pool, idle_timeout=SESSION_IDLE_TIMEOUT)
+else:
+    session_store = InMemorySessionStore(
+        idle_timeout=SESSION_IDLE_TIMEOUT, max_sessions=int(os.getenv("SESSION_MAX", "100000"))
+    )
+
+# Token used when the caller doesn't pass one (e.g. the command-line REPL)
+DEFAULT_SESSION_ID = "default"
 
-# Update the Front-End Orchestration Function
-# Store a global session for simplicity
-# Global session management
-SESSION_USER_ID = None
+# Run a session-store call, off the event loop when the store does I/O
+@metrics.instrument("db.session_store")
+async def call_session_store(method, *args):
+    if session_store.blocking:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
 
-SESSION_USER_ID = None
+# Summaries being regenerated, one task per user at a time
+summary_tasks = {}
 
+# A user's history as prompt context: rolling summary plus recent turns, never more than HISTORY_CONTEXT_TOKENS.
+# When enough older turns have piled up, the summary is regenerated in the background for later turns.
+async def get_history_context(user_id: str) -> str:
+    window = await asyncio.to_thread(user_pref_agent.get_history_window, user_id)
+    if window is None:
+        return ""
+    if window["pending_tokens"] >= HISTORY_SUMMARY_THRESHOLD and user_id not in summary_tasks:
+        summary_tasks[user_id] = asyncio.ensure_future(refresh_history_summary(user_id, window))
+        summary_tasks[user_id].add_done_callback(lambda _: summary_tasks.pop(user_id, None))
+    parts = [f"Summary of the earlier conversation: {window['summary']}\n"] if window["summary"] else []
+    parts += [format_turn(message, response) for message, response in window["turns"]]
+    return "".join(parts)
 
-def front_end_agent_function(state: State) -> State:
-    global SESSION_USER_ID
+# Fold the window's pending turns into the stored summary with one uncached Gemini call
+async def refresh_history_summary(user_id: str, window: dict) -> None:
+    current_deadline.set(None)  # Runs after the turn, so the turn's deadline doesn't apply
+    transcript = "".join(format_turn(message, response) for _, message, response in window["pending"])
+    prompt = (
+        f"Summary of a conversation so far: {window['summary'] or '(none)'}\n"
+        f"Later turns:\n{transcript}\n"
+        f"Rewrite the summary to cover the later turns too, keeping facts about the user and their preferences. "
+        f"Use at most {HISTORY_SUMMARY_TOKENS} tokens."
+    )
+    summary = await generate_with_gemini(prompt)
+    if summary:
+        summary = summary[:HISTORY_SUMMARY_TOKENS * 4]  # Hold the summary to its budget even if Gemini doesn't
+        try:
+            await asyncio.to_thread(
+                user_pref_agent.save_history_summary,
+                user_id, summary, window["pending"][-1][0], window["summary_through_seq"]
+            )
+        except Exception as e:
+            # The pending turns stay pending and are summarized on a later turn
+            logger.warning("Could not save the history summary for %s - %s", user_id, e)
+
+
+# Database calls are blocking, so they run in a worker thread to keep the event loop free
+async def front_end_agent_function(state: State, config: RunnableConfig) -> dict:
     message = state["message"].strip().lower()
+    intents = state.get("intents", frozenset())
+    session_id = state.get("session_id") or DEFAULT_SESSION_ID
+    session_user_id = await call_session_store(session_store.get_user_id, session_id)
 
     # Handle signup
-    if "my name is" in message:
+    if "signup" in intents:
         name = message.split("my name is")[-1].strip()
-        user_id = str(hash(name.lower()))
-        SESSION_USER_ID = user_id
-        response = user_pref_agent.signup(user_id, name, "default_password")
-        if "successful" in response.lower():
-            state["final_response"] = response
-            user_pref_agent.update_conversation_history(user_id, message, response)
-        return state
+        user_id = stable_user_id(name)
+        await call_session_store(session_store.set_user_id, session_id, user_id)
+        try:
+            password_hash = await user_pref_agent.verifier.ahash("default_password")
+        except VerifierBusy:
+            return {"final_response": "We're busy right now. Please try signing up again in a moment."}
+        response = await asyncio.to_thread(user_pref_agent.create_user, user_id, name, password_hash)
+        if "successful" not in response.lower():
+            return {"final_response": ""}
+        await asyncio.to_thread(user_pref_agent.update_conversation_history, user_id, message, response)
+        return {"final_response": response}
 
     # Handle login
-    if "log me in" in message:
-        if SESSION_USER_ID:
-            user_name = user_pref_agent.get_user_name(SESSION_USER_ID)
+    if "login" in intents:
+        if session_user_id:
+            user_name = await asyncio.to_thread(user_pref_agent.get_user_name, session_user_id)
             if user_name:
                 response = f"Hi {user_name.capitalize()}! You're now logged in."
             else:
                 response = "I couldn't find your account. Please sign up first."
         else:
             response = "You need to provide your name to log in. Try: 'My name is [Your Name]'."
-        state["final_response"] = response
-        if SESSION_USER_ID:
-            user_pref_agent.update_conversation_history(SESSION_USER_ID, message, response)
-        return state
+        if session_user_id:
+            await asyncio.to_thread(user_pref_agent.update_conversation_history, session_user_id, message, response)
+        return {"final_response": response}
 
     # Handle "What is my name?"
-    if "what is my name" in message:
-        if SESSION_USER_ID:
-            user_name = user_pref_agent.get_user_name(SESSION_USER_ID)
+    if "whoami" in intents:
+        if session_user_id:
+            user_name = await asyncio.to_thread(user_pref_agent.get_user_name, session_user_id)
             response = f"Your name is {user_name.capitalize()}." if user_name else "I don't have your name stored. Please sign up first."
         else:
             response = "You are not logged in. Please sign up or log in first."
-        state["final_response"] = response
-        if SESSION_USER_ID:
-            user_pref_agent.update_conversation_history(SESSION_USER_ID, message, response)
-        return state
+        if session_user_id:
+            await asyncio.to_thread(user_pref_agent.update_conversation_history, session_user_id, message, response)
+        return {"final_response": response}
 
     # Handle conversation history retrieval
-    if "show my history" in message:
-        if SESSION_USER_ID:
-            response = user_pref_agent.get_conversation_history(SESSION_USER_ID)
+    if "history" in intents:
+        if session_user_id:
+            response = await asyncio.to_thread(user_pref_agent.get_conversation_history, session_user_id)
         else:
             response = "No session found. Please log in first."
-        state["final_response"] = response
-        return state
+        return {"final_response": response}
+
+    # Combine the responses of the agents that ran for this message
+    response_parts = []
+    if "greeting" in intents:
+        response_parts.append(state["greeting_response"])
+    if "joke" in intents:
+        response_parts.append(state["joke_response"])
+    if "weather" in intents:
+        response_parts.append(state["weather_response"])
+
+    if response_parts:
+        response = " ".join(response_parts)
+    else:
+        # Default: Let Gemini handle irrelevant queries, with a bounded view of the user's history
+        prompt = f"The user said: '{state['message']}'. Generate a helpful and polite response."
+        if session_user_id:
+            history_context = await get_history_context(session_user_id)
+            if history_context:
+                prompt = f"Conversation so far:\n{history_context}\n{prompt}"
+        gemini_response = await query_gemini_for_part(config, "final", prompt, "fallback")
+        response = gemini_response or "Sorry, I didn't understand that. Try logging in, signing up, or asking for help."
+    if session_user_id:
+        await asyncio.to_thread(user_pref_agent.update_conversation_history, session_user_id, message, response)
+    return {"final_response": response}
+
+
+# Front-end node: its answer is the "final" part of the streamed reply
+async def front_end_node(state: State, config: RunnableConfig) -> dict:
+    current_deadline.set(get_deadline(config))
+    update = await front_end_agent_function(state, config)
+    stream = get_response_stream(config)
+    if stream is not None:
+        stream.finish_part("final", update["final_response"])
+    return update
+
+
+# Durable graph checkpoints per session: CHECKPOINT_BACKEND=sqlite (CHECKPOINT_PATH) or postgres; off by default
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "").lower()
+
+def create_checkpointer():
+    max_age = float(os.getenv("CHECKPOINT_MAX_AGE", "86400"))
+    if CHECKPOINT_BACKEND == "sqlite":
+        from checkpoint import SQLiteCheckpointSaver
+        return SQLiteCheckpointSaver(os.getenv("CHECKPOINT_PATH", "graph_checkpoints.sqlite3"), max_age=max_age)
+    if CHECKPOINT_BACKEND == "postgres":
+        from checkpoint import PostgresCheckpointSaver
+        return PostgresCheckpointSaver(db_pool, max_age=max_age)
+    return None
+
+# Application factory: build and compile the graph; langgraph is only imported here
+def create_app(checkpointer=None):
+    from langgraph.graph import StateGraph
+    from langgraph.constants import START, END
+
+    # Create StateGraph with the defined state schema; callers pass a TurnInput and get a TurnOutput back
+    greeting_graph = StateGraph(state_schema=State, input=TurnInput, output=TurnOutput)
+
+    # Every node is timed under node.<name> (see metrics.py)
+    def add_timed_node(name: str, node_function, input=None) -> None:
+        greeting_graph.add_node(name, metrics.instrument(f"node.{name}")(node_function), input=input)
+
+    # Add nodes; the classifier and the agents read only their slice of the state
+    add_timed_node("IntentClassifier", intent_classifier_function, input=TurnInput)
+    add_timed_node("GreetingAgent", with_branch_timeout(
+        greeting_agent_function, "greeting", "Hello! How can I assist you today?"
+    ), input=AgentInput)
+    add_timed_node("WeatherAgent", with_branch_timeout(
+        weather_agent_function, "weather", "Could not fetch weather details at the moment. Please try again later."
+    ), input=AgentInput)
+    add_timed_node("JokeAgent", with_branch_timeout(
+        joke_agent_function, "joke", "What do you call fake spaghetti? An impasta!"
+    ), input=AgentInput)
+    add_timed_node("FrontEndAgent", front_end_node)
 
-    # Default: Let Gemini handle irrelevant queries
-    gemini_response = query_gemini(
-        f"The user said: '{state['message']}'. Generate a helpful and polite response."
+    # Define the workflow: classify first, then fan out to the needed agents in parallel
+    greeting_graph.add_edge(START, "IntentClassifier")
+    greeting_graph.add_conditional_edges(
+        "IntentClassifier", route_by_intent,
+        ["GreetingAgent", "JokeAgent", "WeatherAgent", "FrontEndAgent"]
     )
-    response = gemini_response or "Sorry, I didn't understand that. Try logging in, signing up, or asking for help."
-    state["final_response"] = response
-    if SESSION_USER_ID:
-        user_pref_agent.update_conversation_history(SESSION_USER_ID, message, response)
-    return state
-
-
-# Create StateGraph with the defined state schema
-greeting_graph = StateGraph(state_schema=State)
-
-# Add nodes
-greeting_graph.add_node("GreetingAgent", greeting_agent_function)
-greeting_graph.add_node("WeatherAgent", weather_agent_function)
-greeting_graph.add_node("JokeAgent", joke_agent_function)
-greeting_graph.add_node("FrontEndAgent", front_end_agent_function)
-
-# Define the workflow
-greeting_graph.add_edge(START, "GreetingAgent")  # Process greeting first
-greeting_graph.add_edge("GreetingAgent", "JokeAgent")  # Route to JokeAgent
-greeting_graph.add_edge("JokeAgent", "WeatherAgent")  # Route to WeatherAgent
-greeting_graph.add_edge("WeatherAgent", "FrontEndAgent")  # Pass weather to front-end
-greeting_graph.add_edge("FrontEndAgent", END)  # End workflow at front-end
-
-# Compile the graph
-compiled_graph = greeting_graph.compile()
-
-# Function to run the graph
-def run_greeting_agent(input_message: str) -> str:
-    # Prepare initial state
-    initial_state = {
+    greeting_graph.add_edge("GreetingAgent", "FrontEndAgent")  # Join at the front-end
+    greeting_graph.add_edge("JokeAgent", "FrontEndAgent")
+    greeting_graph.add_edge("WeatherAgent", "FrontEndAgent")
+    greeting_graph.add_edge("FrontEndAgent", END)  # End workflow at front-end
+
+    # Compile the graph
+    return greeting_graph.compile(checkpointer=checkpointer)
+
+# The process-wide compiled graph, created by the first turn
+compiled_graph = None
+_compiled_graph_lock = threading.Lock()
+
+def get_compiled_graph():
+    global compiled_graph
+    if compiled_graph is None:
+        with _compiled_graph_lock:
+            if compiled_graph is None:
+                compiled_graph = create_app(create_checkpointer())
+    return compiled_graph
+
+# Prepare the input of a turn; every other key is written by the node that owns it
+# session_id identifies the conversation; client_ip / location decide where weather is looked up
+def build_initial_state(input_message: str, session_id: str = DEFAULT_SESSION_ID,
+                        client_ip: str = None, location: str = None) -> TurnInput:
+    return {
         "message": input_message,
-        "greeting_response": "",
-        "weather_response": "",
-        "joke_response": "",
-        "final_response": ""
+        "session_id": session_id,
+        "client_ip": client_ip,
+        "location": location,
     }
-    result = compiled_graph.invoke(initial_state)
+
+# Config of one turn: its deadline, its checkpoint thread when the graph has a checkpointer,
+# and, when Gemini calls are batched, its prompt batch
+def build_turn_config(session_id: str = DEFAULT_SESSION_ID, batching: bool = None) -> dict:
+    turn = TurnContext(Deadline(TURN_DEADLINE_SECONDS))
+    configurable = {"turn": turn}
+    if batching is None:
+        batching = GEMINI_BATCHING
+    if get_compiled_graph().checkpointer is not None:
+        configurable["thread_id"] = session_id
+    if batching:
+        turn.prompt_batch = prompt_batcher.start_turn()
+    return {"configurable": configurable}
+
+# How many times a failing interrupted turn is retried before it is abandoned;
+# failures are counted per checkpoint, in this process
+CHECKPOINT_MAX_RESUMES = int(os.getenv("CHECKPOINT_MAX_RESUMES", "2"))
+resume_failures = TTLCache(max_size=10000, ttl=float(os.getenv("CHECKPOINT_MAX_AGE", "86400")))
+
+# A session's previous turn that stopped mid-graph (e.g. the worker died) is finished before the next one.
+# Nodes that completed are not re-run; returns that turn's reply, or None when there was nothing to resume.
+# A resume that fails is logged, never raised, so the session's new turn still runs; after
+# CHECKPOINT_MAX_RESUMES failures the interrupted turn is abandoned
+async def resume_interrupted_turn(session_id: str) -> str:
+    graph = get_compiled_graph()
+    if graph.checkpointer is None:
+        return None
+    config = build_turn_config(session_id, batching=False)  # Its prompts were planned by the run that died
+    snapshot = await graph.aget_state(config)
+    if not snapshot.next:
+        return None
+    key = (session_id, snapshot.config["configurable"].get("checkpoint_id"))
+    failures = resume_failures.get(key, 0)
+    if failures < CHECKPOINT_MAX_RESUMES:
+        logger.info("Resuming the interrupted turn of session %s at %s", session_id, snapshot.next)
+        try:
+            result = await graph.ainvoke(None, config)
+            return result["final_response"]
+        except Exception as e:
+            failures += 1
+            resume_failures.set(key, failures)
+            logger.warning("Resuming the interrupted turn of session %s failed (%d of %d) - %s",
+                           session_id, failures, CHECKPOINT_MAX_RESUMES, e)
+            if failures < CHECKPOINT_MAX_RESUMES:
+                return None
+    # Mark the turn as finished by the front-end, so the checkpoint has nothing left to run
+    logger.warning("Abandoning the interrupted turn of session %s at %s", session_id, snapshot.next)
+    try:
+        await graph.aupdate_state(config, None, as_node="FrontEndAgent")
+    except Exception as e:
+        logger.warning("Could not abandon the interrupted turn of session %s - %s", session_id, e)
+    resume_failures.invalidate(key)
+    return None
+
+# Function to run the graph without blocking the event loop
+@metrics.instrument("turn")
+async def run_greeting_agent_async(input_message: str, session_id: str = DEFAULT_SESSION_ID,
+                                   client_ip: str = None, location: str = None) -> str:
+    await resume_interrupted_turn(session_id)
+    initial_state = build_initial_state(input_message, session_id, client_ip, location)
+    result = await get_compiled_graph().ainvoke(initial_state, build_turn_config(session_id))
     return result["final_response"]
 
+# Run several turns through one abatch call; each turn is (message, session_id, client_ip, location).
+# Replies come back in order, with the exception in place of a turn that failed
+@metrics.instrument("turn_batch")
+async def run_greeting_agent_batch_async(turns: list) -> list:
+    await asyncio.gather(*(resume_interrupted_turn(session_id) for session_id in {turn[1] for turn in turns}))
+    states = [build_initial_state(*turn) for turn in turns]
+    configs = [build_turn_config(turn[1]) for turn in turns]
+    results = await get_compiled_graph().abatch(states, configs, return_exceptions=True)
+    return [result if isinstance(result, Exception) else result["final_response"] for result in results]
+
+# Function to stream the reply: yields text chunks as soon as any agent produces them
+async def stream_greeting_agent(input_message: str, session_id: str = DEFAULT_SESSION_ID,
+                                client_ip: str = None, location: str = None):
+    stream = ResponseStream()
+    await resume_interrupted_turn(session_id)
+    config = build_turn_config(session_id, batching=False)
+    config["configurable"]["turn"].response_stream = stream
+    initial_state = build_initial_state(input_message, session_id, client_ip, location)
+
+    async def run_graph():
+        try:
+            async for _ in get_compiled_graph().astream(initial_state, config, stream_mode="updates"):
+                pass
+        finally:
+            stream.finish()
+
+    graph_task = asyncio.ensure_future(run_graph())
+    async for chunk in stream:
+        yield chunk
+    await graph_task
+
+# Background event loop that serves sync callers, so they share one HTTP client
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="agent-loop", daemon=True).start()
+    return _background_loop
+
+# Function to run the graph: a thin sync wrapper around the async pipeline
+def run_greeting_agent(input_message: str, session_id: str = DEFAULT_SESSION_ID,
+                       client_ip: str = None, location: str = None) -> str:
+    future = asyncio.run_coroutine_threadsafe(
+        run_greeting_agent_async(input_message, session_id, client_ip, location), get_background_loop()
+    )
+    return future.result()
+
+# Sync counterpart of stream_greeting_agent, for the REPL and threaded servers
+def stream_greeting_agent_sync(input_message: str, session_id: str = DEFAULT_SESSION_ID,
+                               client_ip: str = None, location: str = None):
+    chunks = queue.Queue()
+
+    async def pump():
+        try:
+            async for chunk in stream_greeting_agent(input_message, session_id, client_ip, location):
+                chunks.put(chunk)
+        finally:
+            chunks.put(None)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_background_loop())
+    while (chunk := chunks.get()) is not None:
+        yield chunk
+    future.result()  # Re-raise anything that went wrong in the graph
+
 # Test the agents
 if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate"]:
+        migrate()
+        print("Database schema is up to date.")
+        sys.exit()
+
     print("Chatbot is running. Type 'exit' or 'quit' to end the conversation.")
     while True:
         user_message = input("You: ")
         if user_message.lower() in ["exit", "quit"]:
             print("Chatbot: Goodbye! Have a great day!")
             break
-        response = run_greeting_agent(user_message)
-        print(f"Chatbot: {response}")
+        print("Chatbot: ", end="", flush=True)
+        for chunk in stream_greeting_agent_sync(user_message):
+            print(chunk, end="", flush=True)
+        print()
 
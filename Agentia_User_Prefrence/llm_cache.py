@@ -0,0 +1,141 @@
+import re
+import time
+import random
+import asyncio
+import hashlib
+from cache import TTLCache, SQLiteStore, SingleFlight
+
+# Prompts that differ only in case, punctuation or spacing ("Hi!" vs "hi") share an entry. Minus signs and
+# decimal points of numbers are kept, so weather at -2.5°C and at 25°C never share one
+NON_WORD = re.compile(r"-(?!\d)|(?<!\d)\.|\.(?!\d)|[^\w\s.-]+")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    return WHITESPACE.sub(" ", NON_WORD.sub("", prompt.lower())).strip()
+
+
+# Caches LLM replies per prompt class: memory LRU with TTL, then an optional SQLite tier,
+# then a live call. Classes with more than one variant keep a pool of pre-generated
+# replies, filled in the background, and answer with a random one.
+class LLMResponseCache:
+    def __init__(self, generate, memory_size: int = 1024, ttl: float = 3600, disk_path: str = None,
+                 variants: dict = None, ttls: dict = None, disabled_classes=(), generate_stream=None):
+        self.generate = generate  # async (prompt) -> text, or None when no usable reply came back
+        # async (prompt, on_chunk) -> (text, complete); text is None when nothing was generated
+        self.generate_stream = generate_stream
+        self.ttl = ttl
+        self.ttls = ttls or {}  # Per-class TTL overrides
+        self.variants = variants or {}  # Per-class pool size; 1 when not listed
+        self.disabled_classes = set(disabled_classes)
+        self.memory = TTLCache(max_size=memory_size, ttl=ttl)
+        self.disk = SQLiteStore(disk_path, table="llm_responses") if disk_path else None
+        self.flight = SingleFlight()
+        self._filling = set()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.background_generations = 0
+
+    def _key(self, prompt: str, prompt_class: str) -> str:
+        digest = hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()
+        return f"{prompt_class}:{digest}"
+
+    # With on_chunk, the whole returned text is also delivered through it: streamed live on a
+    # miss, or as a single chunk when it comes from the cache
+    async def query(self, prompt: str, prompt_class: str = "default", on_chunk=None) -> str:
+        if prompt_class in self.disabled_classes:
+            self.bypassed += 1
+            reply, _ = await self._generate_live(prompt, on_chunk)
+            return reply
+
+        reply = await self.cached(prompt, prompt_class)
+        if reply is not None:
+            if on_chunk is not None:
+                on_chunk(reply)
+            return reply
+
+        key = self._key(prompt, prompt_class)
+        ttl = self.ttls.get(prompt_class, self.ttl)
+        self.misses += 1
+        if on_chunk is not None:
+            # A streaming caller wants its own live tokens, so it doesn't wait on another flight
+            reply, complete = await self._generate_live(prompt, on_chunk)
+            if complete:
+                await self._store(key, [reply], ttl)
+            return reply
+        reply = await self.flight.do(key, lambda: self.generate(prompt))
+        if reply is not None:  # Failures are never cached
+            await self._store(key, [reply], ttl)
+        return reply
+
+    # A cached reply for the prompt, or None without generating anything (misses aren't counted,
+    # the caller either generates through query or hands the reply back through remember)
+    async def cached(self, prompt: str, prompt_class: str = "default") -> str:
+        if prompt_class in self.disabled_classes:
+            return None
+        key = self._key(prompt, prompt_class)
+        ttl = self.ttls.get(prompt_class, self.ttl)
+        pool = self.memory.get(key)
+        if pool is not None:
+            self.memory_hits += 1
+        elif self.disk is not None:
+            # SQLite reads block, so they run off the event loop
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if entry is not None and time.time() - entry["created"] < ttl:
+                pool = entry["variants"]
+                self.memory.set(key, pool, ttl=ttl)
+                self.disk_hits += 1
+        if pool is None:
+            return None
+
+        if len(pool) < self.variants.get(prompt_class, 1) and key not in self._filling:
+            self._filling.add(key)
+            asyncio.ensure_future(self._fill_pool(key, prompt, pool, prompt_class, ttl))
+        return random.choice(pool)
+
+    # Store a reply that was generated elsewhere, e.g. as one field of a batched call
+    async def remember(self, prompt: str, prompt_class: str, reply: str) -> None:
+        if prompt_class in self.disabled_classes:
+            self.bypassed += 1
+            return
+        self.misses += 1
+        await self._store(self._key(prompt, prompt_class), [reply], self.ttls.get(prompt_class, self.ttl))
+
+    async def _generate_live(self, prompt: str, on_chunk) -> tuple:
+        if on_chunk is not None and self.generate_stream is not None:
+            return await self.generate_stream(prompt, on_chunk)
+        reply = await self.generate(prompt)
+        if reply is not None and on_chunk is not None:
+            on_chunk(reply)
+        return reply, reply is not None
+
+    # Generate the missing variants for a prompt without holding up the caller
+    async def _fill_pool(self, key: str, prompt: str, pool: list, prompt_class: str, ttl: float) -> None:
+        try:
+            missing = self.variants[prompt_class] - len(pool)
+            replies = await asyncio.gather(*(self.generate(prompt) for _ in range(missing)))
+            self.background_generations += missing
+            pool = pool + [reply for reply in replies if reply]
+            await self._store(key, pool, ttl)
+        finally:
+            self._filling.discard(key)
+
+    async def _store(self, key: str, pool: list, ttl: float) -> None:
+        self.memory.set(key, pool, ttl=ttl)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, {"created": time.time(), "variants": pool})
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "background_generations": self.background_generations,
+            "memory": self.memory.stats(),
+        }
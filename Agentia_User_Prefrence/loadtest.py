@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import resource
+import tempfile
+import threading
+from contextlib import contextmanager
+import psycopg2.errors
+import benchmark
+from benchmark import FakeGenerativeModel, load_agent
+from write_behind import WriteBehindQueue
+
+# Mixed-intent messages a session picks from after signing up
+CORPUS = [
+    "Hello!",
+    "Hi there, how are you?",
+    "Tell me a joke",
+    "Something funny please, I need a laugh",
+    "What's the weather like today?",
+    "Is it hot? What's the temperature?",
+    "Hey! Tell me a joke and the weather forecast",
+    "Good morning! What's the weather?",
+    "Can you recommend a good book?",
+    "What should I cook for dinner tonight?",
+    "What is my name?",
+    "Show my history",
+    "Log me in",
+]
+
+# Numbers compared against a baseline, and whether a higher value is better
+REGRESSION_METRICS = {"turns_per_second": True, "p50_ms": False, "p99_ms": False}
+
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS user_preferences (
+        user_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        password TEXT NOT NULL,
+        location TEXT,
+        conversation_history TEXT,
+        history_summary TEXT,
+        summary_through_seq INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS conversation_turns (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL REFERENCES user_preferences (user_id) ON DELETE CASCADE,
+        ts REAL NOT NULL,
+        message TEXT NOT NULL,
+        response TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS conversation_turns_user ON conversation_turns (user_id, seq);
+"""
+
+
+# psycopg2-style cursor over SQLite: %s placeholders, UniqueViolation on duplicate keys
+class SQLiteCursor:
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+
+    def execute(self, sql: str, params=()) -> None:
+        try:
+            self._cursor.execute(sql.replace("%s", "?"), params)
+        except sqlite3.IntegrityError as e:
+            raise psycopg2.errors.UniqueViolation(str(e)) from e
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self) -> list:
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+
+# Stand-in for database.ConnectionPool backed by one SQLite file, one connection per thread
+class SQLitePool:
+    def __init__(self, path: str):
+        self.path = path
+        self.connect_kwargs = {}
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.executescript(SQLITE_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @contextmanager
+    def cursor(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._lock:
+                self._connections.append(conn)
+        try:
+            yield SQLiteCursor(conn.cursor())
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def stats(self) -> dict:
+        return {"connections": len(self._connections)}
+
+    def closeall(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+
+# Point the agent at a throwaway SQLite database; only the batched turn insert needs SQLite-specific SQL
+def use_sqlite_database(agent, directory: str) -> None:
+    class SQLiteUserPreferenceAgent(agent.UserPreferenceAgent):
+        def append_turns(self, turns: list) -> None:
+            with self.pool.cursor() as cursor:
+                for user_id, ts, message, response in turns:
+                    # Unknown users have no history to append to
+                    cursor.execute(
+                        "INSERT INTO conversation_turns (user_id, ts, message, response) "
+                        "SELECT %s, %s, %s, %s WHERE EXISTS (SELECT 1 FROM user_preferences WHERE user_id = %s)",
+                        (user_id, ts, message, response, user_id)
+                    )
+
+    user_pref_agent = SQLiteUserPreferenceAgent(
+        SQLitePool(os.path.join(directory, "load_test.sqlite3")), verifier=agent.credential_pool
+    )
+    user_pref_agent.turn_writer = WriteBehindQueue(
+        user_pref_agent.append_turns, spool_path=os.path.join(directory, "conversation_turns.spool")
+    )
+    agent.user_pref_agent = user_pref_agent
+
+
+# One session: sign up, then a random walk through the corpus
+async def run_session(agent, session: str, turns: int, rng: random.Random, latencies: list) -> None:
+    messages = [f"My name is {session}"] + [rng.choice(CORPUS) for _ in range(turns - 1)]
+    for message in messages:
+        start = time.perf_counter()
+        await agent.run_greeting_agent_async(message, session_id=session)
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# Run `concurrency` sessions side by side and summarise their turns
+def run_level(agent, concurrency: int, turns_per_session: int, seed: int, run_id: str) -> dict:
+    latencies = []
+    rng = random.Random(seed)
+
+    async def run_all():
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            run_session(agent, f"load-{run_id}-{concurrency}-{n}", turns_per_session,
+                        random.Random(rng.random()), latencies)
+            for n in range(concurrency)
+        ))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run_all())
+    return {
+        "concurrency": concurrency,
+        "turns": len(latencies),
+        "seconds": elapsed,
+        "turns_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS; it is the peak of the whole process so far
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+# Regressions beyond tolerance (a fraction) against a saved baseline, one line each
+def compare_to_baseline(results: list, baseline: list, tolerance: float) -> list:
+    previous = {level["concurrency"]: level for level in baseline}
+    regressions = []
+    for level in results:
+        before = previous.get(level["concurrency"])
+        if before is None:
+            continue
+        for name, higher_is_better in REGRESSION_METRICS.items():
+            change = (level[name] - before[name]) / before[name] if before[name] else 0.0
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{level['concurrency']} sessions: {name} {before[name]:.1f} -> {level[name]:.1f} ({change:+.0%})"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline load test of run_greeting_agent_async")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--turns", type=int, default=10, help="Turns per session")
+    parser.add_argument("--gemini-latency", type=float, default=benchmark.GEMINI_LATENCY)
+    parser.add_argument("--http-latency", type=float, default=benchmark.HTTP_LATENCY)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the results here as the new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="Compare against this baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative change (default 0.2)")
+    args = parser.parse_args()
+
+    agent = load_agent()
+    agent.model = FakeGenerativeModel(latency=args.gemini_latency)
+    benchmark.HTTP_LATENCY = args.http_latency
+    use_sqlite_database(agent, tempfile.mkdtemp(prefix="loadtest-"))
+
+    run_id = f"{int(time.time())}"
+    results = []
+    print(f"{'sessions':>8} {'turns':>6} {'turns/s':>9} {'p50':>9} {'p99':>9} {'peak RSS':>9}")
+    for concurrency in args.concurrency:
+        level = run_level(agent, concurrency, args.turns, args.seed, run_id)
+        results.append(level)
+        print(f"{level['concurrency']:8} {level['turns']:6} {level['turns_per_second']:9.1f} "
+              f"{level['p50_ms']:7.1f}ms {level['p99_ms']:7.1f}ms {level['peak_rss_mb']:7.1f}MB")
+    agent.user_pref_agent.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
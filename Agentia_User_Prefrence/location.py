@@ -0,0 +1,127 @@
+import os
+import csv
+import mmap
+import struct
+import ipaddress
+from cache import TTLCache, SingleFlight
+
+# Binary layout: header, then fixed-width (start, end, city index) records sorted by start,
+# then the city names as newline-separated UTF-8
+TABLE_MAGIC = b"IPRT"
+HEADER = struct.Struct("<4sII")  # magic, record count, offset of the city block
+RECORD = struct.Struct("<III")   # first IPv4 address, last IPv4 address, city index
+
+UNKNOWN_LOCATION = "Unknown Location"
+
+
+# IPv4 range -> city table, memory-mapped and binary-searched so lookups never parse the file
+class IPRangeTable:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, cities_offset = HEADER.unpack_from(self._map, 0)
+        if magic != TABLE_MAGIC:
+            raise ValueError(f"{path} is not an IP range table")
+        self.cities = self._map[cities_offset:].decode("utf-8").split("\n")
+
+    # Compile a CSV of start_ip,end_ip,city rows into the binary table format
+    @staticmethod
+    def build(csv_path: str, table_path: str) -> None:
+        cities = []
+        city_index = {}
+        records = []
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith("#") or row[0] == "start_ip":
+                    continue
+                start, end, city = row[0].strip(), row[1].strip(), row[2].strip()
+                if city not in city_index:
+                    city_index[city] = len(cities)
+                    cities.append(city)
+                records.append((int(ipaddress.IPv4Address(start)), int(ipaddress.IPv4Address(end)), city_index[city]))
+        records.sort()
+
+        cities_offset = HEADER.size + RECORD.size * len(records)
+        with open(table_path, "wb") as f:
+            f.write(HEADER.pack(TABLE_MAGIC, len(records), cities_offset))
+            for record in records:
+                f.write(RECORD.pack(*record))
+            f.write("\n".join(cities).encode("utf-8"))
+
+    # Open the table for a CSV, recompiling the binary copy only when the CSV is newer
+    @classmethod
+    def from_csv(cls, csv_path: str) -> "IPRangeTable":
+        table_path = csv_path + ".bin"
+        if not os.path.exists(table_path) or os.path.getmtime(table_path) < os.path.getmtime(csv_path):
+            cls.build(csv_path, table_path)
+        return cls(table_path)
+
+    def lookup(self, ip: str) -> str:
+        try:
+            address = int(ipaddress.IPv4Address(ip))
+        except ValueError:
+            return None  # IPv6 and malformed addresses fall through to the remote lookup
+
+        # Find the last range starting at or before the address
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, _, _ = RECORD.unpack_from(self._map, HEADER.size + middle * RECORD.size)
+            if start <= address:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        start, end, city = RECORD.unpack_from(self._map, HEADER.size + (low - 1) * RECORD.size)
+        return self.cities[city] if address <= end else None
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+
+# The client IP worth asking ipinfo.io about, or None for loopback, private (LAN) and malformed addresses:
+# it can't place those, so the server's own location stands in for them
+def public_ip(client_ip: str) -> str:
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return None
+    return None if address.is_private or address.is_loopback else client_ip
+
+
+# Resolves a client's city: explicit location, then the local IP table, then a cached remote lookup
+class LocationResolver:
+    def __init__(self, remote_lookup, ip_table: IPRangeTable = None, ttl: float = 3600, max_size: int = 10000):
+        self.remote_lookup = remote_lookup  # async (client_ip or None) -> city
+        self.ip_table = ip_table
+        self.remote_cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.remote_flight = SingleFlight()
+        self.table_hits = 0
+
+    async def resolve(self, client_ip: str = None, explicit_location: str = None) -> str:
+        if explicit_location:
+            return explicit_location
+
+        # The local table may well map LAN ranges, so it sees every address
+        if client_ip and self.ip_table is not None:
+            city = self.ip_table.lookup(client_ip)
+            if city:
+                self.table_hits += 1
+                return city
+
+        client_ip = public_ip(client_ip) if client_ip else None
+
+        key = client_ip or "server"
+        city = self.remote_cache.get(key)
+        if city is None:
+            city = await self.remote_flight.do(key, lambda: self.remote_lookup(client_ip))
+            # Failed lookups are not cached so the next turn retries
+            if not city:
+                return UNKNOWN_LOCATION
+            self.remote_cache.set(key, city)
+        return city
+
+    def stats(self) -> dict:
+        return {"table_hits": self.table_hits, "remote": self.remote_cache.stats()}
@@ -0,0 +1,121 @@
+import time
+import heapq
+import asyncio
+import logging
+import threading
+from location import UNKNOWN_LOCATION
+
+logger = logging.getLogger(__name__)
+
+
+# Request counts that halve every half_life seconds, so the top keys follow what is asked for now
+class DecayedCounter:
+    def __init__(self, half_life: float = 3600.0, max_keys: int = 1000):
+        self.half_life = half_life
+        self.max_keys = max_keys  # The least requested keys are dropped beyond this
+        self._lock = threading.Lock()
+        self._epoch = time.monotonic()
+        self._scores = {}
+
+    # Weighting each new request by 2^(age / half_life) decays every older count without touching it
+    def _weight(self, now: float) -> float:
+        return 2 ** ((now - self._epoch) / self.half_life)
+
+    def add(self, key, count: float = 1.0) -> None:
+        now = time.monotonic()
+        with self._lock:
+            weight = self._weight(now)
+            if weight > 2 ** 64:
+                # Rebase before the weights overflow
+                self._scores = {k: score / weight for k, score in self._scores.items()}
+                self._epoch = now
+                weight = 1.0
+            self._scores[key] = self._scores.get(key, 0.0) + count * weight
+            if len(self._scores) > 2 * self.max_keys:
+                self._scores = dict(heapq.nlargest(self.max_keys, self._scores.items(), key=lambda item: item[1]))
+
+    # The k keys with the highest decayed counts, with those counts, highest first
+    def top(self, k: int) -> list:
+        with self._lock:
+            weight = self._weight(time.monotonic())
+            return [(key, score / weight)
+                    for key, score in heapq.nlargest(k, self._scores.items(), key=lambda item: item[1])]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+# Keeps the current weather of the most requested cities warm: every interval seconds the top_k cities
+# requested at least min_count times (decayed) are refreshed together in one batched upstream call
+class WeatherPrefetcher:
+    def __init__(self, locate, fetch_many, store, top_k: int = 20, interval: float = 300.0,
+                 half_life: float = 3600.0, min_count: float = 2.0):
+        self.locate = locate          # async city -> {"latitude", "longitude"} or empty
+        self.fetch_many = fetch_many  # async [(latitude, longitude)] -> [current weather or None]
+        self.store = store            # (latitude, longitude, current weather) -> None
+        self.top_k = top_k
+        self.interval = interval
+        self.min_count = min_count
+        self.counter = DecayedCounter(half_life=half_life, max_keys=max(100, 10 * top_k))
+        self._task = None
+        self._loop = None
+
+        self.refreshes = 0
+        self.cities_refreshed = 0
+        self.failures = 0
+
+    # Only real cities count; an unresolved location is never worth prefetching
+    def record(self, city: str) -> None:
+        if self.top_k > 0 and city and city != UNKNOWN_LOCATION:
+            self.counter.add(city.strip().lower())
+
+    # Start the refresh loop on the running event loop; a loop that takes over stops the old loop's task
+    def ensure_running(self) -> None:
+        if self.top_k <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            if self._task is not None and not self._task.done() and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._task.cancel)
+            self._task = loop.create_task(self._run())
+            self._loop = loop
+
+    def hot_cities(self) -> list:
+        return [city for city, count in self.counter.top(self.top_k) if count >= self.min_count]
+
+    # Refresh every hot city with one upstream request; returns how many were refreshed
+    async def refresh(self) -> int:
+        cities = self.hot_cities()
+        if not cities:
+            return 0
+        coordinates = await asyncio.gather(*(self.locate(city) for city in cities))
+        located = [(c["latitude"], c["longitude"]) for c in coordinates if c]
+        if not located:
+            return 0
+        refreshed = 0
+        for (latitude, longitude), current_weather in zip(located, await self.fetch_many(located)):
+            if current_weather:
+                self.store(latitude, longitude, current_weather)
+                refreshed += 1
+        self.refreshes += 1
+        self.cities_refreshed += refreshed
+        logger.debug("Prefetched weather for %d of %d hot cities", refreshed, len(cities))
+        return refreshed
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.failures += 1
+                logger.warning("Weather prefetch failed - %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "tracked_cities": len(self.counter),
+            "hot_cities": self.hot_cities(),
+            "refreshes": self.refreshes,
+            "cities_refreshed": self.cities_refreshed,
+            "failures": self.failures,
+        }
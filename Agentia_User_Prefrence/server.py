@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+from collections import deque
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 64 * 1024
+MAX_HEADER_LINES = 100
+
+STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout",
+}
+
+
+# Raised to a caller the batcher turns away; retry_after is a hint in seconds
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Coalesces requests that arrive within max_wait seconds into one run_batch call of at most max_batch_size.
+# At most max_concurrency batches run at once; while they are all busy, new requests queue and form bigger
+# batches. Requests are shed with Overloaded when max_queue are already waiting, or when one has waited
+# longer than max_queue_wait for a slot. Items with the same key (a session) never run together: one
+# waits in the queue, in order, until the batch holding the other has finished.
+class MicroBatcher:
+    def __init__(self, run_batch, max_batch_size: int = 32, max_wait: float = 0.005, max_concurrency: int = 4,
+                 max_queue: int = 1000, max_queue_wait: float = 5.0, key=None):
+        self.run_batch = run_batch  # async [item] -> [result or exception], in order
+        self.key = key  # item -> hashable, or None when any items may share a batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self._queue = deque()  # (item, future, enqueued at)
+        self._running_keys = set()  # Keys of the items in running batches
+        self._arrived = None
+        self._slots = None
+        self._dispatcher = None
+        self._tasks = set()
+
+        self.accepted = 0
+        self.shed = 0
+        self.expired = 0
+        self.held = 0
+        self.batches = 0
+        self.batched_items = 0
+        self.max_batch_seen = 0
+
+    def start(self) -> None:
+        if self._dispatcher is None:
+            self._arrived = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, item):
+        self.start()
+        if len(self._queue) >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(f"{len(self._queue)} requests already queued", retry_after=self._retry_after())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((item, future, time.monotonic()))
+        self.accepted += 1
+        self._arrived.set()
+        return await future
+
+    # Roughly how long the queue ahead takes to drain at one max_wait per batch
+    def _retry_after(self) -> float:
+        return max(1.0, len(self._queue) / (self.max_batch_size * self.max_concurrency) * self.max_wait)
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self._arrived.wait()
+            await self._slots.acquire()
+            # Let more requests join unless the batch is already full
+            if len(self._queue) < self.max_batch_size:
+                await asyncio.sleep(self.max_wait)
+            batch = self._take_batch()
+            if len(batch) < self.max_batch_size:
+                # Whatever is still queued waits on a running batch of its session, which wakes us when it ends
+                self._arrived.clear()
+            if not batch:
+                self._slots.release()
+                continue
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _take_batch(self) -> list:
+        batch, held = [], deque()
+        now = time.monotonic()
+        while self._queue and len(batch) < self.max_batch_size:
+            item, future, enqueued = entry = self._queue.popleft()
+            if future.done():
+                continue  # The caller gave up, e.g. the client disconnected
+            if now - enqueued > self.max_queue_wait:
+                self.expired += 1
+                future.set_exception(Overloaded(f"Queued for {now - enqueued:.1f}s"))
+                continue
+            key = self.key(item) if self.key is not None else None
+            if key is not None and key in self._running_keys:
+                # Its session already has a turn in this batch or a running one; it goes in a later batch
+                self.held += 1
+                held.append(entry)
+                continue
+            if key is not None:
+                self._running_keys.add(key)
+            batch.append((item, future))
+        held.extend(self._queue)
+        self._queue = held
+        return batch
+
+    async def _run(self, batch: list) -> None:
+        try:
+            self.batches += 1
+            self.batched_items += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            try:
+                results = await self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            if self.key is not None:
+                self._running_keys.difference_update(self.key(item) for item, _ in batch)
+                if self._queue:
+                    self._arrived.set()  # Turns held back for these sessions can go now
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "running_batches": len(self._tasks),
+            "accepted": self.accepted,
+            "shed": self.shed,
+            "expired": self.expired,
+            "held": self.held,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+        }
+
+
+# Minimal HTTP/1.1 chat server on asyncio streams, with keep-alive:
+#   POST /chat  {"message": ..., "session_id": ..., "location": ...} -> {"reply": ..., "session_id": ...}
+#   GET /healthz                                                     -> batcher stats
+#   GET /metrics                                                     -> latency histograms, Prometheus text
+# A request without a session_id starts a new session, whose id comes back in the reply.
+# X-Forwarded-For is only honoured when the peer is one of trusted_proxies
+class ChatServer:
+    def __init__(self, agent, batcher: MicroBatcher, trusted_proxies=()):
+        self.agent = agent
+        self.batcher = batcher
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000):
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self) -> None:
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.batcher.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload, extra_headers = await self._route(method, path, headers, body, peer)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, payload, extra_headers, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError as e:
+            self._write_response(writer, 400, {"error": str(e)}, {}, keep_alive=False)
+        finally:
+            writer.close()
+
+    # (method, path, lowercased headers, body), or None when the client closed the connection
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ValueError("Malformed request line")
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("Too many headers")
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise ValueError(f"Body larger than {MAX_BODY_BYTES} bytes")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), urlsplit(target).path, headers, body
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes, peer) -> tuple:
+        if path == "/chat":
+            if method != "POST":
+                return 405, {"error": "Use POST"}, {}
+            return await self._chat(headers, body, peer)
+        if path == "/healthz":
+            return 200, {"status": "ok", "batcher": self.batcher.stats()}, {}
+        if path == "/metrics":
+            from metrics import metrics
+            return 200, metrics.to_prometheus(), {"Content-Type": "text/plain; version=0.0.4"}
+        return 404, {"error": f"No route for {path}"}, {}
+
+    async def _chat(self, headers: dict, body: bytes, peer) -> tuple:
+        try:
+            request = json.loads(body or b"{}")
+            message = request["message"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": 'Expected a JSON body with a "message"'}, {}
+        if not isinstance(message, str) or not message.strip():
+            return 400, {"error": '"message" must be a non-empty string'}, {}
+        for field in ("session_id", "location"):
+            if request.get(field) is not None and not isinstance(request[field], str):
+                return 400, {"error": f'"{field}" must be a string'}, {}
+        client_ip = peer[0] if peer else None
+        if client_ip in self.trusted_proxies:
+            # Behind our own proxy the client is the first X-Forwarded-For hop
+            client_ip = headers.get("x-forwarded-for", "").split(",")[0].strip() or client_ip
+        # Anonymous clients never share a session: each one gets its own token
+        session_id = request.get("session_id") or uuid.uuid4().hex
+        turn = (message, session_id, client_ip, request.get("location"))
+        try:
+            reply = await self.batcher.submit(turn)
+        except Overloaded as e:
+            return 503, {"error": str(e)}, {"Retry-After": str(int(e.retry_after + 0.5))}
+        except asyncio.TimeoutError:
+            return 504, {"error": "The turn ran out of time"}, {}
+        except Exception as e:
+            logger.error("Turn failed: %s", e)
+            return 500, {"error": "The turn failed"}, {}
+        return 200, {"reply": reply, "session_id": session_id}, {}
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, payload, extra_headers: dict,
+                        keep_alive: bool) -> None:
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json", **extra_headers, "Content-Length": str(len(body)),
+                   "Connection": "keep-alive" if keep_alive else "close"}
+        head = f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in headers.items()
+        )
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+
+
+def create_server(agent, max_batch_size: int = None, max_wait: float = None, max_concurrency: int = None,
+                  max_queue: int = None) -> ChatServer:
+    batcher = MicroBatcher(
+        agent.run_greeting_agent_batch_async,
+        max_batch_size=max_batch_size or int(os.getenv("SERVER_MAX_BATCH_SIZE", "32")),
+        max_wait=max_wait if max_wait is not None else float(os.getenv("SERVER_BATCH_WAIT", "0.005")),
+        max_concurrency=max_concurrency or int(os.getenv("SERVER_MAX_CONCURRENT_BATCHES", "4")),
+        max_queue=max_queue or int(os.getenv("SERVER_MAX_QUEUE", "1000")),
+        max_queue_wait=float(os.getenv("SERVER_MAX_QUEUE_WAIT", "5")),
+        key=lambda turn: turn[1]  # One turn per session at a time, so turns never share a checkpoint
+    )
+    trusted_proxies = [ip.strip() for ip in os.getenv("SERVER_TRUSTED_PROXIES", "").split(",") if ip.strip()]
+    return ChatServer(agent, batcher, trusted_proxies)
+
+
+async def serve(host: str, port: int) -> None:
+    import greeting_agent
+
+    server = create_server(greeting_agent)
+    host, port = await server.start(host, port)
+    print(f"Serving chat on http://{host}:{port}/chat")
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP front end for the User Preference agent")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "8000")))
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,113 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+# Compact per-session record
+class Session:
+    __slots__ = ("user_id", "last_seen")
+
+    def __init__(self, user_id: str = None):
+        self.user_id = user_id
+        self.last_seen = time.monotonic()
+
+
+# Sessions held in this process, evicted after idle_timeout seconds without a turn
+class InMemorySessionStore:
+    blocking = False  # Calls never do I/O, so they can run on the event loop
+
+    def __init__(self, idle_timeout: float = 1800, max_sessions: int = 100000):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # token -> Session, least recently seen first
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get_user_id(self, token: str) -> str:
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            session.last_seen = time.monotonic()
+            self._sessions.move_to_end(token)
+            return session.user_id
+
+    def set_user_id(self, token: str, user_id: str) -> None:
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                session = self._sessions[token] = Session(user_id)
+            else:
+                session.user_id = user_id
+                session.last_seen = time.monotonic()
+            self._sessions.move_to_end(token)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def end_session(self, token: str) -> None:
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    # Sessions are ordered by last use, so only the idle ones at the front are ever visited
+    def _evict_idle(self) -> None:
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            token, session = next(iter(self._sessions.items()))
+            if session.last_seen > cutoff:
+                break
+            del self._sessions[token]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"active_sessions": len(self._sessions), "evictions": self.evictions}
+
+
+# Sessions shared by every worker through a Postgres table (see initialize_database)
+class PostgresSessionStore:
+    blocking = True  # Every call is a database round trip
+
+    def __init__(self, pool, idle_timeout: float = 1800):
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+
+    # Look up and touch the session in one round trip; idle sessions read as missing
+    def get_user_id(self, token: str) -> str:
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "UPDATE chat_sessions SET last_seen = now() "
+                "WHERE token = %s AND last_seen > now() - make_interval(secs => %s) RETURNING user_id",
+                (token, self.idle_timeout)
+            )
+            result = cursor.fetchone()
+        return result[0] if result else None
+
+    def set_user_id(self, token: str, user_id: str) -> None:
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO chat_sessions (token, user_id) VALUES (%s, %s) "
+                "ON CONFLICT (token) DO UPDATE SET user_id = EXCLUDED.user_id, last_seen = now()",
+                (token, user_id)
+            )
+
+    def end_session(self, token: str) -> None:
+        with self.pool.cursor() as cursor:
+            cursor.execute("DELETE FROM chat_sessions WHERE token = %s", (token,))
+
+    # Idle rows are ignored by get_user_id; call this periodically to reclaim them
+    def evict_idle(self) -> int:
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM chat_sessions WHERE last_seen <= now() - make_interval(secs => %s)",
+                (self.idle_timeout,)
+            )
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM chat_sessions WHERE last_seen > now() - make_interval(secs => %s)",
+                (self.idle_timeout,)
+            )
+            return {"active_sessions": cursor.fetchone()[0]}
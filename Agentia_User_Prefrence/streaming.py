@@ -0,0 +1,64 @@
+import asyncio
+
+
+# Streams one turn's reply as it is generated. The reply is made of named parts (one per agent,
+# or "final" for the front-end); parts are written concurrently but read back in the order they
+# appear in final_response, separated by a space.
+class ResponseStream:
+    def __init__(self):
+        self._parts = {}      # part name -> asyncio.Queue of text chunks, None ends the part
+        self._written = {}    # part name -> every chunk written into it so far
+        self._finished = set()
+        self._order = []
+        self._planned = asyncio.Event()
+
+    def _queue(self, part: str) -> asyncio.Queue:
+        if part not in self._parts:
+            self._parts[part] = asyncio.Queue()
+        return self._parts[part]
+
+    # Declare which parts make up the reply, in order
+    def plan(self, parts: list) -> None:
+        self._order = list(parts)
+        self._planned.set()
+
+    def write(self, part: str, text: str) -> None:
+        if text and part not in self._finished:
+            self._written.setdefault(part, []).append(text)
+            self._queue(part).put_nowait(text)
+
+    # The text already streamed into a part, or None if nothing was
+    def written(self, part: str) -> str:
+        chunks = self._written.get(part)
+        return "".join(chunks).strip() if chunks else None
+
+    # End a part; text is written first only if nothing was streamed into it
+    def finish_part(self, part: str, text: str = None) -> None:
+        if part in self._finished:
+            return
+        if part not in self._written:
+            self.write(part, text)
+        self._finished.add(part)
+        self._queue(part).put_nowait(None)
+
+    # End every part so readers never wait on a branch that failed or never ran
+    def finish(self) -> None:
+        for part in self._order:
+            self.finish_part(part)
+        self._planned.set()
+
+    async def __aiter__(self):
+        await self._planned.wait()
+        started = False
+        for part in self._order:
+            queue = self._queue(part)
+            first_chunk = True
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                if first_chunk and started:
+                    yield " "
+                first_chunk = False
+                started = True
+                yield chunk
@@ -0,0 +1,200 @@
+import re
+import zlib
+
+WORD = re.compile(r"[a-z0-9']+")
+
+# Open-Meteo weather codes grouped by what they mean for the advice line
+WEATHER_GROUPS = {
+    0: "clear", 1: "clear", 2: "cloudy", 3: "cloudy", 45: "fog", 48: "fog",
+    51: "drizzle", 53: "drizzle", 55: "drizzle", 61: "rain", 63: "rain", 65: "rain",
+    71: "snow", 73: "snow", 75: "snow", 80: "rain", 81: "rain", 82: "rain",
+    95: "storm", 96: "storm", 99: "storm",
+}
+
+# Upper bound (exclusive, °C) of each temperature band
+TEMPERATURE_BANDS = [(0, "freezing"), (10, "cold"), (18, "cool"), (26, "mild"), (32, "warm"), (float("inf"), "hot")]
+
+TONES = ("friendly", "concise", "formal")
+
+# Per locale: a noun phrase per weather code, a few clauses per temperature band, advice per tone and
+# weather group or band (the concise tone gives none), and sentence templates per tone.
+# Every list is a set of interchangeable variants
+PHRASEBOOK = {
+    "en": {
+        "decimal": ".",
+        "conditions": {
+            0: "clear skies", 1: "mostly clear skies", 2: "partly cloudy skies", 3: "overcast skies",
+            45: "fog", 48: "freezing fog", 51: "light drizzle", 53: "drizzle", 55: "heavy drizzle",
+            61: "light rain", 63: "rain", 65: "heavy rain", 71: "light snow", 73: "snow", 75: "heavy snow",
+            80: "light showers", 81: "rain showers", 82: "violent rain showers", 95: "thunderstorms",
+            96: "thunderstorms with some hail", 99: "thunderstorms with heavy hail",
+        },
+        "unknown": "unsettled weather",
+        "bands": {
+            "freezing": ["it's well below freezing", "it's freezing out there"],
+            "cold": ["it's pretty cold", "it's on the chilly side"],
+            "cool": ["it's a little cool", "it's fresh out"],
+            "mild": ["it's pleasantly mild", "it's comfortable out"],
+            "warm": ["it's nice and warm", "it's warm out"],
+            "hot": ["it's hot out there", "it's a hot one"],
+        },
+        "advice": {
+            "friendly": {
+                "drizzle": ["A light jacket should do.", "Keep an umbrella handy."],
+                "rain": ["An umbrella would be a good idea.", "Keep an umbrella handy."],
+                "snow": ["Watch your step out there.", "Mind the slippery paths."],
+                "storm": ["Best to stay indoors if you can.", "Keep clear of open ground."],
+                "fog": ["Take care on the roads.", "Visibility is low, so go carefully."],
+                "freezing": ["Dress warmly.", "Wrap up well."],
+                "hot": ["Stay hydrated.", "Keep to the shade if you can."],
+            },
+            "formal": {
+                "drizzle": ["A waterproof layer is advisable."],
+                "rain": ["An umbrella is advisable."],
+                "snow": ["Please take care on icy surfaces."],
+                "storm": ["Staying indoors is recommended."],
+                "fog": ["Reduced visibility is expected; please travel with care."],
+                "freezing": ["Warm clothing is recommended."],
+                "hot": ["Please stay hydrated and avoid prolonged sun exposure."],
+            },
+        },
+        "tones": {
+            "friendly": [
+                "Right now {location} has {condition} and {temperature}°C, so {band}.{advice}",
+                "It's {temperature}°C in {location} with {condition}, so {band}.{advice}",
+                "{location} is looking at {condition} and {temperature}°C at the moment; {band}.{advice}",
+            ],
+            "concise": [
+                "{location}: {condition}, {temperature}°C.",
+                "{Condition} in {location}, {temperature}°C.",
+            ],
+            "formal": [
+                "Current conditions in {location}: {condition}, with a temperature of {temperature}°C.{advice}",
+                "The present weather in {location} is {condition} at {temperature}°C.{advice}",
+            ],
+        },
+    },
+    "es": {
+        "decimal": ",",
+        "conditions": {
+            0: "cielo despejado", 1: "cielo mayormente despejado", 2: "cielo parcialmente nublado",
+            3: "cielo cubierto", 45: "niebla", 48: "niebla helada", 51: "llovizna ligera", 53: "llovizna",
+            55: "llovizna intensa", 61: "lluvia ligera", 63: "lluvia", 65: "lluvia intensa", 71: "nevada ligera",
+            73: "nieve", 75: "nevada intensa", 80: "chubascos ligeros", 81: "chubascos", 82: "chubascos violentos",
+            95: "tormentas", 96: "tormentas con granizo leve", 99: "tormentas con granizo fuerte",
+        },
+        "unknown": "tiempo variable",
+        "bands": {
+            "freezing": ["hace un frío helador", "estamos bajo cero"],
+            "cold": ["hace bastante frío", "hace frío"],
+            "cool": ["está fresco", "se nota fresco"],
+            "mild": ["la temperatura es agradable", "se está bien"],
+            "warm": ["hace un calor agradable", "hace calorcito"],
+            "hot": ["hace mucho calor", "hace un calor intenso"],
+        },
+        "advice": {
+            "friendly": {
+                "drizzle": ["Una chaqueta ligera bastará.", "Ten el paraguas a mano."],
+                "rain": ["Conviene llevar paraguas.", "Ten el paraguas a mano."],
+                "snow": ["Cuidado al caminar.", "Ojo con el suelo resbaladizo."],
+                "storm": ["Mejor quedarse en casa si es posible.", "Evita los espacios abiertos."],
+                "fog": ["Precaución en la carretera.", "Hay poca visibilidad, ve con cuidado."],
+                "freezing": ["Abrígate bien.", "Sal bien abrigado."],
+                "hot": ["Mantente hidratado.", "Busca la sombra si puedes."],
+            },
+            "formal": {
+                "drizzle": ["Se recomienda una prenda impermeable."],
+                "rain": ["Se recomienda llevar paraguas."],
+                "snow": ["Se ruega precaución con el hielo."],
+                "storm": ["Se recomienda permanecer en interiores."],
+                "fog": ["Visibilidad reducida; circule con precaución."],
+                "freezing": ["Se recomienda ropa de abrigo."],
+                "hot": ["Se recomienda hidratarse y evitar la exposición prolongada al sol."],
+            },
+        },
+        "tones": {
+            "friendly": [
+                "Ahora mismo en {location} hay {condition} y {temperature} °C, así que {band}.{advice}",
+                "En {location} hay {temperature} °C y {condition}: {band}.{advice}",
+            ],
+            "concise": [
+                "{location}: {condition}, {temperature} °C.",
+            ],
+            "formal": [
+                "Condiciones actuales en {location}: {condition}, con una temperatura de {temperature} °C.{advice}",
+            ],
+        },
+    },
+}
+
+
+def temperature_band(temperature: float) -> str:
+    return next(band for upper, band in TEMPERATURE_BANDS if temperature < upper)
+
+
+# Words that carry no request of their own in a plain "what's the weather like?" message
+PLAIN_REQUEST_WORDS = frozenset("""
+    a an the and or but me my i i'm you your we us it it's its is are was be please pls can could would will
+    what what's whats how how's hows tell give show get let know about for of to in at on like today today's
+    tonight now right current currently outside out here there again also too some any just quick check do
+    does thanks thank ok okay so one
+""".split())
+
+
+# Whether a message asks for more than a plain answer, so it needs Gemini to answer it freely.
+# Words of the intent trigger phrases count as plain, so "hello, tell me a joke and the weather" is plain
+class FreeFormDetector:
+    def __init__(self, known_phrases):
+        self.words = PLAIN_REQUEST_WORDS | {word for phrase in known_phrases for word in WORD.findall(phrase.lower())}
+
+    def __call__(self, message: str) -> bool:
+        return any(word not in self.words for word in WORD.findall(message.lower()))
+
+
+# Local weather sentences from the structured facts, in place of asking Gemini to reword them.
+# The variant of each slot is picked from a hash of the seed (e.g. the session) and the facts, so a
+# reply is deterministic for the same inputs while different sessions hear different phrasings
+class WeatherTemplates:
+    def __init__(self, locale: str = "en", tone: str = "friendly"):
+        self.locale = self._check_locale(locale)
+        self.tone = self._check_tone(tone)
+        self.rendered = 0
+
+    @staticmethod
+    def _check_locale(locale: str) -> str:
+        if locale not in PHRASEBOOK:
+            raise ValueError(f"No weather phrasebook for locale {locale!r}; have {sorted(PHRASEBOOK)}")
+        return locale
+
+    @staticmethod
+    def _check_tone(tone: str) -> str:
+        if tone not in TONES:
+            raise ValueError(f"Unknown tone {tone!r}; use one of {TONES}")
+        return tone
+
+    @staticmethod
+    def _pick(variants: list, seed: str, slot: str):
+        return variants[zlib.crc32(f"{seed}|{slot}".encode("utf-8")) % len(variants)]
+
+    def render(self, location: str, temperature: float, weather_code: int, seed: str = "",
+               tone: str = None, locale: str = None) -> str:
+        phrases = PHRASEBOOK[self._check_locale(locale) if locale else self.locale]
+        tone = self._check_tone(tone) if tone else self.tone
+        band = temperature_band(temperature)
+        seed = f"{seed}|{location}|{weather_code}|{band}"
+
+        condition = phrases["conditions"].get(weather_code, phrases["unknown"])
+        advice_by_group = phrases["advice"].get(tone, {})
+        advice = advice_by_group.get(WEATHER_GROUPS.get(weather_code)) or advice_by_group.get(band)
+        self.rendered += 1
+        return self._pick(phrases["tones"][tone], seed, "sentence").format(
+            location=location,
+            condition=condition,
+            Condition=condition[:1].upper() + condition[1:],
+            temperature=f"{temperature:g}".replace(".", phrases["decimal"]),
+            band=self._pick(phrases["bands"][band], seed, "band"),
+            advice=" " + self._pick(advice, seed, "advice") if advice else "",
+        )
+
+    def stats(self) -> dict:
+        return {"locale": self.locale, "tone": self.tone, "rendered": self.rendered}
@@ -0,0 +1,49 @@
+import asyncio
+
+from server import MicroBatcher
+
+
+# Fake run_batch recording each batch; every item takes `latency` seconds
+class FakeBatchRunner:
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.batches = []
+
+    async def __call__(self, items: list) -> list:
+        self.batches.append(items)
+        await asyncio.sleep(self.latency)
+        return items
+
+
+def run(batcher: MicroBatcher, items: list) -> list:
+    async def submit_all():
+        try:
+            return await asyncio.wait_for(asyncio.gather(*(batcher.submit(item) for item in items)), 5)
+        finally:
+            await batcher.close()
+
+    return asyncio.run(submit_all())
+
+
+def test_turns_of_one_session_never_share_or_overlap_a_batch():
+    runner = FakeBatchRunner()
+    batcher = MicroBatcher(runner, max_batch_size=4, key=lambda turn: turn[1])
+    turns = [(n, session) for n, session in enumerate("aabacbbd")]
+    assert run(batcher, turns) == turns
+
+    for batch in runner.batches:
+        sessions = [session for _, session in batch]
+        assert len(sessions) == len(set(sessions))
+    # Each session's turns still run in the order they arrived
+    order = [turn for batch in runner.batches for turn in batch]
+    for session in "abcd":
+        assert [n for n, s in order if s == session] == [n for n, s in turns if s == session]
+    assert batcher.stats()["held"] > 0
+
+
+def test_without_a_key_everything_batches_together():
+    runner = FakeBatchRunner()
+    batcher = MicroBatcher(runner, max_batch_size=8)
+    turns = [(n, "a") for n in range(4)]
+    assert run(batcher, turns) == turns
+    assert runner.batches == [turns]
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import httpx
+import pytest
+
+import benchmark
+from upstream import Upstream, Deadline, RetryableStatus, UpstreamUnavailable, current_deadline
+
+
+# Fake server answering from a script of (latency, status) per request; the last entry repeats
+class FakeServer:
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        latency, status = self.script[min(self.requests, len(self.script) - 1)]
+        self.requests += 1
+        await asyncio.sleep(latency)
+        return httpx.Response(status, json={"ok": status == 200})
+
+    def get(self, upstream: Upstream, deadline: Deadline = None):
+        async def run():
+            current_deadline.set(deadline)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(self.handler)) as client:
+                return await upstream.get(client, "https://fake.test/")
+
+        return asyncio.run(run())
+
+
+def make_upstream(**options) -> Upstream:
+    options = {"attempts": 3, "timeout": 1.0, "backoff": 0.001, "max_backoff": 0.01, **options}
+    return Upstream("fake", **options)
+
+
+def test_transient_errors_are_retried():
+    server = FakeServer((0.0, 503), (0.0, 502), (0.0, 200))
+    upstream = make_upstream()
+    assert server.get(upstream).status_code == 200
+    assert server.requests == 3
+    assert upstream.stats()["retries"] == 2
+    assert upstream.stats()["failures"] == 0
+
+
+def test_slow_attempt_is_retried_after_its_timeout():
+    server = FakeServer((0.5, 200), (0.0, 200))
+    upstream = make_upstream(timeout=0.1)
+    assert server.get(upstream).status_code == 200
+    assert server.requests == 2
+    assert upstream.retries == 1
+
+
+def test_gives_up_after_its_attempts():
+    server = FakeServer((0.0, 503))
+    upstream = make_upstream()
+    with pytest.raises(RetryableStatus):
+        server.get(upstream)
+    assert server.requests == 3
+    assert upstream.retries == 2
+    assert upstream.failures == 1
+
+
+def test_other_statuses_are_returned_without_retrying():
+    server = FakeServer((0.0, 404))
+    upstream = make_upstream()
+    assert server.get(upstream).status_code == 404
+    assert server.requests == 1
+    assert upstream.breaker.state == "closed"
+
+
+def test_breaker_opens_and_refuses_calls():
+    server = FakeServer((0.0, 503))
+    upstream = make_upstream(attempts=1, failure_threshold=2, reset_timeout=60.0)
+    for _ in range(2):
+        with pytest.raises(RetryableStatus):
+            server.get(upstream)
+    assert upstream.breaker.state == "open"
+
+    with pytest.raises(UpstreamUnavailable):
+        server.get(upstream)
+    assert server.requests == 2
+    assert upstream.stats()["opens"] == 1
+    assert upstream.stats()["rejected"] == 1
+
+
+def test_breaker_closes_after_a_successful_probe():
+    server = FakeServer((0.0, 503), (0.0, 200))
+    upstream = make_upstream(attempts=1, failure_threshold=1, reset_timeout=0.05)
+    with pytest.raises(RetryableStatus):
+        server.get(upstream)
+    assert upstream.breaker.state == "open"
+
+    time.sleep(0.06)
+    assert server.get(upstream).status_code == 200
+    assert upstream.breaker.state == "closed"
+
+
+def test_deadline_cuts_off_a_hanging_upstream():
+    server = FakeServer((30.0, 200))
+    upstream = make_upstream(timeout=5.0)
+    start = time.perf_counter()
+    with pytest.raises((asyncio.TimeoutError, UpstreamUnavailable)):
+        server.get(upstream, Deadline(0.2))
+    assert time.perf_counter() - start < 1.0
+    assert server.requests == 1
+
+
+def test_no_call_once_the_deadline_has_passed():
+    server = FakeServer((0.0, 200))
+    upstream = make_upstream()
+    with pytest.raises(UpstreamUnavailable):
+        server.get(upstream, Deadline(0.0))
+    assert server.requests == 0
+    assert upstream.breaker.state == "closed"
+
+
+# Gemini streams: the agent module with a fake model whose chunks arrive over `latency` seconds
+@pytest.fixture
+def agent(monkeypatch):
+    agent = benchmark.load_agent()
+    monkeypatch.setattr(agent, "model", benchmark.FakeGenerativeModel(latency=2.0))
+    agent.gemini_upstream.breaker.record_success()
+    yield agent
+    agent.gemini_upstream.breaker.record_success()
+
+
+def stream(agent, deadline: Deadline = None):
+    chunks = []
+
+    async def run():
+        current_deadline.set(deadline)
+        return await agent.stream_with_gemini("Tell me a joke", chunks.append)
+
+    start = time.perf_counter()
+    text, complete = asyncio.run(run())
+    return text, complete, chunks, time.perf_counter() - start
+
+
+def test_stream_is_cut_off_by_the_deadline(agent):
+    text, complete, chunks, elapsed = stream(agent, Deadline(0.6))
+    assert elapsed < 1.0
+    assert not complete
+    assert chunks and text == "".join(chunks).strip()
+    # The turn ran out of time; Gemini itself didn't fail
+    assert agent.gemini_upstream.breaker.failures == 0
+
+
+def test_stream_timeout_counts_as_a_failure(agent, monkeypatch):
+    monkeypatch.setattr(agent.gemini_upstream, "timeout", 0.3)
+    _, complete, _, elapsed = stream(agent)
+    assert elapsed < 1.0
+    assert not complete
+    assert agent.gemini_upstream.breaker.failures == 1
+
+
+def test_stream_is_skipped_while_the_breaker_is_open(agent, monkeypatch):
+    class FailingModel:
+        calls = 0
+
+        async def generate_content_async(self, prompt, stream=False):
+            self.calls += 1
+            raise RuntimeError("injected fault")
+
+    failing = FailingModel()
+    monkeypatch.setattr(agent, "model", failing)
+    for _ in range(agent.gemini_upstream.breaker.failure_threshold):
+        assert stream(agent)[:2] == (None, False)
+    assert agent.gemini_upstream.breaker.state == "open"
+
+    assert stream(agent)[:2] == (None, False)
+    assert failing.calls == agent.gemini_upstream.breaker.failure_threshold
@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+
+from write_behind import WriteBehindQueue
+
+
+# Batch writer standing in for Postgres: records what it wrote, and can be made slow or failing
+class FakeDatabase:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.failing = False
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def write_batch(self, records) -> None:
+        time.sleep(self.latency)
+        if self.failing:
+            raise ConnectionError("database unavailable")
+        with self._lock:
+            self.rows.extend(records)
+
+
+def make_queue(database: FakeDatabase, tmp_path, **options) -> WriteBehindQueue:
+    options = {"batch_size": 1000, "flush_interval": 60.0, **options}
+    return WriteBehindQueue(database.write_batch, str(tmp_path / "turns.spool"), **options)
+
+
+def test_a_full_queue_keeps_the_enqueue_order(tmp_path):
+    database = FakeDatabase(latency=0.05)
+    queue = make_queue(database, tmp_path, max_pending=2, enqueue_timeout=0.01)
+    for n in range(10):
+        queue.enqueue(n)
+    queue.close()
+    assert database.rows == list(range(10))
+    assert queue.stats()["sync_writes"] > 0
+
+
+def test_a_full_queue_with_a_failing_database_doesnt_raise(tmp_path):
+    database = FakeDatabase()
+    database.failing = True
+    queue = make_queue(database, tmp_path, max_pending=2, enqueue_timeout=0.01)
+    for n in range(5):
+        queue.enqueue(n)
+
+    database.failing = False
+    queue.flush()
+    queue.close()
+    assert database.rows == list(range(5))
+
+
+# Simulate the process dying: the thread stops without a final flush, and its lock is released
+def crash(queue: WriteBehindQueue) -> None:
+    queue._stopping = True
+    queue._wakeup.set()
+    queue._thread.join()
+    queue._spool.close()
+    queue._owner_lock.close()
+
+
+def test_records_of_a_crashed_queue_are_recovered_in_order(tmp_path):
+    crashed_database = FakeDatabase()
+    crashed_database.failing = True
+    crashed = make_queue(crashed_database, tmp_path)
+    for n in range(3):
+        crashed.enqueue(n)
+    try:
+        crashed.flush()  # Fails, leaving a segment behind
+    except ConnectionError:
+        pass
+    for n in range(3, 5):
+        crashed.enqueue(n)
+    crash(crashed)
+
+    database = FakeDatabase()
+    queue = make_queue(database, tmp_path)
+    queue.start()
+    queue.close()
+    assert database.rows == list(range(5))
+    assert os.listdir(tmp_path) == []
+
+
+def test_a_running_queue_keeps_its_own_records(tmp_path):
+    running_database = FakeDatabase()
+    running_database.failing = True
+    running = make_queue(running_database, tmp_path)
+    running.enqueue("mine")
+
+    database = FakeDatabase()
+    queue = make_queue(database, tmp_path)
+    queue.start()
+    queue.close()
+    assert database.rows == []
+
+    running_database.failing = False
+    running.close()
+    assert running_database.rows == ["mine"]
@@ -0,0 +1,166 @@
+import time
+import asyncio
+import contextvars
+import httpx
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from tenacity.stop import stop_base
+
+# Response statuses worth another attempt; any other status goes back to the caller as is
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Raised without calling the dependency: its breaker is open or the turn has no time left
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# Raised for a retryable status so tenacity sees it as a failed attempt
+class RetryableStatus(Exception):
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"{response.request.url.host} returned status code {response.status_code}")
+        self.response = response
+
+
+# Time budget of one turn, shared by every node and upstream call made for it
+class Deadline:
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+# The deadline of the turn being served; nodes set it so upstream calls deep in helpers can see it
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+# A timeout capped by what is left of the current turn
+def time_left(timeout: float) -> float:
+    deadline = current_deadline.get()
+    return timeout if deadline is None else min(timeout, deadline.remaining())
+
+
+# Stop retrying when the next backoff would run past the turn's deadline
+class stop_at_deadline(stop_base):
+    def __call__(self, retry_state) -> bool:
+        deadline = current_deadline.get()
+        return deadline is not None and deadline.remaining() <= (retry_state.upcoming_sleep or 0)
+
+
+# Closed: calls go through. Open after failure_threshold consecutive failures: calls are
+# refused for reset_timeout seconds. Half-open: a single probe decides whether to close again.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self.rejected += 1
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    # The call let through was given up before it could succeed or fail; let the next one probe
+    def abandon_probe(self) -> None:
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "opens": self.opens, "rejected": self.rejected}
+
+
+# One external dependency: per-attempt timeout, jittered exponential backoff between attempts,
+# and a circuit breaker so a dependency that keeps failing is skipped instead of waited on.
+# Attempt timeouts and backoff never run past the current turn's deadline.
+class Upstream:
+    def __init__(self, name: str, attempts: int = 3, timeout: float = 5.0, backoff: float = 0.1,
+                 max_backoff: float = 2.0, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 retry_on=(httpx.TransportError, RetryableStatus)):
+        self.name = name
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = tuple(retry_on) + (asyncio.TimeoutError,)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _retryable(self, error: BaseException) -> bool:
+        return isinstance(error, self.retry_on) and not isinstance(error, UpstreamUnavailable)
+
+    def _count_retry(self, retry_state) -> None:
+        self.retries += 1
+
+    # Run operation (an async callable taking no arguments) with retries; raises once they are used up
+    async def call(self, operation):
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(f"{self.name} circuit is open")
+        self.calls += 1
+        try:
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(self.attempts) | stop_at_deadline(),
+                wait=wait_random_exponential(multiplier=self.backoff, max=self.max_backoff),
+                retry=retry_if_exception(self._retryable),
+                before_sleep=self._count_retry,
+                reraise=True,
+            ):
+                with attempt:
+                    timeout = time_left(self.timeout)
+                    if timeout <= 0:
+                        raise UpstreamUnavailable(f"No time left in this turn to call {self.name}")
+                    result = await asyncio.wait_for(operation(), timeout)
+        except (UpstreamUnavailable, asyncio.CancelledError):
+            # Out of time or cancelled with its turn, which says nothing about the dependency
+            self.breaker.abandon_probe()
+            raise
+        except Exception:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    # GET through a shared client; retryable statuses count as failures, others are returned
+    async def get(self, client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+        async def attempt():
+            response = await client.get(url, **kwargs)
+            if response.status_code in RETRYABLE_STATUSES:
+                raise RetryableStatus(response)
+            return response
+
+        return await self.call(attempt)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "retries": self.retries, "failures": self.failures, **self.breaker.stats()}
@@ -0,0 +1,232 @@
+import os
+import glob
+import json
+import uuid
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Buffers records in memory and hands them to write_batch from a background thread.
+# Every record is appended to a spool file before it is acknowledged, and a spool segment
+# is only deleted once its batch is written, so a crash loses nothing (delivery is
+# at-least-once: a crash between the write and the delete replays that batch).
+# spool_path is a prefix: each queue spools to files of its own, "<spool_path>.<owner>[.<segment>]",
+# and holds an flock on "<spool_path>.<owner>.lock" while it runs. A starting queue only takes over
+# the files of owners whose lock is free, i.e. whose process is gone.
+class WriteBehindQueue:
+    def __init__(self, write_batch, spool_path: str, batch_size: int = 100, flush_interval: float = 0.5,
+                 max_pending: int = 10000, enqueue_timeout: float = 1.0, fsync: bool = False):
+        self.write_batch = write_batch  # Callable taking a list of records; raises on failure
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.fsync = fsync
+
+        # Slots are released only once a record is written, so a stalled database pushes back on producers
+        self._capacity = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()        # Guards the buffer and the active spool file
+        self._flush_lock = threading.Lock()  # One flush at a time
+        self._wakeup = threading.Event()
+        self._buffer = []
+        self._buffer_slots = 0  # Capacity slots held by the buffered records
+        self._failed = []  # (segment path, records, capacity slots they hold) that still need writing
+        self._spool = None
+        self._segment = 0
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._owner_lock = None
+        self._thread = None
+        self._stopping = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.sync_writes = 0
+        self.failures = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            if self._owner_lock is None:
+                self._owner_lock = open(f"{self._prefix}.lock", "w")
+                fcntl.flock(self._owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._recover_spool()
+            self._spool = open(self._prefix, "a", encoding="utf-8")
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def enqueue(self, record) -> None:
+        if self._thread is None:
+            self.start()
+        slotted = self._capacity.acquire(timeout=self.enqueue_timeout)
+        with self._lock:
+            self._spool.write(json.dumps(record) + "\n")
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._buffer.append(record)
+            self._buffer_slots += slotted
+            self.enqueued += 1
+            if len(self._buffer) >= self.batch_size:
+                self._wakeup.set()
+        if not slotted:
+            # Still full after waiting: rather than grow without bound, this producer writes the buffer
+            # itself, its own record last, so the records still land in the order they were enqueued
+            self.sync_writes += 1
+            try:
+                self.flush()
+            except Exception as e:
+                # It stays spooled and buffered; the background flush retries it
+                logger.warning("Write-behind inline flush failed - %s", e)
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wakeup.wait(timeout=self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Write-behind flush failed - %s", e)
+
+    # Write everything buffered so far; returns how many records were written
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                if self._buffer:
+                    self._failed.append((self._rotate_spool(), self._buffer, self._buffer_slots))
+                    self._buffer, self._buffer_slots = [], 0
+                pending, self._failed = self._failed, []
+
+            written = 0
+            for index, (segment, records, slots) in enumerate(pending):
+                try:
+                    self.write_batch(records)
+                except Exception:
+                    self.failures += 1
+                    with self._lock:
+                        self._failed = pending[index:] + self._failed
+                    raise
+                try:
+                    os.remove(segment)
+                except FileNotFoundError:
+                    pass  # Already gone, so there is nothing left to replay
+                for _ in range(slots):
+                    self._capacity.release()
+                written += len(records)
+                self.written += len(records)
+                self.batches += 1
+            return written
+
+    # This queue's files: "<prefix>" is the active spool, "<prefix>.<n>" its segments
+    @property
+    def _prefix(self) -> str:
+        return f"{self.spool_path}.{self.owner}"
+
+    def _next_segment(self) -> str:
+        self._segment += 1
+        return f"{self._prefix}.{self._segment}"
+
+    # Close the active spool file under a segment name so new records start a fresh file
+    def _rotate_spool(self) -> str:
+        self._spool.close()
+        segment = self._next_segment()
+        os.replace(self._prefix, segment)
+        self._spool = open(self._prefix, "a", encoding="utf-8")
+        return segment
+
+    # Queue records left behind by processes that are gone for the first flush; a live owner's files are
+    # never touched, because its lock can't be taken
+    def _recover_spool(self) -> None:
+        prefix = glob.escape(self.spool_path)
+        for lock_path in glob.glob(f"{prefix}.*.lock"):
+            owner_prefix = lock_path[:-len(".lock")]
+            if owner_prefix == self._prefix:
+                continue
+            try:
+                lock = open(lock_path, "a")
+            except FileNotFoundError:
+                continue  # Another queue recovered it just now
+            try:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # Its owner is still running
+                segments = sorted(glob.glob(f"{glob.escape(owner_prefix)}.*"), key=self._segment_order)
+                for path in [path for path in segments if path != lock_path] + [owner_prefix]:
+                    self._recover_file(path)
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            finally:
+                lock.close()
+        # Files of the single shared spool used before owners existed
+        legacy = glob.glob(f"{prefix}.recovered.*") + [
+            path for path in glob.glob(f"{prefix}.*.*") if path[len(self.spool_path) + 1:].replace(".", "").isdigit()
+        ]
+        for path in sorted(legacy, key=self._mtime) + [self.spool_path]:
+            self._recover_file(path)
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        try:
+            return os.path.getmtime(path)
+        except FileNotFoundError:
+            return 0.0
+
+    # Oldest first: "<owner>.<n>" segments by n, then the owner's active spool
+    @staticmethod
+    def _segment_order(path: str):
+        suffix = path.rsplit(".", 1)[-1]
+        return int(suffix) if suffix.isdigit() else float("inf")
+
+    # Claim a file by renaming it into this queue's namespace first, so two starting queues never both take it
+    def _recover_file(self, path: str) -> None:
+        segment = self._next_segment()
+        try:
+            os.replace(path, segment)
+        except FileNotFoundError:
+            return
+        with open(segment, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if not records:
+            os.remove(segment)
+            return
+        self._failed.append((segment, records, 0))
+        logger.info("Recovered %d unwritten records from %s", len(records), path)
+
+    # Stop the background thread and write whatever is left
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._spool.close()
+                if not self._failed and not self._buffer:
+                    # Nothing left to replay: drop the empty spool and the lock
+                    for path in (self._prefix, f"{self._prefix}.lock"):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                self._owner_lock.close()
+                self._owner_lock = None
+
+    def stats(self) -> dict:
+        return {
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "batches": self.batches,
+            "buffered": len(self._buffer),
+            "sync_writes": self.sync_writes,
+            "failures": self.failures,
+        }